@@ -0,0 +1,27 @@
+import click
+import frappe
+from frappe.commands import get_site, pass_context
+
+
+@click.command("ferum-notification-worker")
+@click.option("--concurrency", type=int, default=8, help="Maximum number of messages in flight")
+@click.option("--global-rate", type=float, default=30, help="Messages per second across all chats")
+@click.option("--per-chat-rate", type=float, default=1, help="Messages per second to a single chat")
+@pass_context
+def notification_worker(context, concurrency, global_rate, per_chat_rate):
+	"""Start the asyncio Telegram notification worker for a site."""
+	from ferum_custom.notification_worker import run_notification_worker
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		stats = run_notification_worker(
+			concurrency=concurrency, global_rate=global_rate, per_chat_rate=per_chat_rate
+		)
+		click.echo(stats)
+	finally:
+		frappe.destroy()
+
+
+commands = [notification_worker]
@@ -0,0 +1,105 @@
+import hashlib
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+
+HASH_CHUNK_SIZE = 1024 * 1024
+# A blob can be created or deleted concurrently between the lookup and the insert
+BLOB_ACQUIRE_ATTEMPTS = 3
+
+
+class AttachmentBlob(Document):
+	pass
+
+
+def get_content_hash(file_path):
+	"""SHA-256 of a file, read in fixed-size chunks so memory use does not grow with the file."""
+	digest = hashlib.sha256()
+	with open(file_path, "rb") as f:
+		while chunk := f.read(HASH_CHUNK_SIZE):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+
+def acquire_blob(content_hash, file_url, file_size):
+	"""Adds a reference to the blob with `content_hash`, creating it for new content.
+
+	Returns the blob's stored file URL and Drive file id/link, which duplicates reuse instead of
+	storing and uploading the content again. A new blob takes over the File record of `file_url`,
+	so the file lives exactly as long as its last reference.
+	"""
+	fields = ["file_url", "google_drive_file_id", "google_drive_web_link"]
+	for _attempt in range(BLOB_ACQUIRE_ATTEMPTS):
+		# Locked, so the last reference cannot be released (and the blob deleted) in between
+		blob = frappe.db.get_value("AttachmentBlob", content_hash, fields, as_dict=True, for_update=True)
+		if blob:
+			frappe.db.sql(
+				"update `tabAttachmentBlob` set reference_count = reference_count + 1 where name = %s",
+				content_hash,
+			)
+			return blob
+
+		frappe.db.savepoint("acquire_blob")
+		try:
+			frappe.get_doc(
+				{
+					"doctype": "AttachmentBlob",
+					"content_hash": content_hash,
+					"file_url": file_url,
+					"file_size": file_size,
+					"reference_count": 1,
+				}
+			).insert(ignore_permissions=True)
+		except frappe.DuplicateEntryError:
+			# Created concurrently; reference it on the next attempt
+			frappe.db.rollback(save_point="acquire_blob")
+			continue
+
+		frappe.db.set_value(
+			"File",
+			{"file_url": file_url},
+			{
+				"attached_to_doctype": "AttachmentBlob",
+				"attached_to_name": content_hash,
+				"attached_to_field": None,
+			},
+			update_modified=False,
+		)
+		return frappe._dict(file_url=file_url, google_drive_file_id=None, google_drive_web_link=None)
+
+	frappe.throw(_("Could not store the content {0}, please try again.").format(content_hash))
+
+
+def release_blob(content_hash):
+	"""Drops a reference; returns the Drive file id to delete once the last reference is gone."""
+	blob = frappe.db.get_value(
+		"AttachmentBlob",
+		content_hash,
+		["reference_count", "google_drive_file_id"],
+		as_dict=True,
+		for_update=True,
+	)
+	if not blob:
+		return None
+	if blob.reference_count > 1:
+		frappe.db.set_value(
+			"AttachmentBlob", content_hash, "reference_count", blob.reference_count - 1, update_modified=False
+		)
+		return None
+
+	frappe.delete_doc("AttachmentBlob", content_hash, ignore_permissions=True, force=True)
+	return blob.google_drive_file_id
+
+
+def set_blob_drive_files(files):
+	"""Records `{content hash: (Drive file id, web link)}` for blobs uploaded to Drive."""
+	if files:
+		frappe.db.bulk_update(
+			"AttachmentBlob",
+			{
+				content_hash: {"google_drive_file_id": file_id, "google_drive_web_link": web_link}
+				for content_hash, (file_id, web_link) in files.items()
+			},
+			update_modified=False,
+		)
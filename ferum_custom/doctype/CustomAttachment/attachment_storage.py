@@ -0,0 +1,338 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from functools import partial
+
+import frappe
+from frappe import _
+from frappe.utils import add_days, cint, nowdate
+
+# Optional: only needed for an S3-compatible remote tier (AWS, MinIO, localstack, ...)
+try:
+	import boto3
+except ImportError:
+	boto3 = None
+
+# Cache of remote files for server-side use (PDFs, zips, previews); least recently used go first
+DEFAULT_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+CACHE_FOLDER = "attachment_cache"
+# Attachments move to the remote tier once the newest one sharing their file is this old
+DEFAULT_TIERING_RULES = ({"after_days": 90},)
+TIERING_BATCH_SIZE = 200
+DRIVE_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Remote storage clients per worker process, keyed by their configuration
+_remote_storages = {}
+_remote_storages_lock = threading.Lock()
+
+
+class FileSystemStorage:
+	"""Files under a directory. Serves the local tier and, pointed at another disk, a stand-in remote tier."""
+
+	def __init__(self, root):
+		self.root = root
+
+	def get_path(self, key):
+		return os.path.join(self.root, key)
+
+	def upload(self, key, file_path):
+		path = self.get_path(key)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		shutil.copyfile(file_path, f"{path}.part")
+		os.replace(f"{path}.part", path)
+
+	def download(self, key, file_path):
+		shutil.copyfile(self.get_path(key), file_path)
+
+	def delete(self, key):
+		try:
+			os.remove(self.get_path(key))
+		except FileNotFoundError:
+			pass
+
+
+class S3Storage:
+	"""S3-compatible object storage; `endpoint_url` points it at MinIO, localstack or another provider."""
+
+	def __init__(
+		self,
+		bucket,
+		endpoint_url=None,
+		region_name=None,
+		access_key_id=None,
+		secret_access_key=None,
+		prefix="",
+	):
+		if boto3 is None:
+			frappe.throw(_("boto3 is required for S3 attachment storage."))
+		self.bucket = bucket
+		self.prefix = prefix
+		self.client = boto3.client(
+			"s3",
+			endpoint_url=endpoint_url,
+			region_name=region_name,
+			aws_access_key_id=access_key_id,
+			aws_secret_access_key=secret_access_key,
+		)
+
+	def upload(self, key, file_path):
+		# Streams from disk, in parts for large files
+		self.client.upload_file(file_path, self.bucket, self.prefix + key)
+
+	def download(self, key, file_path):
+		self.client.download_file(self.bucket, self.prefix + key, file_path)
+
+	def delete(self, key):
+		self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+
+REMOTE_STORAGE_BACKENDS = {"directory": FileSystemStorage, "s3": S3Storage}
+
+
+class RemoteFileCache:
+	"""Size-bounded LRU cache of remote files on local disk.
+
+	A hit refreshes the file's mtime (atime is unreliable on noatime mounts), and a miss evicts the
+	files used longest ago until the cache fits `max_size` again. Downloads go to a temporary name
+	first, so readers never see a partial file.
+	"""
+
+	def __init__(self, root, max_size=DEFAULT_CACHE_MAX_SIZE):
+		self.root = root
+		self.max_size = max_size
+
+	def get(self, key, fetch):
+		"""Returns the cached path of `key`, calling `fetch(path)` to download it on a miss."""
+		path = os.path.join(self.root, hashlib.sha256(key.encode()).hexdigest())
+		try:
+			os.utime(path)
+			return path
+		except FileNotFoundError:
+			pass
+
+		os.makedirs(self.root, exist_ok=True)
+		temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+		try:
+			fetch(temp_path)
+			os.replace(temp_path, path)
+		finally:
+			if os.path.exists(temp_path):
+				os.remove(temp_path)
+		self.evict(keep=path)
+		return path
+
+	def evict(self, keep=None):
+		entries = []
+		with os.scandir(self.root) as it:
+			for entry in it:
+				if entry.is_file() and not entry.name.endswith(".part"):
+					stat = entry.stat()
+					entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+		total = sum(size for _mtime, size, _path in entries)
+		for _mtime, size, path in sorted(entries):
+			if total <= self.max_size:
+				break
+			if path == keep:
+				continue
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+			total -= size
+
+
+def get_local_file_path(file_url):
+	if "/private/files/" in file_url:
+		return frappe.get_site_path("private", "files", file_url.split("/private/files/")[1])
+	return frappe.get_site_path("public", file_url.lstrip("/"))
+
+
+def get_storage_key(storage_path):
+	"""Key of a stored file in every tier: its path relative to the site, e.g. `private/files/a.pdf`."""
+	return os.path.relpath(get_local_file_path(storage_path), frappe.get_site_path())
+
+
+def get_local_storage():
+	return FileSystemStorage(frappe.get_site_path())
+
+
+def get_remote_storage():
+	"""The configured remote tier, or None.
+
+	Configured in site config as `attachment_remote_storage`, e.g.
+	`{"backend": "s3", "bucket": "attachments", "endpoint_url": "http://minio:9000"}`. `backend` is
+	"s3", "directory" (with `root`) or the dotted path of a class with upload/download/delete.
+	"""
+	config = frappe.conf.get("attachment_remote_storage")
+	if not config:
+		return None
+
+	cache_key = json.dumps(config, sort_keys=True)
+	with _remote_storages_lock:
+		if cache_key not in _remote_storages:
+			options = dict(config)
+			backend = options.pop("backend", "s3")
+			storage_class = REMOTE_STORAGE_BACKENDS.get(backend) or frappe.get_attr(backend)
+			_remote_storages[cache_key] = storage_class(**options)
+		return _remote_storages[cache_key]
+
+
+def get_file_cache():
+	max_size = cint(frappe.conf.get("attachment_cache_max_size")) or DEFAULT_CACHE_MAX_SIZE
+	return RemoteFileCache(frappe.get_site_path(CACHE_FOLDER), max_size)
+
+
+def get_tiering_rules():
+	"""`attachment_tiering_rules` from site config: `[{"after_days": 30, "linked_doctype": "ServiceReport"},
+	{"after_days": 90}]`. A rule without `linked_doctype` covers every other attachment."""
+	return frappe.conf.get("attachment_tiering_rules") or DEFAULT_TIERING_RULES
+
+
+def get_attachment_file_path(name):
+	"""Local path of a CustomAttachment's content for server-side use such as PDFs, zips or previews.
+
+	Local files are used in place. Files in the remote tier, and legacy attachments only kept on Google
+	Drive, are downloaded once into the LRU cache and served from there.
+	"""
+	doc = frappe.db.get_value(
+		"CustomAttachment", name, ["storage_path", "storage_tier", "google_drive_file_id"], as_dict=True
+	)
+	if not doc:
+		frappe.throw(_("Attachment {0} not found.").format(name), frappe.DoesNotExistError)
+
+	if doc.storage_path:
+		key = get_storage_key(doc.storage_path)
+		remote = get_remote_storage()
+		if doc.storage_tier == "Remote" and remote:
+			return get_file_cache().get(f"remote:{key}", partial(remote.download, key))
+		path = get_local_storage().get_path(key)
+		if os.path.exists(path):
+			return path
+
+	if doc.google_drive_file_id:
+		return get_file_cache().get(
+			f"drive:{doc.google_drive_file_id}", partial(download_from_google_drive, doc.google_drive_file_id)
+		)
+	frappe.throw(_("The file of attachment {0} is not available.").format(name), FileNotFoundError)
+
+
+def download_from_google_drive(file_id, file_path):
+	from ferum_custom.doctype.CustomAttachment.custom_attachment import (
+		get_drive_api_base_url,
+		get_drive_session,
+	)
+
+	session = get_drive_session()
+	if not session:
+		frappe.throw(_("Google Drive integration is not configured."))
+	with session.get(
+		f"{get_drive_api_base_url()}/drive/v3/files/{file_id}",
+		params={"alt": "media", "supportsAllDrives": "true"},
+		stream=True,
+		timeout=(10, 120),
+	) as response:
+		response.raise_for_status()
+		with open(file_path, "wb") as f:
+			for chunk in response.iter_content(DRIVE_DOWNLOAD_CHUNK_SIZE):
+				f.write(chunk)
+
+
+def apply_storage_tiering():
+	"""Daily job: moves attachments whose tiering rule has expired from local disk to the remote tier.
+
+	Files are grouped by their stored path, since deduplicated attachments share one file; a file
+	moves once every attachment using it is past the rule of its own linked doctype. Only files
+	whose attachments already link to their Drive copy are moved, and File records pointing at the
+	local copy are switched to that link in the same transaction. The local copy is removed only
+	after the new tier is committed.
+	"""
+	remote = get_remote_storage()
+	if not remote:
+		return
+
+	cutoff, values = _get_tiering_cutoff(get_tiering_rules())
+	while True:
+		rows = frappe.db.sql(
+			f"""select storage_path, max(file_url) from `tabCustomAttachment`
+			where storage_tier = 'Local' and ifnull(storage_path, '') != ''
+			group by storage_path
+			having min(ifnull(creation < {cutoff}, 0)) = 1
+				and min(ifnull(file_url, '') like 'http%%') = 1
+			limit {TIERING_BATCH_SIZE}""",
+			values,
+		)
+		# Paths that failed to upload stay local for the next run
+		if _move_to_remote(remote, rows) < len(rows) or len(rows) < TIERING_BATCH_SIZE:
+			break
+
+
+def _get_tiering_cutoff(rules):
+	"""SQL expression for the creation cutoff of an attachment's rule, and its values. Attachments that
+	no rule covers get no cutoff and are never moved."""
+	cases, values = [], {"default_cutoff": None}
+	for i, rule in enumerate(rules):
+		cutoff = add_days(nowdate(), -cint(rule["after_days"]))
+		if rule.get("linked_doctype"):
+			cases.append(f"when %(doctype_{i})s then %(cutoff_{i})s")
+			values.update({f"doctype_{i}": rule["linked_doctype"], f"cutoff_{i}": cutoff})
+		elif values["default_cutoff"] is None:
+			values["default_cutoff"] = cutoff
+
+	if not cases:
+		return "%(default_cutoff)s", values
+	return f"(case ifnull(linked_doctype, '') {' '.join(cases)} else %(default_cutoff)s end)", values
+
+
+def _move_to_remote(remote, rows):
+	"""Uploads the files of `(storage path, Drive link)` rows and flips their attachments to the remote
+	tier. Returns how many were settled."""
+	local = get_local_storage()
+	tiers, remote_urls = {}, {}
+	for storage_path, remote_url in rows:
+		key = get_storage_key(storage_path)
+		if not os.path.exists(local.get_path(key)):
+			# Nothing to move; marked so it does not come up again
+			tiers[storage_path] = "Missing"
+			continue
+		try:
+			remote.upload(key, local.get_path(key))
+			tiers[storage_path] = "Remote"
+			remote_urls[storage_path] = remote_url
+		except Exception:
+			frappe.log_error(
+				title="Attachment tiering failed", message=f"{storage_path}\n{frappe.get_traceback()}"
+			)
+
+	for tier in ("Remote", "Missing"):
+		paths = [storage_path for storage_path, new_tier in tiers.items() if new_tier == tier]
+		if paths:
+			frappe.db.sql(
+				"""update `tabCustomAttachment` set storage_tier = %(tier)s
+				where storage_path in %(paths)s and storage_tier = 'Local'""",
+				{"tier": tier, "paths": tuple(paths)},
+			)
+	if remote_urls:
+		# File records must not keep pointing at the local copy that is removed below
+		cases = " ".join(["when %s then %s"] * len(remote_urls))
+		frappe.db.sql(
+			f"update `tabFile` set file_url = case file_url {cases} end where file_url in %s",
+			(*[value for row in remote_urls.items() for value in row], tuple(remote_urls)),
+		)
+	frappe.db.commit()
+
+	for storage_path, tier in tiers.items():
+		if tier == "Remote":
+			local.delete(get_storage_key(storage_path))
+	return len(tiers)
+
+
+def release_remote_file(storage_path, name):
+	"""Deletes a remote-tier file after commit unless another attachment besides `name` still uses it."""
+	remote = get_remote_storage()
+	if remote and not frappe.db.exists(
+		"CustomAttachment", {"storage_path": storage_path, "name": ["!=", name]}
+	):
+		frappe.db.after_commit.add(partial(remote.delete, get_storage_key(storage_path)))
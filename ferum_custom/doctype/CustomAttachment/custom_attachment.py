@@ -1,13 +1,31 @@
 import mimetypes
 import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
 
 import frappe
-from frappe import _
+import requests  # type: ignore[import-untyped]
 from frappe.model.document import Document
-from frappe.utils.background_jobs import enqueue
+from frappe.utils import add_to_date, cint, now_datetime
+
+from ferum_custom.doctype.AttachmentBlob.attachment_blob import (
+	acquire_blob,
+	get_content_hash,
+	release_blob,
+	set_blob_drive_files,
+)
+from ferum_custom.doctype.CustomAttachment.attachment_storage import (
+	get_local_file_path,
+	get_local_storage,
+	get_storage_key,
+	release_remote_file,
+)
 
 # Conditional import for google-api-python-client and google-auth
 try:
+	from google.auth.transport.requests import AuthorizedSession
 	from google.oauth2 import service_account
 	from googleapiclient.discovery import build
 
@@ -19,82 +37,515 @@ except ImportError:
 		"Google Drive Integration",
 	)
 
+DRIVE_SCOPES = ["https://www.googleapis.com/auth/drive"]
+# Overridable in site config (google_drive_api_base_url), e.g. to point at a local fake Drive
+DEFAULT_DRIVE_API_BASE_URL = "https://www.googleapis.com"
+# Resumable upload chunks must be a multiple of 256 KiB
+UPLOAD_CHUNK_GRANULARITY = 256 * 1024
+DEFAULT_UPLOAD_CHUNK_SIZE = 32 * UPLOAD_CHUNK_GRANULARITY
+UPLOAD_TIMEOUT = (10, 120)
+MAX_UPLOAD_RETRIES = 5
+UPLOAD_RETRY_BACKOFF_SECONDS = 2
+RESUME_INCOMPLETE = 308
+# Drive accepts at most 100 calls per batch request
+DRIVE_BATCH_SIZE = 100
+DRIVE_UPLOAD_CONCURRENCY = 4
+# An attachment whose claim was not renewed for this long is assumed to belong to a dead worker
+UPLOAD_CLAIM_TIMEOUT_MINUTES = 60
+# Claims of uploads that are still making progress are renewed this often
+UPLOAD_HEARTBEAT_SECONDS = 5 * 60
+
+# Credentials, API client and HTTP session per worker process, rebuilt when the key file changes
+_drive_clients = {}
+_drive_clients_lock = threading.Lock()
+
+
+class UploadSessionExpired(Exception):
+	pass
+
 
 class CustomAttachment(Document):
 	def before_insert(self):
-		if self.file_url and GOOGLE_DRIVE_INTEGRATION_ENABLED:
-			enqueue(upload_to_google_drive, queue="long", doc_name=self.name)
+		self.reference_content_blob()
+		if self.file_url and not self.google_drive_file_id and GOOGLE_DRIVE_INTEGRATION_ENABLED:
+			self.google_drive_status = "Queued"
+
+	def after_insert(self):
+		# Attachments of a ServiceReport are uploaded together by the report (see queue_attachment_uploads)
+		if (
+			self.file_url
+			and not self.google_drive_file_id
+			and GOOGLE_DRIVE_INTEGRATION_ENABLED
+			and self.linked_doctype != "ServiceReport"
+		):
+			queue_drive_operation("upload", self.name)
+
+	def on_update(self):
+		self.rename_drive_file()
 
 	def on_trash(self):
-		if self.google_drive_file_id and GOOGLE_DRIVE_INTEGRATION_ENABLED:
-			enqueue(delete_from_google_drive, queue="long", doc_name=self.name)
+		if self.storage_tier == "Remote":
+			release_remote_file(self.storage_path, self.name)
+		# Content shared with other attachments stays on Drive until its last reference is gone
+		file_id = release_blob(self.content_hash) if self.content_hash else self.google_drive_file_id
+		if file_id and GOOGLE_DRIVE_INTEGRATION_ENABLED:
+			queue_drive_operation("delete", file_id)
+
+	def rename_drive_file(self):
+		# The Drive copy follows a renamed attachment, unless other attachments share that copy
+		before = self.get_doc_before_save()
+		if (
+			not GOOGLE_DRIVE_INTEGRATION_ENABLED
+			or not self.google_drive_file_id
+			or not before
+			or before.file_name == self.file_name
+			or not self.file_name
+		):
+			return
+		if not frappe.db.exists(
+			"CustomAttachment", {"google_drive_file_id": self.google_drive_file_id, "name": ["!=", self.name]}
+		):
+			queue_drive_operation("update", (self.google_drive_file_id, {"name": self.file_name}))
+
+	def reference_content_blob(self):
+		# Identical content is stored and uploaded once; duplicates point at the existing copy
+		if not self.file_url or self.file_url.startswith(("http://", "https://")):
+			return
+		file_path = get_local_file_path(self.file_url)
+		if not os.path.exists(file_path):
+			return
+
+		self.content_hash = get_content_hash(file_path)
+		blob = acquire_blob(self.content_hash, self.file_url, os.path.getsize(file_path))
+		# The blob's file may have moved to the remote tier; this upload's own copy is local
+		if blob.file_url and os.path.exists(get_local_file_path(blob.file_url)):
+			if blob.file_url != self.file_url:
+				discard_duplicate_upload(self.file_url)
+			self.file_url = blob.file_url
+		# file_url is replaced by the Drive link after upload; the stored file stays reachable here
+		self.storage_path = self.file_url
+		self.storage_tier = "Local"
+		if blob.google_drive_file_id:
+			self.google_drive_file_id = blob.google_drive_file_id
+			self.file_url = blob.google_drive_web_link or self.file_url
+			self.google_drive_status = "Uploaded"
+
+
+def discard_duplicate_upload(file_url):
+	"""Drops the File record of an upload whose content is already stored, and its file once committed."""
+	frappe.db.delete("File", {"file_url": file_url})
+	frappe.db.after_commit.add(partial(get_local_storage().delete, get_storage_key(file_url)))
+
+
+def queue_drive_operation(operation, value):
+	"""Queues a Drive "upload" (attachment name), "delete" or "update" ((file id, metadata)).
+
+	Everything a transaction queues is run by one background job after it commits, with deletes
+	and metadata updates sent as Drive batch requests; a rollback discards the queue.
+	"""
+	pending = getattr(frappe.local, "ferum_drive_operations", None)
+	if pending is None:
+		pending = frappe.local.ferum_drive_operations = {"upload": [], "delete": [], "update": []}
+		frappe.db.after_commit.add(_enqueue_pending_drive_operations)
+		frappe.db.after_rollback.add(_discard_pending_drive_operations)
+	if value not in pending[operation]:
+		pending[operation].append(value)
+
+
+def queue_attachment_uploads(names):
+	"""Queues the upload of every attachment in `names` that is not on Drive yet."""
+	if not GOOGLE_DRIVE_INTEGRATION_ENABLED or not names:
+		return
+	for name in frappe.get_all(
+		"CustomAttachment",
+		filters={"name": ["in", list(names)], "google_drive_file_id": ["is", "not set"]},
+		pluck="name",
+	):
+		queue_drive_operation("upload", name)
+
+
+def _enqueue_pending_drive_operations():
+	pending = frappe.local.ferum_drive_operations
+	frappe.local.ferum_drive_operations = None
+	if pending and any(pending.values()):
+		frappe.enqueue(
+			"ferum_custom.doctype.CustomAttachment.custom_attachment.run_drive_operations",
+			queue="long",
+			uploads=pending["upload"],
+			deletes=pending["delete"],
+			updates=pending["update"],
+		)
+
+
+def _discard_pending_drive_operations():
+	frappe.local.ferum_drive_operations = None
+
+
+def run_drive_operations(uploads=(), deletes=(), updates=()):
+	"""Background job: runs the Drive operations one transaction queued."""
+	if deletes or updates:
+		service = get_drive_service()
+		if service:
+			calls = [("delete", file_id) for file_id in deletes]
+			calls += [("update", tuple(update)) for update in updates]
+			for (operation, value), error in zip(calls, execute_drive_batch(service, calls), strict=True):
+				if error:
+					frappe.log_error(
+						f"Google Drive {operation} of {value} failed: {error}",
+						"Google Drive Integration Error",
+					)
+	if uploads:
+		upload_attachments(uploads)
+
+
+def execute_drive_batch(service, calls):
+	"""Sends `("delete", file id)` and `("update", (file id, metadata))` calls as Drive batch requests.
+
+	Returns one error (or None) per call, in order. Deleting a file that is already gone counts as
+	success.
+	"""
+	errors = [None] * len(calls)
+
+	def record(request_id, response, exception):
+		if exception is not None and getattr(getattr(exception, "resp", None), "status", None) != 404:
+			errors[int(request_id)] = exception
+
+	files = service.files()
+	for start in range(0, len(calls), DRIVE_BATCH_SIZE):
+		batch = service.new_batch_http_request(callback=record)
+		for index in range(start, min(start + DRIVE_BATCH_SIZE, len(calls))):
+			operation, value = calls[index]
+			if operation == "delete":
+				request = files.delete(fileId=value, supportsAllDrives=True)
+			else:
+				file_id, metadata = value
+				request = files.update(fileId=file_id, body=metadata, supportsAllDrives=True)
+			batch.add(request, request_id=str(index))
+		try:
+			batch.execute()
+		except Exception as e:
+			for index in range(start, min(start + DRIVE_BATCH_SIZE, len(calls))):
+				errors[index] = errors[index] or e
+	return errors
 
 
 @frappe.whitelist()
 def upload_to_google_drive(doc_name):
-	doc = frappe.get_doc("CustomAttachment", doc_name)
-	if not doc.file_url:
-		return
+	upload_attachments([doc_name])
 
-	service = get_drive_service()
-	if not service:
-		return
 
-	file_path = frappe.get_site_path("public", doc.file_url.lstrip("/"))
-	if "/private/files/" in doc.file_url:
-		file_path = frappe.get_site_path("private", doc.file_url.split("/private/files/")[1])
+def upload_attachments(names):
+	"""Uploads many attachments to Drive with a bounded pool of threads.
 
-	if not os.path.exists(file_path):
-		frappe.log_error(f"File not found on server: {file_path}", "Google Drive Upload Error")
+	The attachments are claimed first so concurrent jobs never upload the same file twice. Upload
+	sessions are opened (or resumed) and committed up front, so the threads only stream bytes and a
+	crashed job resumes every file mid-way. While the threads stream, the claims of uploads that
+	keep storing chunks are renewed, so a long upload is not taken for a dead worker's. The outcome
+	of all files is written back in one bulk update.
+	"""
+	session = get_drive_session()
+	if not session:
 		return
 
-	file_metadata = {
-		"name": doc.file_name or os.path.basename(file_path),
-		"parents": [frappe.conf.get("google_drive_folder_id")],
-	}
+	docs = _claim_attachments(names)
+	results = {}
+	transfers = []
+	# Content already on Drive is reused; content claimed twice is uploaded by its first attachment
+	uploaded_blobs = _get_uploaded_blobs({doc.content_hash for doc in docs if doc.content_hash})
+	uploader_by_hash = {}
+	duplicates = {}
+	for doc in docs:
+		if doc.content_hash in uploaded_blobs:
+			results[doc.name] = uploaded_blobs[doc.content_hash]
+			continue
+		if doc.content_hash in uploader_by_hash:
+			duplicates[doc.name] = uploader_by_hash[doc.content_hash]
+			continue
+		if doc.content_hash:
+			uploader_by_hash[doc.content_hash] = doc.name
+
+		file_path = get_local_file_path(doc.file_url)
+		if not os.path.exists(file_path):
+			results[doc.name] = FileNotFoundError(f"File not found on server: {file_path}")
+			continue
+		try:
+			session_url, offset, file = open_upload_session(session, doc, file_path)
+		except Exception as e:
+			results[doc.name] = e
+			continue
+		if file is not None:
+			results[doc.name] = file
+		else:
+			doc.google_drive_upload_session = session_url
+			transfers.append((doc, file_path, offset))
+
+	if transfers:
+		sessions = {doc.name: doc.google_drive_upload_session for doc, _path, _offset in transfers}
+		frappe.db.bulk_update(
+			"CustomAttachment",
+			{name: {"google_drive_upload_session": url} for name, url in sessions.items()},
+			update_modified=False,
+		)
+		frappe.db.commit()
+
+		# Bytes stored per attachment, written by the threads and read here for the heartbeat
+		progress = {doc.name: offset for doc, _path, offset in transfers}
+		with ThreadPoolExecutor(max_workers=min(DRIVE_UPLOAD_CONCURRENCY, len(transfers))) as pool:
+			futures = {
+				pool.submit(
+					upload_chunks,
+					session,
+					doc.google_drive_upload_session,
+					file_path,
+					offset,
+					on_progress=partial(progress.__setitem__, doc.name),
+				): doc.name
+				for doc, file_path, offset in transfers
+			}
+			pending, renewed = set(futures), dict(progress)
+			next_heartbeat = time.monotonic() + UPLOAD_HEARTBEAT_SECONDS
+			while pending:
+				done, pending = wait(pending, timeout=UPLOAD_HEARTBEAT_SECONDS, return_when=FIRST_COMPLETED)
+				for future in done:
+					try:
+						results[futures[future]] = future.result()
+					except Exception as e:
+						results[futures[future]] = e
+				if pending and time.monotonic() >= next_heartbeat:
+					renewed = _renew_upload_claims([futures[future] for future in pending], progress, renewed)
+					next_heartbeat = time.monotonic() + UPLOAD_HEARTBEAT_SECONDS
 
-	mime_type, _ = mimetypes.guess_type(file_path)
-	media = {
-		"body": open(file_path, "rb"),
-		"mimeType": mime_type or "application/octet-stream",
+	for name, uploader in duplicates.items():
+		results[name] = results.get(uploader)
+	set_blob_drive_files(
+		{
+			content_hash: (results[name].get("id"), results[name].get("webViewLink"))
+			for content_hash, name in uploader_by_hash.items()
+			if isinstance(results.get(name), dict)
+		}
+	)
+	_write_upload_results(docs, results)
+
+
+def _get_uploaded_blobs(content_hashes):
+	if not content_hashes:
+		return {}
+	return {
+		blob.name: {"id": blob.google_drive_file_id, "webViewLink": blob.google_drive_web_link}
+		for blob in frappe.get_all(
+			"AttachmentBlob",
+			filters={"name": ["in", list(content_hashes)], "google_drive_file_id": ["is", "set"]},
+			fields=["name", "google_drive_file_id", "google_drive_web_link"],
+		)
 	}
 
-	try:
-		file = (
-			service.files().create(body=file_metadata, media_body=media, fields="id, webViewLink").execute()
+
+def _claim_attachments(names):
+	docs = frappe.db.sql(
+		"""select name, file_name, file_url, content_hash, google_drive_upload_session
+		from `tabCustomAttachment`
+		where name in %(names)s
+			and ifnull(google_drive_file_id, '') = ''
+			and (ifnull(google_drive_status, '') != 'Uploading' or modified < %(stale)s)
+		for update skip locked""",
+		{
+			"names": tuple(names),
+			"stale": add_to_date(now_datetime(), minutes=-UPLOAD_CLAIM_TIMEOUT_MINUTES),
+		},
+		as_dict=True,
+	)
+	if docs:
+		frappe.db.bulk_update(
+			"CustomAttachment", {doc.name: {"google_drive_status": "Uploading"} for doc in docs}
 		)
-		doc.google_drive_file_id = file.get("id")
-		doc.file_url = file.get("webViewLink")
-		doc.save()
-		frappe.msgprint(_(f"File {doc.file_name} uploaded to Google Drive."))
-	except Exception as e:
-		frappe.log_error(
-			f"Failed to upload file {doc.file_name} to Google Drive: {e}",
-			"Google Drive Integration Error",
+	frappe.db.commit()
+	return docs
+
+
+def _renew_upload_claims(names, progress, renewed):
+	"""Refreshes `modified` of the claims whose upload stored more bytes since the last renewal, so
+	only a stalled upload can go stale. Returns the progress the claims were renewed at."""
+	advanced = [name for name in names if progress[name] != renewed.get(name)]
+	if advanced:
+		frappe.db.sql(
+			"""update `tabCustomAttachment` set modified = %(now)s
+			where name in %(names)s and google_drive_status = 'Uploading'""",
+			{"now": now_datetime(), "names": tuple(advanced)},
 		)
+		frappe.db.commit()
+	return {**renewed, **{name: progress[name] for name in advanced}}
+
+
+def _write_upload_results(docs, results):
+	updates = {}
+	for doc in docs:
+		result = results.get(doc.name)
+		if isinstance(result, dict):
+			updates[doc.name] = {
+				"google_drive_file_id": result.get("id"),
+				"file_url": result.get("webViewLink"),
+				"google_drive_status": "Uploaded",
+				"google_drive_upload_session": None,
+				"google_drive_error": None,
+			}
+		else:
+			updates[doc.name] = {"google_drive_status": "Failed", "google_drive_error": str(result)}
+			if isinstance(result, UploadSessionExpired):
+				# The next attempt starts a new session
+				updates[doc.name]["google_drive_upload_session"] = None
+			frappe.log_error(
+				f"Failed to upload file {doc.file_name} to Google Drive: {result}",
+				"Google Drive Integration Error",
+			)
+	if updates:
+		frappe.db.bulk_update("CustomAttachment", updates)
+	frappe.db.commit()
+
+
+def open_upload_session(session, doc, file_path):
+	"""Returns `(session url, bytes already received, None)`, or `(…, file metadata)` if Drive has it all.
+
+	Resumes `doc.google_drive_upload_session` when Drive still knows it and opens a new resumable
+	upload session otherwise.
+	"""
+	total = os.path.getsize(file_path)
+	if doc.google_drive_upload_session:
+		try:
+			offset, file = _query_upload(session, doc.google_drive_upload_session, total)
+			return doc.google_drive_upload_session, offset, file
+		except UploadSessionExpired:
+			pass
+	return _start_upload_session(session, doc, file_path, total), 0, None
+
+
+def upload_chunks(session, session_url, file_path, offset=0, chunk_size=None, on_progress=None):
+	"""Streams `file_path` from `offset` to a resumable upload session and returns the file's metadata.
+
+	Only one chunk is held in memory at a time. Transient errors ask Drive how much it stored and
+	continue from there. `on_progress(bytes stored)` is called whenever Drive confirms more bytes.
+	Touches no database, so it can run in worker threads.
+	"""
+	chunk_size = chunk_size or get_upload_chunk_size()
+	total = os.path.getsize(file_path)
+
+	retries = 0
+	with open(file_path, "rb") as f:
+		while True:
+			f.seek(offset)
+			chunk = f.read(chunk_size)
+			content_range = (
+				f"bytes {offset}-{offset + len(chunk) - 1}/{total}" if chunk else f"bytes */{total}"
+			)
+			try:
+				response = session.put(
+					session_url, data=chunk, headers={"Content-Range": content_range}, timeout=UPLOAD_TIMEOUT
+				)
+				if response.status_code >= 500:
+					response.raise_for_status()
+			except requests.RequestException:
+				retries += 1
+				if retries > MAX_UPLOAD_RETRIES:
+					raise
+				time.sleep(UPLOAD_RETRY_BACKOFF_SECONDS * retries)
+				# Drive may have stored part of the failed chunk
+				offset, file = _query_upload(session, session_url, total)
+				if file is not None:
+					return file
+				if on_progress:
+					on_progress(offset)
+				continue
+
+			if response.status_code in (200, 201):
+				return response.json()
+			if response.status_code == RESUME_INCOMPLETE:
+				offset = _get_received_bytes(response)
+				retries = 0
+				if on_progress:
+					on_progress(offset)
+				continue
+			if response.status_code in (404, 410):
+				raise UploadSessionExpired(session_url)
+			response.raise_for_status()
+			raise requests.HTTPError(f"Unexpected upload response {response.status_code}", response=response)
+
+
+def get_upload_chunk_size():
+	size = cint(frappe.conf.get("google_drive_upload_chunk_size")) or DEFAULT_UPLOAD_CHUNK_SIZE
+	return max(UPLOAD_CHUNK_GRANULARITY, size // UPLOAD_CHUNK_GRANULARITY * UPLOAD_CHUNK_GRANULARITY)
+
+
+def get_drive_api_base_url():
+	return (frappe.conf.get("google_drive_api_base_url") or DEFAULT_DRIVE_API_BASE_URL).rstrip("/")
+
+
+def _start_upload_session(session, doc, file_path, total):
+	mime_type, _encoding = mimetypes.guess_type(file_path)
+	response = session.post(
+		f"{get_drive_api_base_url()}/upload/drive/v3/files",
+		params={"uploadType": "resumable", "fields": "id,webViewLink", "supportsAllDrives": "true"},
+		json={
+			"name": doc.file_name or os.path.basename(file_path),
+			"parents": [frappe.conf.get("google_drive_folder_id")],
+		},
+		headers={
+			"X-Upload-Content-Type": mime_type or "application/octet-stream",
+			"X-Upload-Content-Length": str(total),
+		},
+		timeout=UPLOAD_TIMEOUT,
+	)
+	response.raise_for_status()
+	return response.headers["Location"]
+
+
+def _query_upload(session, session_url, total):
+	"""Returns `(bytes received, None)` for an unfinished upload or `(total, file)` for a finished one."""
+	response = session.put(
+		session_url, data=b"", headers={"Content-Range": f"bytes */{total}"}, timeout=UPLOAD_TIMEOUT
+	)
+	if response.status_code in (200, 201):
+		return total, response.json()
+	if response.status_code == RESUME_INCOMPLETE:
+		return _get_received_bytes(response), None
+	if response.status_code in (404, 410):
+		raise UploadSessionExpired(session_url)
+	response.raise_for_status()
+	raise requests.HTTPError(f"Unexpected upload response {response.status_code}", response=response)
+
+
+def _get_received_bytes(response):
+	# "Range: bytes=0-1048575" once Drive has stored anything, absent before that
+	received = response.headers.get("Range")
+	return int(received.rsplit("-", 1)[1]) + 1 if received else 0
 
 
 @frappe.whitelist()
 def delete_from_google_drive(doc_name):
-	doc = frappe.get_doc("CustomAttachment", doc_name)
-	if not doc.google_drive_file_id:
-		return
+	file_id = frappe.db.get_value("CustomAttachment", doc_name, "google_drive_file_id")
+	if file_id:
+		run_drive_operations(deletes=[file_id])
 
-	service = get_drive_service()
-	if not service:
-		return
 
-	try:
-		service.files().delete(fileId=doc.google_drive_file_id).execute()
-		frappe.msgprint(_(f"File {doc.file_name} deleted from Google Drive."))
-	except Exception as e:
-		frappe.log_error(
-			f"Failed to delete file {doc.file_name} from Google Drive: {e}",
-			"Google Drive Integration Error",
-		)
+def get_drive_service():
+	"""Discovery-based Drive API client, cached per worker process."""
+	client = _get_drive_client()
+	if not client:
+		return None
+	if "service" not in client:
+		client["service"] = build("drive", "v3", credentials=client["credentials"], cache_discovery=False)
+	return client["service"]
 
 
-def get_drive_service():
+def get_drive_session():
+	"""Authorised HTTP session for raw Drive calls such as resumable uploads, cached per worker process."""
+	client = _get_drive_client()
+	if not client:
+		return None
+	if "session" not in client:
+		client["session"] = AuthorizedSession(client["credentials"])
+	return client["session"]
+
+
+def _get_drive_client():
 	if not GOOGLE_DRIVE_INTEGRATION_ENABLED:
 		return None
 
@@ -106,10 +557,15 @@ def get_drive_service():
 			)
 			return None
 
-		credentials = service_account.Credentials.from_service_account_file(
-			key_file_path, scopes=["https://www.googleapis.com/auth/drive"]
-		)
-		return build("drive", "v3", credentials=credentials)
+		version = os.path.getmtime(key_file_path)
+		with _drive_clients_lock:
+			client = _drive_clients.get(key_file_path)
+			if not client or client["version"] != version:
+				credentials = service_account.Credentials.from_service_account_file(
+					key_file_path, scopes=DRIVE_SCOPES
+				)
+				client = _drive_clients[key_file_path] = {"version": version, "credentials": credentials}
+			return client
 	except Exception as e:
 		frappe.log_error(f"Failed to get Google Drive service: {e}", "Google Drive Integration Error")
 		return None
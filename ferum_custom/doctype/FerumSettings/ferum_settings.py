@@ -0,0 +1,10 @@
+import frappe
+from frappe.model.document import Document
+
+from ferum_custom.settings import clear_settings_cache
+
+
+class FerumSettings(Document):
+	def on_update(self):
+		# Cleared only once the save commits, so concurrent readers cannot re-cache the old values
+		frappe.db.after_commit.add(clear_settings_cache)
@@ -7,6 +7,8 @@ from frappe.model.document import Document
 from frappe.utils.background_jobs import enqueue
 from google.oauth2.service_account import Credentials
 
+from ferum_custom.workflow import validate_status_transition
+
 # --- Google Sheets Integration ---
 
 GOOGLE_SHEETS_INTEGRATION_ENABLED = frappe.conf.get("google_sheets_integration_enabled", False)
@@ -33,6 +35,9 @@ from backend.bot.telegram_bot import send_telegram_message
 
 
 class Invoice(Document):
+	def validate(self):
+		self.validate_status_transitions()
+
 	def after_insert(self):
 		self.notify_on_subcontractor_invoice()
 		enqueue("ferum_custom.doctype.invoice.invoice.sync_to_google_sheets", queue="short", doc=self)
@@ -40,6 +45,10 @@ class Invoice(Document):
 	def on_update(self):
 		pass  # Handled by hooks
 
+	def validate_status_transitions(self):
+		# Transition rules live in ferum_custom.workflow
+		validate_status_transition(self, "Invoice")
+
 	def notify_on_subcontractor_invoice(self):
 		if self.counterparty_type == "Subcontractor":
 			message = f"New subcontractor invoice created: {self.name} for {self.counterparty_name}. Amount: {self.amount}"
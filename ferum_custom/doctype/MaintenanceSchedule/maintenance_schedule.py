@@ -1,55 +1,445 @@
+import calendar
+import json
+from datetime import timedelta
+
 import frappe
-from frappe.utils import add_days, add_months, add_years, getdate, nowdate
+from frappe import _
+from frappe.utils import add_days, cint, get_first_day_of_week, getdate, nowdate
+from redis.exceptions import LockError
+
+from ferum_custom.doctype.ServiceRequest.service_request import remove_from_sla_timer_after_commit
+from ferum_custom.notifications import notification_digest
+
+GENERATION_CHUNK_SIZE = 200
+# Schedules per background job; the jobs of one run are processed in parallel by the workers
+GENERATION_SHARD_SIZE = 500
+GENERATION_CHECKPOINT_KEY = "ferum_maintenance_generation_checkpoint"
+GENERATION_LOCK_KEY = "ferum_maintenance_generation_lock"
+GENERATION_LOCK_TIMEOUT = 60 * 60
+# Backfill creates at most this many occurrences per schedule and run; the rest stays due
+MAX_BACKFILL_OCCURRENCES = 100
+FORECAST_CACHE_KEY = "ferum_maintenance_forecast"
+FORECAST_MAX_WEEKS = 53
+FORECAST_GROUPS = ("customer", "service_project", "service_object")
+# Frequency -> (days, months) per period
+FREQUENCY_PERIODS = {
+	"Daily": (1, 0),
+	"Weekly": (7, 0),
+	"Monthly": (0, 1),
+	"Annually": (0, 12),
+}
 
 
 def generate_service_requests_from_schedule():
+	"""Scheduler job: splits the due MaintenanceSchedules into name ranges, one background job each."""
 	today = nowdate()
-	maintenance_schedules = frappe.get_list(
+	names = frappe.get_all(
 		"MaintenanceSchedule",
 		filters={
 			"next_due_date": ["<=", today],
 			"docstatus": 0,  # Draft or active schedules
 		},
-		fields=["name"],
+		pluck="name",
+		order_by="name asc",
 	)
+	for start in range(0, len(names), GENERATION_SHARD_SIZE):
+		shard = names[start : start + GENERATION_SHARD_SIZE]
+		frappe.enqueue(
+			"ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule.generate_for_schedule_range",
+			queue="long",
+			job_id=f"ferum_maintenance_generation::{shard[0]}",
+			deduplicate=True,
+			first=shard[0],
+			last=shard[-1],
+			today=today,
+		)
+
+
+def generate_for_schedule_range(first, last, today=None, chunk_size=GENERATION_CHUNK_SIZE):
+	"""Background job: creates the ServiceRequests of the due schedules named `first`..`last`.
+
+	Due schedules and their items are fetched in two queries and turned into ServiceRequests in
+	memory, one per item and due occurrence (see `expand_occurrences` for missed ones). Requests
+	are inserted in chunks of whole schedules; each chunk advances its schedules'
+	`next_due_date` and the range checkpoint in the same commit, so an interrupted run resumes after
+	the last committed schedule instead of starting over.
+
+	A range is processed by one worker at a time. Every request carries an idempotency key
+	(schedule, item, occurrence date) backed by a unique index, so overlapping ranges and manual
+	reruns never create a request twice.
+	"""
+	today = today or nowdate()
+	cache = frappe.cache()
+	lock = cache.lock(cache.make_key(f"{GENERATION_LOCK_KEY}:{first}"), timeout=GENERATION_LOCK_TIMEOUT)
+	if not lock.acquire(blocking=False):
+		# Another worker is already processing this range
+		return
+
+	try:
+		schedules = get_due_schedules(today, first, last)
+		occurrences = expand_occurrences(schedules, today)
+		schedules = [s for s in schedules if s.name in occurrences]
+		items_by_schedule = get_schedule_items([s.name for s in schedules])
+
+		with notification_digest():
+			_generate_for_schedules(schedules, items_by_schedule, occurrences, today, first, chunk_size)
 
-	for schedule_data in maintenance_schedules:
+		frappe.db.set_global(f"{GENERATION_CHECKPOINT_KEY}:{first}", None)
+		frappe.db.commit()
+		# next_due_date moved without doc events
+		clear_forecast_cache()
+	finally:
 		try:
-			schedule = frappe.get_doc("MaintenanceSchedule", schedule_data.name)
-			if schedule.end_date and getdate(schedule.end_date) < getdate(today):
-				# Schedule has ended, skip it
-				continue
-
-			for item in schedule.items:
-				service_request = frappe.new_doc("ServiceRequest")
-				service_request.customer = schedule.customer
-				service_request.service_project = schedule.service_project
-				service_request.service_object = item.service_object
-				service_request.subject = (
-					f"Scheduled Maintenance for {item.service_object} ({schedule.schedule_name})"
-				)
-				service_request.description = (
-					item.description or f"Routine maintenance as per schedule {schedule.schedule_name}"
-				)
-				service_request.status = "Open"
-				service_request.save()
-				frappe.log_by_activity(
-					doctype="ServiceRequest",
-					name=service_request.name,
-					text=f"Created from Maintenance Schedule {schedule.name}",
-					status="Success",
+			lock.release()
+		except LockError:
+			# The lock expired while the range was processed; idempotency keys keep that safe
+			pass
+
+
+def get_due_schedules(today, first, last):
+	checkpoint = get_generation_checkpoint(first)
+	if checkpoint and checkpoint.get("run_date") == today:
+		# Resume an interrupted run after the last schedule it committed
+		name_filter = [">", checkpoint["schedule"]]
+	else:
+		name_filter = [">=", first]
+
+	schedules = frappe.get_all(
+		"MaintenanceSchedule",
+		filters=[
+			["next_due_date", "<=", today],
+			["docstatus", "=", 0],
+			["name", *name_filter],
+			["name", "<=", last],
+		],
+		fields=[
+			"name",
+			"schedule_name",
+			"customer",
+			"service_project",
+			"frequency",
+			"catch_up_policy",
+			"start_date",
+			"end_date",
+			"next_due_date",
+		],
+		order_by="name asc",
+	)
+	# Schedules that have ended are skipped
+	return [s for s in schedules if not s.end_date or getdate(s.end_date) >= getdate(today)]
+
+
+def get_schedule_items(schedule_names):
+	items_by_schedule = {name: [] for name in schedule_names}
+	if not schedule_names:
+		return items_by_schedule
+
+	for item in frappe.get_all(
+		"MaintenanceScheduleItem",
+		filters={"parenttype": "MaintenanceSchedule", "parent": ["in", schedule_names]},
+		fields=["name", "parent", "service_object", "description"],
+		order_by="parent asc, idx asc",
+	):
+		items_by_schedule[item.parent].append(item)
+	return items_by_schedule
+
+
+def get_generation_checkpoint(first):
+	checkpoint = frappe.db.get_global(f"{GENERATION_CHECKPOINT_KEY}:{first}")
+	return json.loads(checkpoint) if checkpoint else None
+
+
+def get_occurrence(anchor, frequency, index, anchor_day=None):
+	"""The `index`-th due date of a schedule whose first due date is `anchor`.
+
+	Months are counted from the anchor rather than from the previous occurrence, and fall on
+	`anchor_day` (the schedule's day of the month, see `get_anchor_day`) clamped to the month's
+	length. A schedule due on the 31st is due on the last day of shorter months and returns to the
+	31st afterwards, even once `next_due_date` has been advanced to a clamped date.
+	"""
+	days, months = FREQUENCY_PERIODS[frequency]
+	if days:
+		return anchor + timedelta(days=days * index)
+
+	month_index = anchor.year * 12 + anchor.month - 1 + months * index
+	year, month = divmod(month_index, 12)
+	month += 1
+	day = min(anchor_day or anchor.day, calendar.monthrange(year, month)[1])
+	return anchor.replace(year=year, month=month, day=day)
+
+
+def get_anchor_day(schedule):
+	"""Day of the month a schedule is due on: the day of its start date, unless `next_due_date` has
+	been moved off it, e.g. by hand."""
+	anchor = getdate(schedule.next_due_date)
+	if schedule.get("start_date"):
+		day = getdate(schedule.start_date).day
+		if anchor.day == min(day, calendar.monthrange(anchor.year, anchor.month)[1]):
+			return day
+	return anchor.day
+
+
+def count_due_occurrences(anchor, frequency, until, anchor_day=None):
+	"""Number of occurrences from `anchor` up to and including `until`, without iterating."""
+	if until < anchor:
+		return 0
+
+	days, months = FREQUENCY_PERIODS[frequency]
+	if days:
+		return (until - anchor).days // days + 1
+
+	elapsed = (until.year - anchor.year) * 12 + until.month - anchor.month
+	periods = elapsed // months
+	if get_occurrence(anchor, frequency, periods, anchor_day) > until:
+		periods -= 1
+	return periods + 1
+
+
+def expand_occurrences(schedules, today):
+	"""Computes the due dates of every schedule up to `today` in one step.
+
+	Returns `{schedule name: (due dates to generate, new next_due_date)}`. Backfill schedules get
+	one entry per missed occurrence (up to MAX_BACKFILL_OCCURRENCES); Collapse schedules get only
+	the latest one. Schedules with an unknown frequency are left out.
+	"""
+	today = getdate(today)
+	occurrences = {}
+	for schedule in schedules:
+		if schedule.frequency not in FREQUENCY_PERIODS:
+			continue
+
+		anchor, anchor_day = getdate(schedule.next_due_date), get_anchor_day(schedule)
+		until = min(today, getdate(schedule.end_date)) if schedule.end_date else today
+		due = count_due_occurrences(anchor, schedule.frequency, until, anchor_day)
+		if not due:
+			continue
+
+		if schedule.catch_up_policy == "Collapse":
+			dates = [get_occurrence(anchor, schedule.frequency, due - 1, anchor_day)]
+			generated = due
+		else:
+			generated = min(due, MAX_BACKFILL_OCCURRENCES)
+			dates = [get_occurrence(anchor, schedule.frequency, i, anchor_day) for i in range(generated)]
+		next_due_date = get_occurrence(anchor, schedule.frequency, generated, anchor_day)
+		occurrences[schedule.name] = (dates, next_due_date)
+	return occurrences
+
+
+def get_idempotency_key(schedule, item, due_date):
+	return f"maintenance:{schedule}:{item}:{due_date}"
+
+
+def build_service_requests(schedule, items, due_dates):
+	"""ServiceRequests for `items` on each of `due_dates`."""
+	first_due_date = getdate(schedule.next_due_date)
+	service_requests = []
+	for due_date in due_dates:
+		for item in items:
+			description = item.description or f"Routine maintenance as per schedule {schedule.schedule_name}"
+			if schedule.catch_up_policy == "Collapse" and due_date != first_due_date:
+				description += f"\n\nCovers all occurrences missed from {first_due_date} to {due_date}."
+			service_requests.append(
+				frappe.get_doc(
+					{
+						"doctype": "ServiceRequest",
+						"title": f"Scheduled Maintenance for {item.service_object} ({schedule.schedule_name}, {due_date})",
+						"description": description,
+						"type": "Routine Maintenance",
+						"status": "Open",
+						"customer": schedule.customer,
+						"project": schedule.service_project,
+						"service_object": item.service_object,
+						"idempotency_key": get_idempotency_key(schedule.name, item.name, due_date),
+					}
 				)
+			)
+	return service_requests
+
+
+@frappe.whitelist()
+def get_maintenance_forecast(weeks=26, group_by="customer"):
+	"""Scheduled visits per week for the coming `weeks`, grouped by customer, project or object.
+
+	A visit is one service object of a schedule on one occurrence. Returns
+	`{"weeks": [week start dates], "rows": [{group_by, "visits": [per week], "total"}], "totals": [per week]}`,
+	busiest groups first. Results are cached until a MaintenanceSchedule changes.
+	"""
+	weeks = min(max(cint(weeks), 1), FORECAST_MAX_WEEKS)
+	if group_by not in FORECAST_GROUPS:
+		frappe.throw(_("Forecasts can be grouped by {0}.").format(", ".join(FORECAST_GROUPS)))
+	frappe.has_permission("MaintenanceSchedule", "read", throw=True)
+
+	start = get_first_day_of_week(nowdate(), as_str=False)
+	cache_field = f"{start}:{weeks}:{group_by}"
+	forecast = frappe.cache().hget(FORECAST_CACHE_KEY, cache_field)
+	if forecast is None:
+		forecast = build_maintenance_forecast(start, weeks, group_by)
+		frappe.cache().hset(FORECAST_CACHE_KEY, cache_field, forecast)
+	return forecast
+
+
+def build_maintenance_forecast(start, weeks, group_by):
+	end = add_days(start, weeks * 7 - 1)
+	schedules = [
+		s
+		for s in frappe.get_all(
+			"MaintenanceSchedule",
+			filters={"docstatus": 0, "next_due_date": ["<=", end]},
+			fields=[
+				"name",
+				"customer",
+				"service_project",
+				"frequency",
+				"start_date",
+				"end_date",
+				"next_due_date",
+			],
+		)
+		if s.frequency in FREQUENCY_PERIODS and (not s.end_date or getdate(s.end_date) >= start)
+	]
+	items_by_schedule = get_schedule_items([s.name for s in schedules])
+
+	visits = {}
+	for schedule in schedules:
+		items = items_by_schedule[schedule.name]
+		if not items:
+			continue
+		occurrences = count_occurrences_per_week(schedule, start, weeks)
+		if group_by == "service_object":
+			groups = [(item.service_object, 1) for item in items]
+		else:
+			groups = [(schedule.get(group_by), len(items))]
+		for group, objects in groups:
+			row = visits.setdefault(group, [0] * weeks)
+			for week, count in enumerate(occurrences):
+				row[week] += count * objects
+
+	rows = sorted(
+		({group_by: group, "visits": row, "total": sum(row)} for group, row in visits.items()),
+		key=lambda row: row["total"],
+		reverse=True,
+	)
+	return {
+		"weeks": [str(add_days(start, week * 7)) for week in range(weeks)],
+		"rows": rows,
+		"totals": [sum(week) for week in zip(*visits.values(), strict=True)] if visits else [0] * weeks,
+	}
+
+
+def count_occurrences_per_week(schedule, start, weeks):
+	"""Occurrences of `schedule` in each of the `weeks` weeks beginning on `start`."""
+	counts = [0] * weeks
+	anchor = getdate(schedule.next_due_date)
+	last = add_days(start, weeks * 7 - 1)
+	if schedule.end_date:
+		last = min(last, getdate(schedule.end_date))
+	if last < anchor:
+		return counts
 
-			# Update next_due_date for the schedule
-			if schedule.frequency == "Daily":
-				schedule.next_due_date = add_days(schedule.next_due_date, 1)
-			elif schedule.frequency == "Weekly":
-				schedule.next_due_date = add_days(schedule.next_due_date, 7)
-			elif schedule.frequency == "Monthly":
-				schedule.next_due_date = add_months(schedule.next_due_date, 1)
-			elif schedule.frequency == "Annually":
-				schedule.next_due_date = add_years(schedule.next_due_date, 1)
-
-			schedule.save()
+	if schedule.frequency == "Daily":
+		# Every day between the anchor and the last date counts; no need to list them
+		for week in range(weeks):
+			week_start = add_days(start, week * 7)
+			days = (min(add_days(week_start, 6), last) - max(week_start, anchor)).days + 1
+			counts[week] = max(days, 0)
+		return counts
+
+	anchor_day = get_anchor_day(schedule)
+	index = count_due_occurrences(anchor, schedule.frequency, add_days(start, -1), anchor_day)
+	occurrence = get_occurrence(anchor, schedule.frequency, index, anchor_day)
+	while occurrence <= last:
+		counts[(occurrence - start).days // 7] += 1
+		index += 1
+		occurrence = get_occurrence(anchor, schedule.frequency, index, anchor_day)
+	return counts
+
+
+def clear_forecast_cache(doc=None, method=None):
+	frappe.cache().delete_value(FORECAST_CACHE_KEY)
+
+
+def _generate_for_schedules(schedules, items_by_schedule, occurrences, today, first, chunk_size):
+	chunk = []
+	pending = 0
+	for schedule in schedules:
+		chunk.append(schedule)
+		pending += len(items_by_schedule[schedule.name]) * len(occurrences[schedule.name][0])
+		if pending >= chunk_size:
+			_insert_chunk(chunk, items_by_schedule, occurrences, today, first)
+			chunk, pending = [], 0
+
+	if chunk:
+		_insert_chunk(chunk, items_by_schedule, occurrences, today, first)
+
+
+def _rollback_schedule(savepoint, pending_count, inserted):
+	"""Rolls one schedule back to its savepoint, with the side effects its inserts left outside the
+	database: queued notifications and SLA timer entries."""
+	frappe.db.rollback(save_point=savepoint)
+	pending = getattr(frappe.local, "ferum_pending_notifications", None)
+	if pending:
+		del pending[pending_count:]
+	names = [service_request.name for service_request in inserted if service_request.name]
+	if names:
+		# Runs after the timer entries the inserts queued for the commit
+		remove_from_sla_timer_after_commit(names)
+
+
+def _insert_chunk(schedules, items_by_schedule, occurrences, today, first):
+	service_requests = {
+		schedule.name: build_service_requests(
+			schedule, items_by_schedule[schedule.name], occurrences[schedule.name][0]
+		)
+		for schedule in schedules
+	}
+	existing = set(
+		frappe.get_all(
+			"ServiceRequest",
+			filters={
+				"idempotency_key": [
+					"in",
+					[sr.idempotency_key for requests in service_requests.values() for sr in requests],
+				]
+			},
+			pluck="idempotency_key",
+		)
+	)
+
+	advanced = []
+	for schedule in schedules:
+		savepoint = f"maintenance_{frappe.scrub(schedule.name)}"
+		pending_count = len(getattr(frappe.local, "ferum_pending_notifications", None) or [])
+		inserted = []
+		frappe.db.savepoint(savepoint)
+		try:
+			for service_request in service_requests[schedule.name]:
+				if service_request.idempotency_key not in existing:
+					inserted.append(service_request)
+					service_request.insert()
+		except frappe.UniqueValidationError:
+			# A concurrent run created these requests first and advances the schedule itself
+			_rollback_schedule(savepoint, pending_count, inserted)
+			continue
 		except Exception as e:
-			frappe.log_error(f"Failed to process Maintenance Schedule {schedule_data.name}: {e}")
+			# Only this schedule is rolled back; it stays due and is retried on the next run
+			_rollback_schedule(savepoint, pending_count, inserted)
+			frappe.log_error(f"Failed to process Maintenance Schedule {schedule.name}: {e}")
+			continue
+
+		advanced.append((schedule.name, getdate(schedule.next_due_date), occurrences[schedule.name][1]))
+
+	if advanced:
+		# Compare-and-set: a schedule another run has already advanced keeps its newer date
+		cases = " ".join(["when name = %s and next_due_date = %s then %s"] * len(advanced))
+		frappe.db.sql(
+			f"""update `tabMaintenanceSchedule`
+			set next_due_date = case {cases} else next_due_date end
+			where name in %s""",
+			(*[value for row in advanced for value in row], tuple(row[0] for row in advanced)),
+		)
+
+	frappe.db.set_global(
+		f"{GENERATION_CHECKPOINT_KEY}:{first}",
+		json.dumps({"run_date": today, "schedule": schedules[-1].name}),
+	)
+	frappe.db.commit()
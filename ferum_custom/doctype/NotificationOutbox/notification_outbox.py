@@ -0,0 +1,11 @@
+import frappe
+from frappe.model.document import Document
+
+
+class NotificationOutbox(Document):
+	pass
+
+
+def on_doctype_update():
+	# The drainer scans pending rows in creation order
+	frappe.db.add_index("NotificationOutbox", ["status", "creation"])
@@ -0,0 +1,217 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import frappe
+from frappe.model.document import Document
+from PIL import Image, ImageOps
+
+from ferum_custom.doctype.AttachmentBlob.attachment_blob import get_content_hash
+from ferum_custom.doctype.CustomAttachment.attachment_storage import (
+	get_local_file_path,
+	get_local_storage,
+	get_storage_key,
+)
+
+PHOTO_DOCTYPE = "RequestPhotoAttachmentItem"
+PHOTO_VARIANT_FOLDER = "photo-variants"
+# variant: (field, longest side in px, format, quality). PDFs get JPEG, which wkhtmltopdf can render.
+PHOTO_VARIANTS = {
+	"thumbnail": ("photo_thumbnail", 320, "WEBP", 75),
+	"preview": ("photo_preview", 1600, "WEBP", 80),
+	"print": ("photo_print", 1600, "JPEG", 82),
+}
+PHOTO_VARIANT_EXTENSIONS = {"WEBP": "webp", "JPEG": "jpg"}
+PHOTO_VARIANT_WORKERS = 4
+
+
+class RequestPhotoAttachmentItem(Document):
+	pass
+
+
+def queue_photo_variants(doc, method=None):
+	"""on_update hook of the doctypes with a photo table (ServiceRequest): queues variant rendering
+	for photo rows added or replaced in `doc`."""
+	names = [row.name for row in _get_photo_rows(doc) if row.photo and row.photo != row.variant_source]
+	if names:
+		frappe.enqueue(
+			"ferum_custom.doctype.RequestPhotoAttachmentItem.request_photo_attachment_item.generate_photo_variants",
+			queue="long",
+			enqueue_after_commit=True,
+			names=names,
+		)
+
+
+def generate_photo_variants(names):
+	"""Background job: renders thumbnail/preview/print variants for the given photo rows.
+
+	Variants are stored once per content hash (and privacy), so the same photo attached twice is
+	rendered once.
+	Decoding and resizing are CPU-bound and run in a process pool; the pool touches no database.
+	The original photo is left as is.
+	"""
+	rows = frappe.get_all(
+		PHOTO_DOCTYPE,
+		filters={"name": ["in", names]},
+		fields=["name", "parent", "parenttype", "photo", "variant_source"],
+	)
+	rows = [row for row in rows if row.photo and row.photo != row.variant_source]
+
+	# Public and private photos keep their variants under /files and /private/files respectively
+	rows_by_content = {}
+	for row in rows:
+		file_path = get_local_file_path(row.photo)
+		if not os.path.exists(file_path):
+			continue
+		row.is_private = "/private/files/" in row.photo
+		rows_by_content.setdefault((get_content_hash(file_path), row.is_private), []).append((row, file_path))
+
+	missing = {
+		(content_hash, is_private): entries
+		for (content_hash, is_private), entries in rows_by_content.items()
+		if not all(
+			os.path.exists(get_variant_path(content_hash, variant, is_private)) for variant in PHOTO_VARIANTS
+		)
+	}
+	failed = set()
+	if missing:
+		with ProcessPoolExecutor(max_workers=min(PHOTO_VARIANT_WORKERS, len(missing))) as pool:
+			futures = {
+				(content_hash, is_private): pool.submit(
+					render_photo_variants,
+					entries[0][1],
+					os.path.dirname(get_variant_path(content_hash, "thumbnail", is_private)),
+					content_hash,
+				)
+				for (content_hash, is_private), entries in missing.items()
+			}
+			for content, future in futures.items():
+				try:
+					future.result()
+				except Exception:
+					failed.add(content)
+					frappe.log_error(
+						title="Photo variant generation failed",
+						message=f"{missing[content][0][0].photo}\n{frappe.get_traceback()}",
+					)
+
+	updates = {}
+	for (content_hash, is_private), entries in rows_by_content.items():
+		if (content_hash, is_private) in failed:
+			continue
+		if (content_hash, is_private) in missing:
+			_register_variant_files(content_hash, is_private)
+		for row, _file_path in entries:
+			updates[row.name] = {
+				field: get_variant_url(content_hash, variant, is_private)
+				for variant, (field, _size, _format, _quality) in PHOTO_VARIANTS.items()
+			}
+			updates[row.name]["variant_source"] = row.photo
+
+	if updates:
+		frappe.db.bulk_update(PHOTO_DOCTYPE, updates, update_modified=False)
+		frappe.db.commit()
+
+
+def render_photo_variants(source_path, target_dir, content_hash):
+	"""Writes every variant of one photo into `target_dir`. Runs in a worker process."""
+	os.makedirs(target_dir, exist_ok=True)
+	largest = max(size for _field, size, _format, _quality in PHOTO_VARIANTS.values())
+	with Image.open(source_path) as source:
+		# Lets the JPEG decoder downscale by a power of two instead of decoding all 12 MP
+		source.draft("RGB", (largest, largest))
+		image = ImageOps.exif_transpose(source)
+		if image.mode not in ("RGB", "L"):
+			image = image.convert("RGB")
+
+		for variant, (_field, size, image_format, quality) in PHOTO_VARIANTS.items():
+			resized = image.copy()
+			resized.thumbnail((size, size), Image.Resampling.LANCZOS)
+			file_name = get_variant_file_name(content_hash, variant)
+			temp_path = os.path.join(target_dir, f".{file_name}.tmp")
+			resized.save(temp_path, format=image_format, quality=quality, optimize=True)
+			os.replace(temp_path, os.path.join(target_dir, file_name))
+
+
+def _register_variant_files(content_hash, is_private):
+	# Shared by every photo with this content, so not attached to any one document; see
+	# release_photo_variants for their cleanup
+	for variant in PHOTO_VARIANTS:
+		file_url = get_variant_url(content_hash, variant, is_private)
+		if not frappe.db.exists("File", {"file_url": file_url}):
+			frappe.get_doc(
+				{
+					"doctype": "File",
+					"file_name": get_variant_file_name(content_hash, variant),
+					"file_url": file_url,
+					"is_private": is_private,
+				}
+			).insert(ignore_permissions=True)
+
+
+def release_photo_variants(doc, method=None):
+	"""on_update/on_trash hook of the doctypes with a photo table: deletes the variant files of
+	removed or replaced photos once no current photo row uses them any more."""
+	variant_fields = [field for field, _size, _format, _quality in PHOTO_VARIANTS.values()]
+	before = doc.get_doc_before_save() if method == "on_update" else doc
+	if not before:
+		return
+
+	current = set()
+	if method == "on_update":
+		current = {
+			row.get(variant_fields[0]) for row in _get_photo_rows(doc) if row.photo == row.variant_source
+		}
+	released = {
+		tuple(row.get(field) for field in variant_fields)
+		for row in _get_photo_rows(before)
+		if row.get(variant_fields[0]) and row.get(variant_fields[0]) not in current
+	}
+	if not released:
+		return
+
+	# Rows of other documents still using the variants; rows whose photo changed since they were
+	# rendered only hold stale URLs
+	still_used = set(
+		frappe.db.sql_list(
+			f"""select distinct `{variant_fields[0]}` from `tab{PHOTO_DOCTYPE}`
+			where `{variant_fields[0]}` in %(urls)s and photo = variant_source
+				and not (parenttype = %(parenttype)s and parent = %(parent)s)""",
+			{"urls": tuple(urls[0] for urls in released), "parenttype": doc.doctype, "parent": doc.name},
+		)
+	)
+	file_urls = [url for urls in released if urls[0] not in still_used for url in urls if url]
+	if file_urls:
+		frappe.db.delete("File", {"file_url": ["in", file_urls]})
+		storage = get_local_storage()
+		for file_url in file_urls:
+			frappe.db.after_commit.add(partial(storage.delete, get_storage_key(file_url)))
+
+
+def _get_photo_rows(doc):
+	return [
+		row
+		for table_field in doc.meta.get_table_fields()
+		if table_field.options == PHOTO_DOCTYPE
+		for row in doc.get(table_field.fieldname) or []
+	]
+
+
+def get_variant_file_name(content_hash, variant):
+	image_format = PHOTO_VARIANTS[variant][2]
+	return f"{content_hash}-{variant}.{PHOTO_VARIANT_EXTENSIONS[image_format]}"
+
+
+def get_variant_url(content_hash, variant, is_private=False):
+	root = "/private/files" if is_private else "/files"
+	return f"{root}/{PHOTO_VARIANT_FOLDER}/{get_variant_file_name(content_hash, variant)}"
+
+
+def get_variant_path(content_hash, variant, is_private=False):
+	return get_local_file_path(get_variant_url(content_hash, variant, is_private))
+
+
+def get_photo_url(row, variant="preview"):
+	"""URL of a photo row's variant for forms and print formats, or the original until it is rendered."""
+	field = PHOTO_VARIANTS[variant][0]
+	return row.get(field) or row.get("photo")
@@ -0,0 +1,196 @@
+import datetime
+from bisect import bisect_left, bisect_right
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+from frappe.utils import add_to_date, get_datetime, get_time, getdate
+
+WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+CALENDAR_CACHE_KEY = "ferum_sla_calendar"
+CALENDAR_ASSIGNMENTS_CACHE_KEY = "ferum_sla_calendar_assignments"
+# A compiled calendar covers this many days around its anchor date
+COMPILE_DAYS_BEFORE = 400
+COMPILE_DAYS_AFTER = 800
+# Compiled calendars are cached per window of this many days, anchored at the window's first day,
+# so every moment in a window still has COMPILE_DAYS_AFTER - WINDOW_DAYS days of calendar ahead
+CALENDAR_WINDOW_DAYS = 365
+# Windows nobody asks for any more drop out of the cache on their own
+CALENDAR_CACHE_TTL = 7 * 24 * 60 * 60
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class SLACalendar(Document):
+	def validate(self):
+		for row in self.working_hours:
+			if get_time(row.end_time) <= get_time(row.start_time):
+				frappe.throw(_("Row {0}: End Time must be after Start Time.").format(row.idx))
+
+	def on_update(self):
+		clear_calendar_cache(self.name)
+		customers, projects = {self.customer}, {self.service_project}
+		before = self.get_doc_before_save()
+		if before:
+			customers.add(before.customer)
+			projects.add(before.service_project)
+		enqueue_sla_recompute(customers, projects)
+
+	def on_trash(self):
+		clear_calendar_cache(self.name)
+		enqueue_sla_recompute({self.customer}, {self.service_project})
+
+
+class CompiledCalendar:
+	"""Working time as sorted, non-overlapping `[start, end)` intervals in epoch seconds.
+
+	`cumulative[i]` is the working time before interval i, so finding the moment N working seconds
+	after any instant is two binary searches instead of a walk over the calendar.
+	"""
+
+	def __init__(self, starts, ends):
+		self.starts = starts
+		self.ends = ends
+		self.cumulative = []
+		self.cumulative_end = []
+		total = 0
+		for start, end in zip(starts, ends, strict=True):
+			self.cumulative.append(total)
+			total += end - start
+			self.cumulative_end.append(total)
+
+	def as_dict(self):
+		return {"starts": self.starts, "ends": self.ends}
+
+	def add_working_seconds(self, moment, seconds):
+		"""Returns the datetime `seconds` of working time after `moment`, or None past the compiled range."""
+		if seconds <= 0:
+			return get_datetime(moment)
+		t = (get_datetime(moment) - EPOCH).total_seconds()
+		if not self.starts or t < self.starts[0]:
+			return None
+
+		i = bisect_right(self.starts, t) - 1
+		if t < self.ends[i]:
+			offset = self.cumulative[i] + (t - self.starts[i])
+		else:
+			# Outside working hours: the clock starts with the next interval
+			offset = self.cumulative_end[i]
+
+		# First interval whose end is at or past the target; ending exactly at closing time stays there
+		target = offset + seconds
+		j = bisect_left(self.cumulative_end, target)
+		if j == len(self.starts):
+			return None
+		return EPOCH + datetime.timedelta(seconds=self.starts[j] + (target - self.cumulative[j]))
+
+
+def compile_calendar(calendar, anchor=None):
+	"""Expands weekly working hours minus holidays into intervals around `anchor` (default: today)."""
+	working_hours = frappe.get_all(
+		"SLACalendarWorkingHour",
+		filters={"parenttype": "SLACalendar", "parent": calendar},
+		fields=["weekday", "start_time", "end_time"],
+	)
+	holidays = {
+		getdate(d)
+		for d in frappe.get_all(
+			"SLACalendarHoliday",
+			filters={"parenttype": "SLACalendar", "parent": calendar},
+			pluck="holiday_date",
+		)
+	}
+
+	spans_by_weekday = {i: [] for i in range(7)}
+	for row in working_hours:
+		spans_by_weekday[WEEKDAYS.index(row.weekday)].append(
+			(get_time(row.start_time), get_time(row.end_time))
+		)
+
+	starts, ends = [], []
+	first_day = getdate(anchor) - datetime.timedelta(days=COMPILE_DAYS_BEFORE)
+	for offset in range(COMPILE_DAYS_BEFORE + COMPILE_DAYS_AFTER):
+		day = first_day + datetime.timedelta(days=offset)
+		if day in holidays:
+			continue
+		for start_time, end_time in sorted(spans_by_weekday[day.weekday()]):
+			start = (datetime.datetime.combine(day, start_time) - EPOCH).total_seconds()
+			end = (datetime.datetime.combine(day, end_time) - EPOCH).total_seconds()
+			if ends and start <= ends[-1]:
+				# Overlapping or touching spans are merged
+				ends[-1] = max(ends[-1], end)
+			else:
+				starts.append(start)
+				ends.append(end)
+
+	return CompiledCalendar(starts, ends)
+
+
+def get_compiled_calendar(calendar, moment=None):
+	"""The compiled calendar covering `moment` (default: now), cached per CALENDAR_WINDOW_DAYS window."""
+	window = (getdate(moment) - EPOCH.date()).days // CALENDAR_WINDOW_DAYS
+	key = f"{CALENDAR_CACHE_KEY}:{calendar}:{window}"
+	compiled = frappe.cache().get_value(key)
+	if compiled is None:
+		anchor = EPOCH.date() + datetime.timedelta(days=window * CALENDAR_WINDOW_DAYS)
+		compiled = compile_calendar(calendar, anchor=anchor).as_dict()
+		frappe.cache().set_value(key, compiled, expires_in_sec=CALENDAR_CACHE_TTL)
+	return CompiledCalendar(compiled["starts"], compiled["ends"])
+
+
+def add_business_hours(calendar, start, hours):
+	"""Adds `hours` of working time of `calendar` to `start`."""
+	seconds = hours * 3600
+	deadline = get_compiled_calendar(calendar, start).add_working_seconds(start, seconds)
+	if deadline is None:
+		# Very long SLAs run past the window: compile around the start
+		deadline = compile_calendar(calendar, anchor=start).add_working_seconds(start, seconds)
+	if deadline is None:
+		# A calendar without working hours cannot move the clock; fall back to wall-clock time
+		deadline = add_to_date(start, hours=hours)
+	return deadline
+
+
+def get_calendar_for_request(customer=None, project=None, emergency=False):
+	"""Returns the SLA calendar that applies to a request: project first, then customer."""
+	assignments = frappe.cache().get_value(CALENDAR_ASSIGNMENTS_CACHE_KEY)
+	if assignments is None:
+		assignments = {"project": {}, "customer": {}, "emergency": []}
+		for row in frappe.get_all(
+			"SLACalendar", fields=["name", "customer", "service_project", "apply_to_emergencies"]
+		):
+			if row.service_project:
+				assignments["project"][row.service_project] = row.name
+			elif row.customer:
+				assignments["customer"][row.customer] = row.name
+			if row.apply_to_emergencies:
+				assignments["emergency"].append(row.name)
+		frappe.cache().set_value(CALENDAR_ASSIGNMENTS_CACHE_KEY, assignments)
+
+	calendar = assignments["project"].get(project) or assignments["customer"].get(customer)
+	if calendar and emergency and calendar not in assignments["emergency"]:
+		return None
+	return calendar
+
+
+def get_sla_deadline(start, hours, calendar=None):
+	if calendar:
+		return add_business_hours(calendar, start, hours)
+	return add_to_date(start, hours=hours)
+
+
+def clear_calendar_cache(calendar):
+	frappe.cache().delete_keys(f"{CALENDAR_CACHE_KEY}:{calendar}:")
+	frappe.cache().delete_value(CALENDAR_ASSIGNMENTS_CACHE_KEY)
+
+
+def enqueue_sla_recompute(customers, projects):
+	customers = sorted(c for c in customers if c)
+	projects = sorted(p for p in projects if p)
+	if customers or projects:
+		frappe.enqueue(
+			"ferum_custom.doctype.ServiceRequest.service_request.recompute_sla_deadlines",
+			queue="long",
+			enqueue_after_commit=True,
+			customers=customers,
+			projects=projects,
+		)
@@ -1,38 +1,233 @@
+import json
+
 import frappe
 from frappe.model.document import Document
+from frappe.utils import cint
+
+# Redis hash of ServiceObject name -> {"customer", "project"}, copied onto ServiceRequests
+SERVICE_OBJECT_CACHE_KEY = "ferum_service_object_attributes"
+# Maintained in SQL by the documents using the object, never through the form
+USAGE_COUNTERS = ("active_project_count", "open_request_count")
 
 
 class ServiceObject(Document):
 	def validate(self):
-		# Check for uniqueness of object_name (though already handled by unique:1 in JSON)
-		# This provides a more user-friendly error message
-		if self.is_new() or self.has_changed("object_name"):
-			if (
-				frappe.db.exists("ServiceObject", {"object_name": self.object_name})
-				and frappe.db.get_value("ServiceObject", {"object_name": self.object_name}, "name")
-				!= self.name
-			):
+		# object_name is unique in the schema too; this gives a friendlier message
+		if self.is_new() or self.has_value_changed("object_name"):
+			filters = {"object_name": self.object_name}
+			if not self.is_new():
+				filters["name"] = ["!=", self.name]
+			if frappe.db.get_value("ServiceObject", filters, "name"):
 				frappe.throw(f"Service Object with name '{self.object_name}' already exists.")
 
+	def before_save(self):
+		# The counters are updated in SQL without touching `modified`, so a form loaded before such
+		# an update would otherwise write its stale values back
+		if not self.is_new():
+			self.update(
+				frappe.db.get_value(
+					"ServiceObject", self.name, list(USAGE_COUNTERS), as_dict=True, for_update=True
+				)
+				or {}
+			)
+
+	def on_update(self):
+		forget_service_objects_after_commit([self.name])
+
+	def after_rename(self, old_name, new_name, merge=False):
+		forget_service_objects_after_commit([old_name, new_name])
+
 	def on_trash(self):
 		# Prevent deletion if the ServiceObject is linked to an active ServiceProject
-		# or any active ServiceRequest
-		active_projects = frappe.get_all(
-			"ServiceProject",
-			filters={"objects.service_object": self.name, "status": ["in", ["Planned", "Active"]]},
-			pluck="name",
+		# or any active ServiceRequest. The usage counters are kept up to date by those documents,
+		# so the names are only looked up for the error message.
+		usage = frappe.db.get_value(
+			"ServiceObject",
+			self.name,
+			list(USAGE_COUNTERS),
+			as_dict=True,
+			for_update=True,
 		)
-		if active_projects:
+		if usage.active_project_count:
+			active_projects = frappe.get_all(
+				"ServiceProject",
+				filters={"objects.service_object": self.name, "status": ["in", ["Planned", "Active"]]},
+				pluck="name",
+			)
 			frappe.throw(
 				f"Cannot delete Service Object. It is linked to active Service Projects: {', '.join(active_projects)}"
 			)
 
-		active_requests = frappe.get_all(
-			"ServiceRequest",
-			filters={"service_object": self.name, "status": ["in", ["Open", "In Progress"]]},
-			pluck="name",
-		)
-		if active_requests:
+		if usage.open_request_count:
+			active_requests = frappe.get_all(
+				"ServiceRequest",
+				filters={"service_object": self.name, "status": ["in", ["Open", "In Progress"]]},
+				pluck="name",
+			)
 			frappe.throw(
 				f"Cannot delete Service Object. It is linked to active Service Requests: {', '.join(active_requests)}"
 			)
+
+		forget_service_objects_after_commit([self.name])
+
+
+def get_service_object_attributes(names):
+	"""Returns `{name: {"customer", "project"}}` for many ServiceObjects.
+
+	Served from the site cache; all misses together cost one query. Unknown names are left out.
+	"""
+	names = list(dict.fromkeys(n for n in names if n))
+	if not names:
+		return {}
+
+	cache = frappe.cache()
+	key = cache.make_key(SERVICE_OBJECT_CACHE_KEY)
+	attributes = {}
+	missing = []
+	for name, value in zip(names, cache.hmget(key, names), strict=True):
+		if value is None:
+			missing.append(name)
+		else:
+			attributes[name] = json.loads(value)
+
+	if missing:
+		loaded = {
+			row.name: {"customer": row.customer, "project": row.project}
+			for row in frappe.get_all(
+				"ServiceObject", filters={"name": ["in", missing]}, fields=["name", "customer", "project"]
+			)
+		}
+		if loaded:
+			cache_service_object_attributes(loaded)
+		attributes.update(loaded)
+
+	return attributes
+
+
+def cache_service_object_attributes(attributes):
+	cache = frappe.cache()
+	cache.hset(
+		cache.make_key(SERVICE_OBJECT_CACHE_KEY),
+		mapping={name: json.dumps(values) for name, values in attributes.items()},
+	)
+
+
+def forget_service_objects(names):
+	cache = frappe.cache()
+	cache.hdel(cache.make_key(SERVICE_OBJECT_CACHE_KEY), *names)
+
+
+def forget_service_objects_after_commit(names):
+	# Dropping the entries only once the change is committed keeps concurrent readers from
+	# re-caching the old values in between
+	frappe.db.after_commit.add(lambda: forget_service_objects(names))
+
+
+def update_service_object_usage(field, old_objects, new_objects):
+	"""Moves the usage counter `field` of ServiceObjects from `old_objects` to `new_objects`.
+
+	Called by the documents that use ServiceObjects whenever the objects they hold "in use" change;
+	each distinct delta costs one UPDATE.
+	"""
+	deltas = {}
+	for name in old_objects:
+		if name:
+			deltas[name] = deltas.get(name, 0) - 1
+	for name in new_objects:
+		if name:
+			deltas[name] = deltas.get(name, 0) + 1
+
+	names_by_delta = {}
+	for name, delta in deltas.items():
+		if delta:
+			names_by_delta.setdefault(delta, []).append(name)
+
+	for delta, names in names_by_delta.items():
+		frappe.db.sql(
+			f"update `tabServiceObject` set `{field}` = greatest(`{field}` + %s, 0) where name in %s",
+			(delta, tuple(names)),
+		)
+
+
+def rebuild_service_object_usage(names=None):
+	"""Recounts the usage counters of `names`, or of every ServiceObject, from scratch.
+
+	Run after migrations and on demand; the daily `check_service_object_usage` only recounts the
+	objects that have drifted.
+	"""
+	from ferum_custom.doctype.ServiceProject.service_project import ACTIVE_PROJECT_STATUSES
+	from ferum_custom.doctype.ServiceRequest.service_request import SLA_OPEN_STATUSES
+
+	if names is not None and not names:
+		return
+
+	condition = "where so.name in %(names)s" if names is not None else ""
+	frappe.db.sql(
+		f"""update `tabServiceObject` so
+		set active_project_count = (
+			select count(distinct item.parent)
+			from `tabProjectObjectItem` item
+			join `tabServiceProject` project on project.name = item.parent
+			where item.parenttype = 'ServiceProject'
+				and item.service_object = so.name
+				and project.status in %(project_statuses)s
+		),
+		open_request_count = (
+			select count(*)
+			from `tabServiceRequest` request
+			where request.service_object = so.name and request.status in %(request_statuses)s
+		)
+		{condition}""",
+		{
+			"project_statuses": ACTIVE_PROJECT_STATUSES,
+			"request_statuses": SLA_OPEN_STATUSES,
+			"names": tuple(names or ()),
+		},
+	)
+
+
+def check_service_object_usage():
+	"""Daily drift check: compares the usage counters with grouped counts of the objects in use and
+	recounts only the objects that differ. Returns the names that had drifted."""
+	from ferum_custom.doctype.ServiceProject.service_project import ACTIVE_PROJECT_STATUSES
+	from ferum_custom.doctype.ServiceRequest.service_request import SLA_OPEN_STATUSES
+
+	expected = {}
+	for name, count in frappe.db.sql(
+		"""select item.service_object, count(distinct item.parent)
+		from `tabProjectObjectItem` item
+		join `tabServiceProject` project on project.name = item.parent
+		where item.parenttype = 'ServiceProject' and project.status in %s
+		group by item.service_object""",
+		(ACTIVE_PROJECT_STATUSES,),
+	):
+		expected.setdefault(name, {})["active_project_count"] = count
+	for name, count in frappe.db.sql(
+		"""select service_object, count(*) from `tabServiceRequest`
+		where status in %s and ifnull(service_object, '') != ''
+		group by service_object""",
+		(SLA_OPEN_STATUSES,),
+	):
+		expected.setdefault(name, {})["open_request_count"] = count
+
+	stored = {
+		row.name: row
+		for row in frappe.get_all(
+			"ServiceObject",
+			or_filters={field: [">", 0] for field in USAGE_COUNTERS},
+			fields=["name", *USAGE_COUNTERS],
+		)
+	}
+	drifted = [
+		name
+		for name in stored.keys() | expected.keys()
+		if any(
+			cint((stored.get(name) or {}).get(field)) != cint(expected.get(name, {}).get(field))
+			for field in USAGE_COUNTERS
+		)
+	]
+	if drifted:
+		# Objects that were deleted since are not matched by the UPDATE
+		rebuild_service_object_usage(drifted)
+		frappe.log_error(title="ServiceObject usage counters drifted", message="\n".join(sorted(drifted)))
+	return drifted
@@ -0,0 +1,255 @@
+import csv
+import os
+
+import frappe
+from frappe import _
+from frappe.utils import now
+
+from ferum_custom.doctype.ServiceObject.service_object import update_service_object_usage
+from ferum_custom.doctype.ServiceProject.service_project import ACTIVE_PROJECT_STATUSES
+
+IMPORT_BATCH_SIZE = 500
+IMPORT_COLUMNS = ("object_name", "address", "customer", "type", "project")
+ERROR_REPORT_COLUMNS = ("row", *IMPORT_COLUMNS, "error")
+AUDIT_FIELDS = ("creation", "modified", "owner", "modified_by")
+
+
+@frappe.whitelist(methods=["POST"])
+def import_service_objects(file_url, project=None):
+	"""Queues the import of ServiceObjects from an uploaded CSV or XLSX file.
+
+	The file needs an `object_name` column and may have `address`, `customer`, `type` and `project`
+	columns (headers like "Object Name" work too). `project` links every imported object to that
+	ServiceProject unless the row names its own. The outcome is published to the user as a
+	`service_object_import` realtime event.
+	"""
+	frappe.has_permission("ServiceObject", "create", throw=True)
+	if os.path.splitext(file_url)[1].lower() not in (".csv", ".xlsx"):
+		frappe.throw(_("Only CSV and XLSX files can be imported."))
+	file_name = frappe.db.get_value("File", {"file_url": file_url})
+	if not file_name:
+		frappe.throw(_("File {0} not found.").format(file_url), frappe.DoesNotExistError)
+	# The job reads the file as Administrator; the caller has to be allowed to read it themselves
+	frappe.has_permission("File", "read", file_name, throw=True)
+
+	return frappe.enqueue(
+		"ferum_custom.doctype.ServiceObject.service_object_import.run_service_object_import",
+		queue="long",
+		timeout=60 * 60,
+		file_url=file_url,
+		project=project,
+		user=frappe.session.user,
+	).id
+
+
+def run_service_object_import(file_url, project=None, user=None, batch_size=IMPORT_BATCH_SIZE):
+	"""Background job: streams the file and inserts its ServiceObjects in committed batches.
+
+	Rows are validated against names, customers and projects preloaded in one query each, so the
+	per-row `ServiceObject.validate` queries are skipped. Objects and their ProjectObjectItem links
+	are bulk-inserted per batch; a batch the database rejects is retried row by row. Rejected rows
+	are written to a CSV error report as they are met.
+	Returns `{"imported", "failed", "error_report"}`.
+	"""
+	path = frappe.get_doc("File", {"file_url": file_url}).get_full_path()
+	importer = ServiceObjectImporter(project, batch_size)
+
+	report_name = f"service-object-import-errors-{frappe.generate_hash(length=10)}.csv"
+	report_path = frappe.get_site_path("private", "files", report_name)
+	with open(report_path, "w", newline="", encoding="utf-8") as report:
+		importer.error_writer = csv.DictWriter(report, fieldnames=ERROR_REPORT_COLUMNS, extrasaction="ignore")
+		importer.error_writer.writeheader()
+		for row_number, row in iter_import_rows(path):
+			importer.add(row_number, row)
+		importer.flush()
+
+	result = {"imported": importer.imported, "failed": importer.failed, "error_report": None}
+	if importer.failed:
+		result["error_report"] = (
+			frappe.get_doc(
+				{
+					"doctype": "File",
+					"file_name": report_name,
+					"file_url": f"/private/files/{report_name}",
+					"is_private": 1,
+				}
+			)
+			.insert(ignore_permissions=True)
+			.file_url
+		)
+	else:
+		os.remove(report_path)
+	frappe.db.commit()
+
+	if user:
+		frappe.publish_realtime("service_object_import", result, user=user, after_commit=True)
+	return result
+
+
+def iter_import_rows(path):
+	"""Yields `(row number, {column: value})` from a CSV or XLSX file without loading it whole."""
+	if path.lower().endswith(".xlsx"):
+		from openpyxl import load_workbook
+
+		workbook = load_workbook(path, read_only=True, data_only=True)
+		try:
+			rows = workbook.active.iter_rows(values_only=True)
+			header = [frappe.scrub(str(cell or "")) for cell in next(rows, ())]
+			for row_number, values in enumerate(rows, start=2):
+				if any(value is not None for value in values):
+					yield row_number, _clean_row(dict(zip(header, values, strict=False)))
+		finally:
+			workbook.close()
+		return
+
+	with open(path, newline="", encoding="utf-8-sig") as f:
+		reader = csv.reader(f)
+		header = [frappe.scrub(column) for column in next(reader, [])]
+		for row_number, values in enumerate(reader, start=2):
+			if any(values):
+				yield row_number, _clean_row(dict(zip(header, values, strict=False)))
+
+
+def _clean_row(row):
+	return {
+		column: str(row[column]).strip() if row.get(column) is not None else "" for column in IMPORT_COLUMNS
+	}
+
+
+class ServiceObjectImporter:
+	"""Validates rows against preloaded lookups and bulk-inserts them in batches."""
+
+	def __init__(self, project=None, batch_size=IMPORT_BATCH_SIZE):
+		self.project = project
+		self.batch_size = batch_size
+		self.error_writer = None
+		self.imported = 0
+		self.failed = 0
+		self.batch = []
+
+		# One query each; object names also collect the rows accepted so far
+		self.object_names = set(frappe.get_all("ServiceObject", pluck="object_name"))
+		self.customers = set(frappe.get_all("Customer", pluck="name"))
+		self.projects = {
+			p.name: p.status for p in frappe.get_all("ServiceProject", fields=["name", "status"])
+		}
+		self.next_idx = {
+			row.parent: row.idx
+			for row in frappe.get_all(
+				"ProjectObjectItem",
+				filters={"parenttype": "ServiceProject"},
+				fields=["parent", "max(idx) as idx"],
+				group_by="parent",
+			)
+		}
+
+	def add(self, row_number, row):
+		row["project"] = row["project"] or self.project or ""
+		error = self.get_row_error(row)
+		if error:
+			self.reject(row_number, row, error)
+			return
+
+		self.object_names.add(row["object_name"])
+		self.batch.append((row_number, row))
+		if len(self.batch) >= self.batch_size:
+			self.flush()
+
+	def reject(self, row_number, row, error):
+		self.failed += 1
+		self.error_writer.writerow({"row": row_number, **row, "error": error})
+
+	def get_row_error(self, row):
+		if not row["object_name"]:
+			return _("Object Name is required.")
+		if row["object_name"] in self.object_names:
+			return _("Service Object {0} already exists.").format(row["object_name"])
+		if not row["customer"]:
+			return _("Customer is required.")
+		if row["customer"] not in self.customers:
+			return _("Customer {0} not found.").format(row["customer"])
+		if row["project"] and row["project"] not in self.projects:
+			return _("Service Project {0} not found.").format(row["project"])
+		return None
+
+	def flush(self):
+		if not self.batch:
+			return
+
+		batch, self.batch = self.batch, []
+		next_idx = dict(self.next_idx)
+		try:
+			self.insert_rows([row for _row_number, row in batch])
+		except Exception:
+			frappe.db.rollback()
+			self.next_idx = next_idx
+			self.insert_row_by_row(batch)
+		frappe.db.commit()
+
+	def insert_row_by_row(self, batch):
+		"""Isolates the rows the database rejects, e.g. on a constraint the lookups do not cover."""
+		for row_number, row in batch:
+			next_idx = dict(self.next_idx)
+			frappe.db.savepoint("service_object_import_row")
+			try:
+				self.insert_rows([row])
+			except Exception as e:
+				frappe.db.rollback(save_point="service_object_import_row")
+				self.next_idx = next_idx
+				self.object_names.discard(row["object_name"])
+				self.reject(row_number, row, str(e))
+
+	def insert_rows(self, rows):
+		timestamp = now()
+		user = frappe.session.user
+		frappe.db.bulk_insert(
+			"ServiceObject",
+			["name", "object_name", "address", "customer", "type", "project", *AUDIT_FIELDS],
+			[
+				(
+					row["object_name"],
+					row["object_name"],
+					row["address"],
+					row["customer"],
+					row["type"],
+					row["project"] or None,
+					timestamp,
+					timestamp,
+					user,
+					user,
+				)
+				for row in rows
+			],
+		)
+
+		links = []
+		for row in rows:
+			if row["project"]:
+				idx = self.next_idx.get(row["project"], 0) + 1
+				self.next_idx[row["project"]] = idx
+				links.append(
+					(
+						frappe.generate_hash(length=10),
+						row["project"],
+						"ServiceProject",
+						"objects",
+						idx,
+						row["object_name"],
+						timestamp,
+						timestamp,
+						user,
+						user,
+					)
+				)
+		if links:
+			frappe.db.bulk_insert(
+				"ProjectObjectItem",
+				["name", "parent", "parenttype", "parentfield", "idx", "service_object", *AUDIT_FIELDS],
+				links,
+			)
+			update_service_object_usage(
+				"active_project_count",
+				[],
+				[link[5] for link in links if self.projects[link[1]] in ACTIVE_PROJECT_STATUSES],
+			)
+		self.imported += len(rows)
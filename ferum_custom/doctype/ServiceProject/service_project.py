@@ -2,12 +2,22 @@ import frappe
 from frappe import _
 from frappe.model.document import Document
 
+from ferum_custom.doctype.ServiceObject.service_object import update_service_object_usage
+
+ACTIVE_PROJECT_STATUSES = ("Planned", "Active")
+
 
 class ServiceProject(Document):
 	def validate(self):
 		self.check_dates_and_amount()
 		self.validate_unique_objects()
 
+	def on_update(self):
+		self.update_service_object_usage()
+
+	def on_trash(self):
+		self.update_service_object_usage(deleted=True)
+
 	def check_dates_and_amount(self):
 		if self.end_date and self.start_date and self.end_date < self.start_date:
 			frappe.throw(_("End Date cannot be before Start Date."))
@@ -15,27 +25,49 @@ class ServiceProject(Document):
 			frappe.throw(_("Total Amount cannot be negative."))
 
 	def validate_unique_objects(self):
-		# Check for duplicate ServiceObjects within this project
+		# Duplicates within this project
 		seen_objects = set()
+		duplicates = []
 		for item in self.objects:
-			if item.service_object in seen_objects:
-				frappe.throw(_(f"Service Object {item.service_object} is duplicated in this project."))
+			if item.service_object in seen_objects and item.service_object not in duplicates:
+				duplicates.append(item.service_object)
 			seen_objects.add(item.service_object)
 
-			# Check if ServiceObject is already linked to another active project
-			# Exclude current project from the check
-			existing_link = frappe.db.get_value(
-				"ProjectObjectItem",
-				{
-					"service_object": item.service_object,
-					"parenttype": "ServiceProject",
-					"parent": ["!=", self.name],  # Exclude current project
+		conflicts = [
+			_("Service Object {0} is duplicated in this project.").format(service_object)
+			for service_object in duplicates
+		]
+
+		# Objects already linked to another active project, looked up in one query
+		if seen_objects and self.status in ACTIVE_PROJECT_STATUSES:
+			for row in frappe.get_all(
+				"ServiceProject",
+				filters={
+					"name": ["!=", self.name],
+					"status": ["in", ACTIVE_PROJECT_STATUSES],
+					"objects.service_object": ["in", list(seen_objects)],
 				},
-				"parent",
-			)
-			if existing_link:
-				frappe.throw(
-					_(
-						f"Service Object {item.service_object} is already linked to active project {existing_link}."
+				fields=["name", "objects.service_object as service_object"],
+				order_by="name asc",
+			):
+				conflicts.append(
+					_("Service Object {0} is already linked to active project {1}.").format(
+						row.service_object, row.name
 					)
 				)
+
+		if conflicts:
+			frappe.throw("<br>".join(conflicts), title=_("Duplicate Service Objects"))
+
+	def update_service_object_usage(self, deleted=False):
+		# Keeps ServiceObject.active_project_count in step with this project
+		before = self if deleted else self.get_doc_before_save()
+		old = get_active_objects(before) if before else set()
+		new = set() if deleted else get_active_objects(self)
+		update_service_object_usage("active_project_count", old, new)
+
+
+def get_active_objects(project):
+	if project.status not in ACTIVE_PROJECT_STATUSES:
+		return set()
+	return {item.service_object for item in project.objects}
@@ -2,6 +2,9 @@ import frappe
 from frappe import _
 from frappe.model.document import Document
 
+from ferum_custom.doctype.CustomAttachment.custom_attachment import queue_attachment_uploads
+from ferum_custom.workflow import validate_status_transition
+
 
 class ServiceReport(Document):
 	def validate(self):
@@ -10,9 +13,31 @@ class ServiceReport(Document):
 		self.validate_workflow_transitions()
 		self.validate_work_items()
 
+	def on_update(self):
+		# One background job uploads every attachment of the report that is not on Drive yet
+		queue_attachment_uploads(
+			{item.custom_attachment for item in self.documents if item.custom_attachment}
+		)
+
 	def on_submit(self):
 		self.update_service_request_on_submit()
 
+	def after_delete(self):
+		# The report's attachments go with it, unless another report uses them too; their Drive
+		# deletes are batched into one job
+		names = {item.custom_attachment for item in self.documents if item.custom_attachment}
+		if not names:
+			return
+		shared = set(
+			frappe.get_all(
+				"ServiceReportDocumentItem",
+				filters={"custom_attachment": ["in", list(names)]},
+				pluck="custom_attachment",
+			)
+		)
+		for name in names - shared:
+			frappe.delete_doc("CustomAttachment", name, ignore_permissions=True)
+
 	def calculate_total_amount(self):
 		self.total_amount = 0
 		for item in self.work_items:
@@ -25,26 +50,8 @@ class ServiceReport(Document):
 				frappe.throw(_("Attachment is required for all Document Items."))
 
 	def validate_workflow_transitions(self):
-		old_status = frappe.db.get_value("ServiceReport", self.name, "status") if not self.is_new() else None
-
-		if old_status == "Draft" and self.status == "Submitted":
-			# Draft to Submitted is allowed
-			pass
-		elif old_status == "Submitted" and self.status == "Approved":
-			# Submitted to Approved is allowed (e.g., by Dept Head)
-			pass
-		elif old_status == "Approved" and self.status == "Archived":
-			# Approved to Archived is allowed
-			pass
-		elif old_status == "Submitted" and self.status == "Draft":
-			# Submitted to Draft (Amend) is allowed
-			pass
-		elif self.status == "Cancelled":
-			# Cancelled is allowed from Draft or Submitted
-			if old_status not in ["Draft", "Submitted"]:
-				frappe.throw(_("Service Report can only be Cancelled from Draft or Submitted status."))
-		elif old_status and old_status != self.status:  # Prevent invalid transitions
-			frappe.throw(_(f"Invalid status transition from {old_status} to {self.status}."))
+		# Transition rules live in ferum_custom.workflow
+		validate_status_transition(self, "ServiceReport")
 
 	def update_service_request_on_submit(self):
 		if self.service_request:
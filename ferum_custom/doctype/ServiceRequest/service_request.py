@@ -1,10 +1,37 @@
 import json
+from functools import partial
 
 import frappe
 import requests  # type: ignore[import-untyped]
 from frappe import _
 from frappe.model.document import Document
-from frappe.utils import add_days, add_hours, getdate, nowdate
+from frappe.utils import add_to_date, cint, get_datetime, now_datetime
+
+from ferum_custom.doctype.ServiceObject.service_object import (
+	get_service_object_attributes,
+	update_service_object_usage,
+)
+from ferum_custom.doctype.SLACalendar.sla_calendar import get_calendar_for_request, get_sla_deadline
+from ferum_custom.notifications import (
+	get_sla_breach_message,
+	notify_new_service_requests_bulk,
+	notify_sla_breaches,
+)
+from ferum_custom.workflow import validate_status_transition
+
+SLA_OPEN_STATUSES = ("Open", "In Progress")
+SLA_RECOMPUTE_CHUNK_SIZE = 500
+BULK_CHUNK_SIZE = 200
+BULK_MAX_CHUNK_SIZE = 1000
+BULK_MAX_REQUESTS = 10000
+BULK_REQUEST_TYPES = ("Routine Maintenance", "Emergency")
+BULK_PRIORITIES = ("Low", "Medium", "High")
+# The only fields a bulk row may set; everything else (name, creation, SLA stamps, assignment,
+# idempotency key, ...) is owned by the server
+BULK_INPUT_FIELDS = ("title", "type", "priority", "service_object", "description", "reported_datetime")
+SLA_TIMER_KEY = "ferum_sla_deadlines"
+# rebuild_sla_timer loads deadlines this far ahead; saves add any deadline as it changes
+SLA_TIMER_HORIZON_HOURS = 48
 
 
 class ServiceRequest(Document):
@@ -12,87 +39,323 @@ class ServiceRequest(Document):
 		self.set_customer_and_project()
 		self.validate_workflow_transitions()
 		self.calculate_sla_deadline()
+		self.update_timestamps()
 
 	def on_update(self):
 		self.check_sla_breach()
-		self.update_timestamps()
+		update_sla_timer(self)
+		self.update_service_object_usage()
+
+	def on_trash(self):
+		remove_from_sla_timer_after_commit([self.name])
+		self.update_service_object_usage(deleted=True)
 
 	def set_customer_and_project(self):
 		if self.is_new() or self.has_value_changed("service_object"):
-			if self.service_object:
-				service_object_doc = frappe.get_doc("ServiceObject", self.service_object)
-				self.customer = service_object_doc.customer
-				self.project = service_object_doc.project
-			else:
-				self.customer = None
-				self.project = None
+			attributes = get_service_object_attributes([self.service_object]).get(self.service_object) or {}
+			self.customer = attributes.get("customer")
+			self.project = attributes.get("project")
 
 	def validate_workflow_transitions(self):
-		# Implement strict workflow transitions based on Technical_Specification_full.md
-		# [*] --> Open
-		# Open --> InProgress : Assign Engineer
-		# InProgress --> Completed : Submit Service Report
-		# Completed --> Closed : Manager Approval
-
-		# Get old status if document is not new
-		old_status = frappe.db.get_value("ServiceRequest", self.name, "status") if not self.is_new() else None
-
-		if old_status == "Open" and self.status == "In Progress" and not self.assigned_to:
-			frappe.throw(_("Cannot set status to 'In Progress' without assigning an engineer."))
-		elif old_status == "In Progress" and self.status == "Completed" and not self.linked_report:
-			frappe.throw(_("Cannot set status to 'Completed' without linking a Service Report."))
-		elif (
-			old_status == "Completed"
-			and self.status == "Closed"
-			and "System Manager" not in frappe.get_roles()
-		):  # Placeholder for Manager Approval
-			# In a real scenario, this would check for a specific role or user
-			frappe.throw(_("Only a Manager can close a Service Request."))
-		# Add more transitions as needed based on the full workflow diagram
-		# For example, Open -> Cancelled, In Progress -> Cancelled, Completed -> In Progress (for rework)
-		# For simplicity, I'm only adding the main positive flow and a basic check for closing.
+		# Transition rules live in ferum_custom.workflow
+		validate_status_transition(self, "ServiceRequest")
 
 	def calculate_sla_deadline(self):
-		# Placeholder for SLA calculation logic
-		# This would typically involve business hours, holidays, etc.
-		# For now, a simple calculation based on type and priority
-		if self.type == "Emergency" and self.priority == "High":
-			self.sla_deadline = add_hours(self.creation, 4)  # 4 hours for high emergency
-		elif self.type == "Emergency" and self.priority == "Medium":
-			self.sla_deadline = add_hours(self.creation, 8)  # 8 hours for medium emergency
-		elif self.type == "Routine" and self.priority == "High":
-			self.sla_deadline = add_days(self.creation, 1)  # 1 day for routine high
-		else:
-			self.sla_deadline = add_days(self.creation, 3)  # 3 days for others
+		# Business hours of the request's SLA calendar when one applies, wall-clock time otherwise
+		calendar = get_calendar_for_request(self.customer, self.project, emergency=self.type == "Emergency")
+		self.sla_deadline = get_sla_deadline(
+			self.creation, get_sla_target_hours(self.type, self.priority), calendar
+		)
+
+		if self.sla_breached_at and get_datetime(self.sla_deadline) > now_datetime():
+			# The deadline moved (e.g. priority lowered), so a future breach must be reported again
+			self.sla_breached_at = None
 
 	def check_sla_breach(self):
 		if (
-			self.status not in ["Completed", "Closed"]
+			self.status in SLA_OPEN_STATUSES
 			and self.sla_deadline
-			and getdate(nowdate()) > getdate(self.sla_deadline)
+			and not self.sla_breached_at
+			and now_datetime() > get_datetime(self.sla_deadline)
+			# Claimed like any sweep, so a breach is marked and alerted once
+			and sweep_sla_breaches([self.name])
 		):
-			message = f"SLA for Service Request {self.name} has been breached! Title: {self.title}. Priority: {self.priority}. Due: {self.sla_deadline}"
-			frappe.msgprint(_(message))
-			frappe.log_error(message, "SLA Breach Alert")
-
-			# Enqueue the notification sending to a background job
-			frappe.enqueue(
-				"ferum_custom.doctype.service_request.service_request.send_sla_breach_notifications",
-				service_request_name=self.name,
-				message=message,
-			)
+			self.sla_breached_at = frappe.db.get_value("ServiceRequest", self.name, "sla_breached_at")
+			frappe.msgprint(_(get_sla_breach_message(self)))
+
+	def update_service_object_usage(self, deleted=False):
+		# Keeps ServiceObject.open_request_count in step with this request
+		before = self if deleted else self.get_doc_before_save()
+		old = [before.service_object] if before and before.status in SLA_OPEN_STATUSES else []
+		new = [self.service_object] if not deleted and self.status in SLA_OPEN_STATUSES else []
+		update_service_object_usage("open_request_count", old, new)
 
 	def update_timestamps(self):
+		# Runs in validate so the stamps are part of the same write as the status change
 		if self.status == "In Progress" and not self.actual_start_datetime:
 			self.actual_start_datetime = frappe.utils.now()
 		elif self.status == "Completed" and not self.actual_end_datetime:
 			self.actual_end_datetime = frappe.utils.now()
-		self.save()
+
+
+def get_sla_target_hours(request_type, priority):
+	if request_type == "Emergency" and priority == "High":
+		return 4
+	if request_type == "Emergency" and priority == "Medium":
+		return 8
+	if request_type == "Routine" and priority == "High":
+		return 24
+	return 72
+
+
+def recompute_sla_deadlines(customers=None, projects=None):
+	"""Background job: recalculates the deadlines of open requests after an SLA calendar changed.
+
+	Works through the affected requests in chunks, with one UPDATE and one commit per chunk.
+	"""
+	or_filters = {}
+	if customers:
+		or_filters["customer"] = ["in", customers]
+	if projects:
+		or_filters["project"] = ["in", projects]
+	if not or_filters:
+		return 0
+
+	updated = 0
+	last_name = ""
+	while True:
+		rows = frappe.get_all(
+			"ServiceRequest",
+			filters={"status": ["in", SLA_OPEN_STATUSES], "name": [">", last_name]},
+			or_filters=or_filters,
+			fields=["name", "creation", "type", "priority", "customer", "project"],
+			order_by="name asc",
+			limit=SLA_RECOMPUTE_CHUNK_SIZE,
+		)
+		if not rows:
+			break
+
+		deadlines = []
+		for row in rows:
+			calendar = get_calendar_for_request(row.customer, row.project, emergency=row.type == "Emergency")
+			deadlines.append(
+				(
+					row.name,
+					get_sla_deadline(row.creation, get_sla_target_hours(row.type, row.priority), calendar),
+				)
+			)
+
+		# Like calculate_sla_deadline: a deadline moved into the future must be able to breach again.
+		# SET assignments apply left to right, so the check sees the new deadline
+		cases = " ".join(["when %s then %s"] * len(deadlines))
+		frappe.db.sql(
+			f"""update `tabServiceRequest`
+			set sla_deadline = case name {cases} end,
+				sla_breached_at = if(sla_deadline > %s, null, sla_breached_at)
+			where name in %s""",
+			[value for pair in deadlines for value in pair]
+			+ [now_datetime(), tuple(name for name, _deadline in deadlines)],
+		)
+		frappe.db.commit()
+		updated += len(rows)
+		last_name = rows[-1].name
+
+	return updated
 
 
 @frappe.whitelist()
 def check_all_slas():
-	open_requests = frappe.get_all("ServiceRequest", filters={"status": ["not in", ["Completed", "Closed"]]})
-	for req in open_requests:
-		doc = frappe.get_doc("ServiceRequest", req.name)
-		doc.check_sla_breach()
+	"""Daily reconciliation: alerts on every open request past its deadline that was not reported yet."""
+	return sweep_sla_breaches()
+
+
+def sweep_sla_breaches(names=None):
+	"""Alerts, in bulk, on open requests that passed their SLA deadline since the last sweep.
+
+	Uses the (status, sla_deadline) index and marks the requests with `sla_breached_at`, so each
+	breach is reported exactly once. `names` restricts the sweep to the given requests. The
+	candidates are claimed with SKIP LOCKED, so overlapping sweeps (timer tick, daily run, a save)
+	never alert the same breach twice: rows another sweep holds are left to it.
+	"""
+	return sum(1 for row in _sweep_sla_breaches(names) if row.is_breached)
+
+
+def _sweep_sla_breaches(names=None):
+	"""Runs the sweep and returns the rows it claimed; with `names`, that includes the requests that
+	turned out not to be breached, while rows held by another transaction are left out."""
+	if names is not None and not names:
+		return []
+	now = now_datetime()
+	breach_condition = "status in %(statuses)s and sla_deadline < %(now)s and sla_breached_at is null"
+	claimed = frappe.db.sql(
+		f"""select name, title, priority, sla_deadline, assigned_to, customer,
+			ifnull({breach_condition}, 0) as is_breached
+		from `tabServiceRequest`
+		where {"name in %(names)s" if names is not None else breach_condition}
+		for update skip locked""",
+		{"statuses": SLA_OPEN_STATUSES, "now": now, "names": names},
+		as_dict=True,
+	)
+	breached = [row for row in claimed if row.is_breached]
+	if not breached:
+		return claimed
+
+	frappe.db.sql(
+		"""update `tabServiceRequest` set sla_breached_at = %(now)s
+		where name in %(names)s and sla_breached_at is null""",
+		{"now": now, "names": [row.name for row in breached]},
+	)
+	notify_sla_breaches(breached)
+	frappe.log_error(
+		"\n".join(get_sla_breach_message(row) for row in breached), f"SLA Breach Alert ({len(breached)})"
+	)
+	return claimed
+
+
+# --- SLA timer ---
+# A Redis sorted set of request name -> deadline timestamp acts as a priority queue, so the
+# per-minute tick only reads its head instead of scanning the table. It is only changed once the
+# transaction commits, so a rollback cannot leave a phantom or outdated deadline behind.
+
+
+def update_sla_timer(doc):
+	if doc.status in SLA_OPEN_STATUSES and doc.sla_deadline and not doc.sla_breached_at:
+		deadline = get_datetime(doc.sla_deadline).timestamp()
+		frappe.db.after_commit.add(partial(_add_to_sla_timer, {doc.name: deadline}))
+	else:
+		remove_from_sla_timer_after_commit([doc.name])
+
+
+def remove_from_sla_timer_after_commit(names):
+	frappe.db.after_commit.add(partial(_remove_from_sla_timer, names))
+
+
+def _add_to_sla_timer(deadlines):
+	cache = frappe.cache()
+	cache.zadd(cache.make_key(SLA_TIMER_KEY), deadlines)
+
+
+def _remove_from_sla_timer(names):
+	cache = frappe.cache()
+	cache.zrem(cache.make_key(SLA_TIMER_KEY), *names)
+
+
+def check_due_sla_deadlines():
+	"""Scheduler tick: alerts on the requests at the head of the timer whose deadline has passed."""
+	cache = frappe.cache()
+	key = cache.make_key(SLA_TIMER_KEY)
+	due = [frappe.safe_decode(name) for name in cache.zrangebyscore(key, "-inf", now_datetime().timestamp())]
+	if not due:
+		return 0
+
+	claimed = _sweep_sla_breaches(due)
+	# Claimed entries are either alerted now or no longer breachable; saves re-add moved deadlines.
+	# Requests another transaction holds stay due for the next tick, deleted ones are dropped.
+	settled = {row.name for row in claimed}
+	unclaimed = [name for name in due if name not in settled]
+	if unclaimed:
+		existing = set(frappe.get_all("ServiceRequest", filters={"name": ["in", unclaimed]}, pluck="name"))
+		settled.update(name for name in unclaimed if name not in existing)
+	if settled:
+		remove_from_sla_timer_after_commit(sorted(settled))
+	return sum(1 for row in claimed if row.is_breached)
+
+
+def rebuild_sla_timer():
+	"""Scheduler job: reloads every deadline within the horizon from the (status, sla_deadline) index."""
+	horizon = add_to_date(now_datetime(), hours=SLA_TIMER_HORIZON_HOURS)
+	rows = frappe.get_all(
+		"ServiceRequest",
+		filters={
+			"status": ["in", SLA_OPEN_STATUSES],
+			"sla_deadline": ["<=", horizon],
+			"sla_breached_at": ["is", "not set"],
+		},
+		fields=["name", "sla_deadline"],
+	)
+
+	cache = frappe.cache()
+	key = cache.make_key(SLA_TIMER_KEY)
+	pipeline = cache.pipeline()
+	pipeline.zremrangebyscore(key, "-inf", horizon.timestamp())
+	if rows:
+		pipeline.zadd(key, {row.name: get_datetime(row.sla_deadline).timestamp() for row in rows})
+	pipeline.execute()
+	return len(rows)
+
+
+@frappe.whitelist(methods=["POST"])
+def bulk_create_service_requests(rows, chunk_size=BULK_CHUNK_SIZE):
+	"""Creates many ServiceRequests in one call (call-centre and bot integrations).
+
+	Rows are validated set-wise against ServiceObjects fetched in one lookup, inserted in chunks with
+	one commit per chunk, and announced with one aggregated notification per chunk. A failing row
+	is rolled back on its own without affecting the rest of its chunk. Returns one result per row:
+	`{"row", "status": "Created" | "Failed", "name" | "error"}`.
+	"""
+	rows = frappe.parse_json(rows) if isinstance(rows, str) else rows
+	chunk_size = min(max(cint(chunk_size), 1), BULK_MAX_CHUNK_SIZE)
+	if len(rows) > BULK_MAX_REQUESTS:
+		frappe.throw(_("At most {0} Service Requests can be created per call.").format(BULK_MAX_REQUESTS))
+	frappe.has_permission("ServiceRequest", "create", throw=True)
+
+	objects = get_service_object_attributes(
+		row.get("service_object") for row in rows if isinstance(row, dict)
+	)
+	results = [None] * len(rows)
+	valid = []
+	for idx, row in enumerate(rows):
+		error = _get_bulk_row_error(row, objects)
+		if error:
+			results[idx] = {"row": idx, "status": "Failed", "error": error}
+		else:
+			valid.append(idx)
+
+	for start in range(0, len(valid), chunk_size):
+		created = []
+		for idx in valid[start : start + chunk_size]:
+			row = rows[idx]
+			savepoint = f"bulk_sr_{idx}"
+			frappe.db.savepoint(savepoint)
+			try:
+				doc = frappe.get_doc(
+					{
+						"doctype": "ServiceRequest",
+						"status": "Open",
+						**{field: row[field] for field in BULK_INPUT_FIELDS if field in row},
+					}
+				)
+				doc.flags.skip_notifications = True
+				doc.insert()
+			except Exception as e:
+				frappe.db.rollback(save_point=savepoint)
+				results[idx] = {"row": idx, "status": "Failed", "error": str(e)}
+			else:
+				created.append(doc)
+				results[idx] = {"row": idx, "status": "Created", "name": doc.name}
+
+		if created:
+			notify_new_service_requests_bulk(created)
+		frappe.db.commit()
+
+	return results
+
+
+def _get_bulk_row_error(row, objects):
+	if not isinstance(row, dict):
+		return _("Row must be an object.")
+	if not row.get("title"):
+		return _("Title is required.")
+	if row.get("service_object") and row["service_object"] not in objects:
+		return _("Service Object {0} not found.").format(row["service_object"])
+	if row.get("status") and row["status"] != "Open":
+		return _("New Service Requests must start in status Open.")
+	if row.get("type") and row["type"] not in BULK_REQUEST_TYPES:
+		return _("Invalid Type {0}.").format(row["type"])
+	if row.get("priority") and row["priority"] not in BULK_PRIORITIES:
+		return _("Invalid Priority {0}.").format(row["priority"])
+	return None
+
+
+def on_doctype_update():
+	frappe.db.add_index("ServiceRequest", ["status", "sla_deadline"])
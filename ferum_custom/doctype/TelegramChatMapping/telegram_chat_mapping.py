@@ -0,0 +1,172 @@
+from functools import partial
+
+import frappe
+from frappe.model.document import Document
+
+# Site-cache index of enabled mappings:
+# {"User": {user: [chat_id]}, "Customer": {...}, "Role": {...}, "role_members": {role: [user]}}
+# "role_members" only lists enabled users that have a chat mapping, so role lookups stay small.
+CHAT_INDEX_CACHE_KEY = "ferum_telegram_chat_index"
+# Serialises read-modify-write updates of the cached index between workers
+CHAT_INDEX_LOCK_KEY = "ferum_telegram_chat_index_lock"
+CHAT_INDEX_LOCK_TIMEOUT = 10
+
+
+class TelegramChatMapping(Document):
+	def on_update(self):
+		update_chat_index(self.reference_doctype, self.reference_name)
+		before = self.get_doc_before_save()
+		if before and (before.reference_doctype, before.reference_name) != (
+			self.reference_doctype,
+			self.reference_name,
+		):
+			update_chat_index(before.reference_doctype, before.reference_name)
+
+	def on_trash(self):
+		update_chat_index(self.reference_doctype, self.reference_name)
+
+
+def get_chat_index():
+	index = frappe.cache().get_value(CHAT_INDEX_CACHE_KEY)
+	if index is None:
+		index = build_chat_index()
+	return index
+
+
+def build_chat_index():
+	"""Builds the full index with three queries and stores it in the site cache."""
+	with _chat_index_lock():
+		return _build_chat_index()
+
+
+def _build_chat_index():
+	index = {"User": {}, "Customer": {}, "Role": {}, "role_members": {}}
+	mappings = frappe.get_all(
+		"TelegramChatMapping",
+		filters={"enabled": 1},
+		fields=["reference_doctype", "reference_name", "chat_id"],
+		order_by="creation asc",
+	)
+	for row in mappings:
+		index[row.reference_doctype].setdefault(row.reference_name, []).append(row.chat_id)
+
+	# Disabled users keep their mappings but are not reached through their roles
+	enabled_users = index["User"] and frappe.get_all(
+		"User", filters={"name": ["in", list(index["User"])], "enabled": 1}, pluck="name"
+	)
+	for user, roles in _get_user_roles(enabled_users).items():
+		for role in roles:
+			index["role_members"].setdefault(role, []).append(user)
+
+	frappe.cache().set_value(CHAT_INDEX_CACHE_KEY, index)
+	return index
+
+
+def update_chat_index(reference_doctype, reference_name):
+	"""Refreshes the index entries of a single recipient once its changed mappings are committed.
+
+	Applied after commit so a rollback never reaches the cache, and under a lock so concurrent
+	updates of the index do not overwrite each other.
+	"""
+	frappe.db.after_commit.add(partial(_apply_chat_index_update, reference_doctype, reference_name))
+
+
+def _apply_chat_index_update(reference_doctype, reference_name):
+	with _chat_index_lock():
+		index = frappe.cache().get_value(CHAT_INDEX_CACHE_KEY)
+		if index is None:
+			# Nothing cached yet, the next lookup builds a fresh index
+			return
+
+		chat_ids = frappe.get_all(
+			"TelegramChatMapping",
+			filters={"reference_doctype": reference_doctype, "reference_name": reference_name, "enabled": 1},
+			pluck="chat_id",
+			order_by="creation asc",
+		)
+		entries = index[reference_doctype]
+		if chat_ids:
+			entries[reference_name] = chat_ids
+		else:
+			entries.pop(reference_name, None)
+
+		if reference_doctype == "User":
+			enabled = chat_ids and frappe.db.get_value("User", reference_name, "enabled")
+			roles = _get_user_roles([reference_name]).get(reference_name, []) if enabled else []
+			_set_user_roles(index, reference_name, roles)
+
+		frappe.cache().set_value(CHAT_INDEX_CACHE_KEY, index)
+
+
+def on_user_update(doc, method):
+	"""Keeps role membership in the index in sync when a mapped user's roles change."""
+	roles = [] if method == "on_trash" or not doc.enabled else [d.role for d in doc.get("roles")]
+	frappe.db.after_commit.add(partial(_apply_user_roles, doc.name, roles))
+
+
+def _apply_user_roles(user, roles):
+	with _chat_index_lock():
+		index = frappe.cache().get_value(CHAT_INDEX_CACHE_KEY)
+		if index is not None and user in index["User"] and _set_user_roles(index, user, roles):
+			frappe.cache().set_value(CHAT_INDEX_CACHE_KEY, index)
+
+
+def _get_user_roles(users):
+	"""`{user: [role]}` from the users' Has Role rows, like on_user_update; unlike frappe.get_roles,
+	the automatic roles ("All", "Guest") are left out, so rebuilt and patched indexes agree."""
+	roles = {}
+	if users:
+		for row in frappe.get_all(
+			"Has Role",
+			filters={"parenttype": "User", "parent": ["in", list(users)]},
+			fields=["parent", "role"],
+		):
+			roles.setdefault(row.parent, []).append(row.role)
+	return roles
+
+
+def _chat_index_lock():
+	cache = frappe.cache()
+	return cache.lock(
+		cache.make_key(CHAT_INDEX_LOCK_KEY),
+		timeout=CHAT_INDEX_LOCK_TIMEOUT,
+		blocking_timeout=CHAT_INDEX_LOCK_TIMEOUT,
+	)
+
+
+def _set_user_roles(index, user, roles):
+	"""Moves `user` to exactly `roles` in role_members. Returns True if anything changed."""
+	changed = False
+	roles = set(roles)
+	for role, members in list(index["role_members"].items()):
+		if user in members and role not in roles:
+			members.remove(user)
+			changed = True
+			if not members:
+				del index["role_members"][role]
+	for role in roles:
+		members = index["role_members"].setdefault(role, [])
+		if user not in members:
+			members.append(user)
+			changed = True
+	return changed
+
+
+def resolve_chat_ids(users=None, customers=None, roles=None):
+	"""Resolves every given recipient to a de-duplicated list of chat ids using only the cached index."""
+	index = get_chat_index()
+	chat_ids = []
+
+	def add(reference_doctype, names):
+		for name in names or ():
+			for chat_id in index[reference_doctype].get(name, ()):
+				if chat_id not in chat_ids:
+					chat_ids.append(chat_id)
+
+	add("User", users)
+	add("Customer", customers)
+	add("Role", roles)
+	for role in roles or ():
+		add("User", index["role_members"].get(role))
+
+	return chat_ids
@@ -78,6 +78,11 @@ app_license = "mit"
 # 	"methods": "ferum_custom.utils.jinja_methods",
 # 	"filters": "ferum_custom.utils.jinja_filters"
 # }
+jinja = {
+	"methods": [
+		"ferum_custom.doctype.RequestPhotoAttachmentItem.request_photo_attachment_item.get_photo_url"
+	],
+}
 
 # Installation
 # ------------
@@ -137,9 +142,23 @@ app_license = "mit"
 # ---------------
 
 doc_events = {
+	"User": {
+		"on_update": "ferum_custom.doctype.TelegramChatMapping.telegram_chat_mapping.on_user_update",
+		"on_trash": "ferum_custom.doctype.TelegramChatMapping.telegram_chat_mapping.on_user_update",
+	},
+	"MaintenanceSchedule": {
+		"on_update": "ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule.clear_forecast_cache",
+		"on_trash": "ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule.clear_forecast_cache",
+		"after_rename": "ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule.clear_forecast_cache",
+	},
 	"ServiceRequest": {
 		"after_insert": "ferum_custom.notifications.notify_new_service_request",
-		"on_update": "ferum_custom.notifications.notify_service_request_status_change",
+		"on_update": [
+			"ferum_custom.notifications.notify_service_request_status_change",
+			"ferum_custom.doctype.RequestPhotoAttachmentItem.request_photo_attachment_item.queue_photo_variants",
+			"ferum_custom.doctype.RequestPhotoAttachmentItem.request_photo_attachment_item.release_photo_variants",
+		],
+		"on_trash": "ferum_custom.doctype.RequestPhotoAttachmentItem.request_photo_attachment_item.release_photo_variants",
 	},
 	"ServiceReport": {
 		"after_insert": "ferum_custom.notifications.notify_new_service_report",
@@ -158,9 +177,22 @@ doc_events = {
 # ---------------
 
 scheduler_events = {
+	"cron": {
+		"* * * * *": [
+			"ferum_custom.notifications.send_notification_digests",
+			"ferum_custom.notifications.drain_notification_outbox",
+			"ferum_custom.doctype.ServiceRequest.service_request.check_due_sla_deadlines",
+		],
+	},
+	"hourly": [
+		"ferum_custom.doctype.ServiceRequest.service_request.rebuild_sla_timer",
+	],
 	"daily": [
 		"ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule.generate_service_requests_from_schedule",
 		"ferum_custom.doctype.ServiceRequest.service_request.check_all_slas",
+		"ferum_custom.notifications.clear_old_outbox_entries",
+		"ferum_custom.doctype.ServiceObject.service_object.check_service_object_usage",
+		"ferum_custom.doctype.CustomAttachment.attachment_storage.apply_storage_tiering",
 	],
 }
 
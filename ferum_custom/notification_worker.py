@@ -0,0 +1,298 @@
+"""Dedicated asyncio consumer for Telegram notifications.
+
+When Ferum Settings selects the "Async Worker" delivery mode, `drain_notification_outbox` pushes
+outbox rows onto a Redis list; this worker drains that list with bounded concurrency while
+respecting Telegram's global and per-chat rate limits, and acknowledges every message back to the
+outbox once delivered or given up on. Rows it never acknowledges are pushed again by the drain.
+Start it with `bench --site <site> ferum-notification-worker`.
+"""
+
+import asyncio
+import json
+import time
+from collections import deque
+
+import frappe
+import requests
+
+from ferum_custom.notifications import (
+	FASTAPI_NOTIFICATION_ENDPOINT,
+	FASTAPI_TIMEOUT,
+	NOTIFICATION_QUEUE_KEY,
+	acknowledge_worker_deliveries,
+)
+from ferum_custom.settings import get_settings
+
+WORKER_STATS_CACHE_KEY = "ferum_notification_worker_stats"
+
+# Telegram allows roughly 30 messages per second overall and one message per second per chat
+DEFAULT_GLOBAL_RATE = 30
+DEFAULT_PER_CHAT_RATE = 1
+DEFAULT_CONCURRENCY = 8
+MAX_DELIVERY_ATTEMPTS = 5
+RETRY_BACKOFF_SECONDS = 1
+MAX_RETRY_BACKOFF_SECONDS = 60
+FETCH_BATCH_SIZE = 100
+STATS_INTERVAL_SECONDS = 30
+
+
+class TokenBucket:
+	"""Async token bucket refilled at `rate` tokens per second, holding at most `capacity` tokens."""
+
+	def __init__(self, rate, capacity=None):
+		self.rate = rate
+		self.capacity = capacity or rate
+		self.tokens = self.capacity
+		self.updated_at = time.monotonic()
+		self.blocked_until = 0
+		self.lock = asyncio.Lock()
+
+	async def acquire(self):
+		async with self.lock:
+			while True:
+				now = time.monotonic()
+				if now < self.blocked_until:
+					await asyncio.sleep(self.blocked_until - now)
+					continue
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+				self.updated_at = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				await asyncio.sleep((1 - self.tokens) / self.rate)
+
+	def block_for(self, seconds):
+		"""Pauses the bucket, e.g. for the Retry-After period of a 429 response."""
+		self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class DeliveryStats:
+	"""Counts outcomes and keeps a window of recent delivery latencies for percentile reporting."""
+
+	def __init__(self, window=10000):
+		self.started_at = time.monotonic()
+		self.sent = 0
+		self.failed = 0
+		self.retried = 0
+		self.rate_limited = 0
+		self.latencies = deque(maxlen=window)
+
+	def record(self, ok, latency):
+		if ok:
+			self.sent += 1
+		else:
+			self.failed += 1
+		self.latencies.append(latency)
+
+	def percentile(self, percent):
+		if not self.latencies:
+			return None
+		ordered = sorted(self.latencies)
+		return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+	def as_dict(self):
+		elapsed = max(time.monotonic() - self.started_at, 1e-9)
+		return {
+			"sent": self.sent,
+			"failed": self.failed,
+			"retried": self.retried,
+			"rate_limited": self.rate_limited,
+			"throughput_per_second": round(self.sent / elapsed, 3),
+			"latency_p50": self.percentile(50),
+			"latency_p95": self.percentile(95),
+			"latency_p99": self.percentile(99),
+		}
+
+
+class NotificationWorker:
+	"""Delivers `{"chat_id", "text"}` messages to the FastAPI backend from an async message source."""
+
+	def __init__(
+		self,
+		fastapi_url,
+		token,
+		concurrency=DEFAULT_CONCURRENCY,
+		global_rate=DEFAULT_GLOBAL_RATE,
+		per_chat_rate=DEFAULT_PER_CHAT_RATE,
+		max_attempts=MAX_DELIVERY_ATTEMPTS,
+	):
+		self.url = fastapi_url.rstrip("/") + FASTAPI_NOTIFICATION_ENDPOINT
+		self.concurrency = concurrency
+		self.per_chat_rate = per_chat_rate
+		self.max_attempts = max_attempts
+		self.global_bucket = TokenBucket(global_rate)
+		self.chat_buckets = {}
+		self.stats = DeliveryStats()
+		# (message, delivered) pairs not yet acknowledged to the message source
+		self.outcomes = []
+
+		self.session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+		self.session.mount("http://", adapter)
+		self.session.mount("https://", adapter)
+		self.session.headers.update({"Authorization": f"Bearer {token}", "Content-Type": "application/json"})
+
+	async def run(self, fetch, stop_event=None, acknowledge=None):
+		"""Drains `fetch()` (an async callable returning a list of messages) until `stop_event` is set.
+
+		An empty list from `fetch` means the source is idle and is simply polled again. Between
+		fetches, `acknowledge(outcomes)` is called in a thread with the `(message, delivered)` pairs
+		finished since the last call.
+		"""
+		stop_event = stop_event or asyncio.Event()
+		slots = asyncio.Semaphore(self.concurrency)
+		in_flight = set()
+
+		async def deliver(message):
+			try:
+				delivered = await self.deliver(message)
+				self.outcomes.append((message, delivered))
+			finally:
+				slots.release()
+
+		async def flush_outcomes():
+			if acknowledge and self.outcomes:
+				outcomes, self.outcomes = self.outcomes, []
+				await asyncio.to_thread(acknowledge, outcomes)
+
+		while not stop_event.is_set():
+			messages = await fetch()
+			for message in messages:
+				await slots.acquire()
+				task = asyncio.create_task(deliver(message))
+				in_flight.add(task)
+				task.add_done_callback(in_flight.discard)
+			await flush_outcomes()
+
+		if in_flight:
+			await asyncio.gather(*in_flight)
+		await flush_outcomes()
+
+	async def deliver(self, message):
+		"""Sends one message, honouring rate limits, Retry-After and exponential backoff."""
+		started_at = time.monotonic()
+		bucket = self.chat_buckets.get(message["chat_id"])
+		if bucket is None:
+			bucket = self.chat_buckets[message["chat_id"]] = TokenBucket(self.per_chat_rate)
+
+		for attempt in range(1, self.max_attempts + 1):
+			await bucket.acquire()
+			await self.global_bucket.acquire()
+			status_code, retry_after = await asyncio.to_thread(self._post, message)
+
+			if status_code and status_code < 300:
+				self.stats.record(True, time.monotonic() - started_at)
+				return True
+
+			retryable = status_code is None or status_code == 429 or status_code >= 500
+			if not retryable or attempt == self.max_attempts:
+				break
+
+			self.stats.retried += 1
+			if status_code == 429:
+				self.stats.rate_limited += 1
+				bucket.block_for(retry_after or RETRY_BACKOFF_SECONDS)
+			else:
+				await asyncio.sleep(
+					min(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1), MAX_RETRY_BACKOFF_SECONDS)
+				)
+
+		self.stats.record(False, time.monotonic() - started_at)
+		return False
+
+	def _post(self, message):
+		"""Blocking HTTP call, run in a thread. Returns (status_code, retry_after_seconds)."""
+		try:
+			response = self.session.post(self.url, data=json.dumps(message), timeout=FASTAPI_TIMEOUT)
+		except requests.RequestException:
+			return None, None
+
+		retry_after = None
+		if response.status_code == 429:
+			retry_after = _parse_retry_after(response)
+		return response.status_code, retry_after
+
+
+def _parse_retry_after(response):
+	value = response.headers.get("Retry-After")
+	if value and value.isdigit():
+		return int(value)
+	try:
+		# Telegram reports the wait inside the error body
+		return int(response.json()["parameters"]["retry_after"])
+	except Exception:
+		return None
+
+
+# --- Redis queue ---
+
+
+def make_redis_fetch(timeout=1):
+	"""Returns an async fetch callable that pops up to FETCH_BATCH_SIZE messages from the queue."""
+	cache = frappe.cache()
+	key = cache.make_key(NOTIFICATION_QUEUE_KEY)
+
+	def pop():
+		item = cache.blpop(key, timeout=timeout)
+		if not item:
+			return []
+		messages = [item[1]]
+		messages.extend(cache.lpop(key, FETCH_BATCH_SIZE - 1) or [])
+		return [json.loads(m) for m in messages]
+
+	async def fetch():
+		return await asyncio.to_thread(pop)
+
+	return fetch
+
+
+def run_notification_worker(
+	concurrency=DEFAULT_CONCURRENCY, global_rate=DEFAULT_GLOBAL_RATE, per_chat_rate=DEFAULT_PER_CHAT_RATE
+):
+	"""Entry point of the bench command; runs until interrupted."""
+	settings = get_settings()
+	if not settings.fastapi_url or not settings.fastapi_jwt_token:
+		frappe.throw("FastAPI URL and JWT Token must be set in Ferum Settings.")
+
+	worker = NotificationWorker(
+		settings.fastapi_url,
+		settings.fastapi_jwt_token,
+		concurrency=concurrency,
+		global_rate=global_rate,
+		per_chat_rate=per_chat_rate,
+	)
+
+	async def publish_stats(stop_event):
+		while not stop_event.is_set():
+			await asyncio.sleep(STATS_INTERVAL_SECONDS)
+			frappe.cache().set_value(WORKER_STATS_CACHE_KEY, worker.stats.as_dict())
+
+	async def main():
+		stop_event = asyncio.Event()
+		reporter = asyncio.create_task(publish_stats(stop_event))
+		try:
+			await worker.run(make_redis_fetch(), stop_event, acknowledge_outbox_messages)
+		finally:
+			stop_event.set()
+			reporter.cancel()
+			frappe.cache().set_value(WORKER_STATS_CACHE_KEY, worker.stats.as_dict())
+
+	try:
+		asyncio.run(main())
+	except KeyboardInterrupt:
+		pass
+	return worker.stats.as_dict()
+
+
+def acknowledge_outbox_messages(outcomes):
+	"""Reports the outcome of messages that came from the NotificationOutbox back to it."""
+	acknowledge_worker_deliveries(
+		[(message["outbox"], delivered) for message, delivered in outcomes if message.get("outbox")]
+	)
+
+
+@frappe.whitelist()
+def get_notification_worker_stats():
+	"""Throughput and latency percentiles last published by the notification worker."""
+	frappe.only_for("System Manager")
+	return frappe.cache().get_value(WORKER_STATS_CACHE_KEY)
@@ -1,115 +1,577 @@
+import hashlib
 import json
+import time
+from contextlib import contextmanager
 
 import frappe
 import requests
+from frappe.utils import add_days, add_to_date, now_datetime
+
+from ferum_custom.doctype.TelegramChatMapping.telegram_chat_mapping import resolve_chat_ids
+from ferum_custom.settings import get_settings
+
+FASTAPI_NOTIFICATION_ENDPOINT = "/api/v1/send_telegram_notification"
+FASTAPI_BULK_NOTIFICATION_ENDPOINT = "/api/v1/send_telegram_notifications"
+
+# (connect, read) timeouts in seconds for every call to the FastAPI backend
+FASTAPI_TIMEOUT = (3.05, 15)
+MAX_SEND_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 0.5
+# Upper bound for a Retry-After header; a longer wait is left to the next drain
+MAX_RETRY_DELAY_SECONDS = 30
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Redis list drained by the asyncio worker (see ferum_custom.notification_worker)
+NOTIFICATION_QUEUE_KEY = "ferum_notification_queue"
+
+OUTBOX_DRAIN_JOB_ID = "ferum_notification_outbox_drain"
+OUTBOX_BATCH_SIZE = 500
+MAX_OUTBOX_ATTEMPTS = 5
+OUTBOX_RETENTION_DAYS = 7
+# Claimed rows whose outcome was not recorded by then (crashed drain, async worker that never
+# acknowledged) are delivered again; idempotency keys keep the backend from sending them twice
+OUTBOX_QUEUED_LEASE_MINUTES = 30
+
+# Event types that are never folded into a digest
+IMMEDIATE_EVENT_TYPES = ("digest", "emergency_service_request", "sla_breach")
+# Sorted set of chat_id -> time of its oldest buffered event, plus one list of lines per chat
+DIGEST_CHATS_KEY = "ferum_notification_digest_chats"
+DIGEST_BUFFER_KEY = "ferum_notification_digest"
+DIGEST_MAX_LINES = 25
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
+_http_session = None
+
+
+def get_http_session():
+	"""Returns the keep-alive session shared by all notification jobs of this worker process."""
+	global _http_session
+	if _http_session is None:
+		_http_session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=10)
+		_http_session.mount("http://", adapter)
+		_http_session.mount("https://", adapter)
+	return _http_session
+
+
+def send_telegram_notifications(messages):
+	"""Background job: sends a batch of `{"chat_id", "text"}` messages via the FastAPI backend.
+
+	Returns the sent, failed and retried counts.
+	"""
+	stats, _delivered = deliver_telegram_messages([m for m in messages if m.get("chat_id")])
+	return stats
 
 
 def send_telegram_notification_via_fastapi(chat_id, message):
-	"""Fetches config from Ferum Settings and sends a Telegram notification via the FastAPI backend."""
-	settings = frappe.get_single("Ferum Settings")
+	"""Sends a single Telegram notification; kept for jobs queued before batching was introduced."""
+	return send_telegram_notifications([{"chat_id": chat_id, "text": message}])
 
-	if not settings.enable_telegram_notifications or not settings.fastapi_url or not chat_id:
-		return
+
+def deliver_telegram_messages(messages):
+	"""Sends `messages` over the shared keep-alive session.
+
+	The whole batch goes out as one payload to the bulk endpoint; backends without it get one call
+	per message over the same connection. Returns `(stats, delivered)`, where `delivered[i]` tells
+	whether `messages[i]` was accepted by the backend.
+	"""
+	stats = {"sent": 0, "failed": 0, "retried": 0}
+	delivered = [False] * len(messages)
+	settings = get_settings()
+
+	if not messages or not settings.enable_telegram_notifications or not settings.fastapi_url:
+		return stats, delivered
+
+	token = settings.fastapi_jwt_token
+	if not token:
+		frappe.log_error("FastAPI JWT Token not set in Ferum Settings", "Notification Error")
+		stats["failed"] = len(messages)
+		return stats, delivered
+
+	session = get_http_session()
+	session.headers.update({"Authorization": f"Bearer {token}", "Content-Type": "application/json"})
+	base_url = settings.fastapi_url.rstrip("/")
 
 	try:
-		token = settings.get_password("fastapi_jwt_token")
-		if not token:
-			frappe.log_error("FastAPI JWT Token not set in Ferum Settings", "Notification Error")
-			return
-
-		headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-		payload = {"chat_id": chat_id, "text": message}
-
-		# Note: The actual requests call is now wrapped in a background job by the calling functions.
-		# This function is the background job itself.
-		response = requests.post(
-			f"{settings.fastapi_url}/api/v1/send_telegram_notification",
-			headers=headers,
-			data=json.dumps(payload),
-		)
-		response.raise_for_status()
-		frappe.log_by_page(
-			f"Telegram notification sent via FastAPI for chat_id {chat_id}", "Notification Success"
+		response = _post_with_retry(
+			session,
+			base_url + FASTAPI_BULK_NOTIFICATION_ENDPOINT,
+			{"messages": messages},
+			stats,
+			len(messages),
 		)
+		if response.status_code in (404, 405):
+			# Backend predates the bulk endpoint
+			delivered = [_send_single(session, base_url, message, stats) for message in messages]
+		else:
+			response.raise_for_status()
+			stats["sent"] += len(messages)
+			delivered = [True] * len(messages)
+	except Exception as e:
+		stats["failed"] += len(messages)
+		frappe.log_error(f"Failed to send Telegram notifications via FastAPI: {e}", "Notification Error")
+
+	frappe.logger("ferum_custom.notifications").info(
+		f"Telegram notifications: {stats['sent']} sent, {stats['failed']} failed, {stats['retried']} retried"
+	)
+	return stats, delivered
 
+
+def _send_single(session, base_url, message, stats):
+	try:
+		response = _post_with_retry(session, base_url + FASTAPI_NOTIFICATION_ENDPOINT, message, stats, 1)
+		response.raise_for_status()
+		stats["sent"] += 1
+		return True
 	except Exception as e:
+		stats["failed"] += 1
 		frappe.log_error(
-			f"Failed to send Telegram notification via FastAPI to chat_id {chat_id}: {e}",
+			f"Failed to send Telegram notification via FastAPI to chat_id {message['chat_id']}: {e}",
 			"Notification Error",
 		)
+		return False
+
+
+def _post_with_retry(session, url, payload, stats, message_count):
+	"""POSTs `payload`, retrying connection errors and retryable status codes with exponential backoff."""
+	for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+		delay = RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1)
+		try:
+			response = session.post(url, data=json.dumps(payload), timeout=FASTAPI_TIMEOUT)
+		except (requests.ConnectionError, requests.Timeout):
+			if attempt == MAX_SEND_ATTEMPTS:
+				raise
+		else:
+			if response.status_code not in RETRYABLE_STATUS_CODES or attempt == MAX_SEND_ATTEMPTS:
+				return response
+			retry_after = response.headers.get("Retry-After")
+			if retry_after and retry_after.isdigit():
+				delay = max(delay, min(int(retry_after), MAX_RETRY_DELAY_SECONDS))
+
+		stats["retried"] += message_count
+		time.sleep(delay)
+
+
+def get_recipient_chat_ids(users=None, customers=None, roles=None):
+	"""Resolves users, customers and roles to chat ids in one cached lookup.
+
+	Falls back to the chat configured in Ferum Settings when no recipient has a mapping.
+	"""
+	chat_ids = resolve_chat_ids(users=users, customers=customers, roles=roles)
+	if not chat_ids and get_settings().fallback_telegram_chat_id:
+		chat_ids = [get_settings().fallback_telegram_chat_id]
+	return chat_ids
 
 
 def get_chat_id_for_user(user):
-	"""Placeholder function to get Telegram Chat ID for a given user."""
-	# In a real implementation, you would have a custom field 'telegram_chat_id' in the User DocType.
-	# return frappe.db.get_value("User", user, "custom_telegram_chat_id")
-	# For now, returning a placeholder from settings.
-	return frappe.get_single("Ferum Settings").fallback_telegram_chat_id
+	"""Returns the first Telegram Chat ID mapped to `user`."""
+	return next(iter(get_recipient_chat_ids(users=[user])), None)
 
 
 def get_chat_id_for_customer(customer):
-	"""Placeholder function to get Telegram Chat ID for a given customer."""
-	# You would have a custom field 'telegram_chat_id' in the Customer or Contact DocType.
-	# return frappe.db.get_value("Customer", customer, "custom_telegram_chat_id")
-	return frappe.get_single("Ferum Settings").fallback_telegram_chat_id
+	"""Returns the first Telegram Chat ID mapped to `customer`."""
+	return next(iter(get_recipient_chat_ids(customers=[customer])), None)
 
 
 def get_chat_ids_for_roles(roles):
-	"""Placeholder function to get all chat IDs for users with given roles."""
-	# This is a simplified example. A real implementation would be more complex.
-	# and might involve a custom mapping DocType.
-	return [frappe.get_single("Ferum Settings").fallback_telegram_chat_id]
+	"""Returns the chat IDs mapped to the given roles and to users holding them."""
+	return get_recipient_chat_ids(roles=roles)
 
 
-def enqueue_notification(chat_ids, message):
-	"""Helper function to enqueue notifications for a list of chat_ids."""
+def enqueue_notification(chat_ids, message, event_type=None, reference=None):
+	"""Queues `message` for each chat_id.
+
+	Queued messages are written to the NotificationOutbox by the transaction that queued them, right
+	before it commits, and delivered in bulk by `drain_notification_outbox` afterwards; a rollback
+	discards them. Messages of digestable `event_type`s are buffered per chat instead and sent later
+	as one summary (see `notification_digest`). Pass the triggering document as `reference` so the
+	idempotency key of the message stays stable.
+	"""
+	pending = _get_pending_notifications()
 	for chat_id in chat_ids:
 		if chat_id:
-			frappe.enqueue(
-				"ferum_custom.notifications.send_telegram_notification_via_fastapi",
-				chat_id=chat_id,
-				message=message,
+			pending.append(
+				{
+					"chat_id": chat_id,
+					"text": message,
+					"event_type": event_type,
+					"idempotency_key": make_idempotency_key(chat_id, message, event_type, reference),
+				}
 			)
 
 
+def make_idempotency_key(chat_id, message, event_type=None, reference=None):
+	"""Same document version, event, chat and text always produce the same key."""
+	if reference is not None:
+		basis = f"{reference.doctype}|{reference.name}|{reference.modified}"
+	else:
+		basis = frappe.generate_hash()
+	return hashlib.sha256(f"{basis}|{event_type}|{chat_id}|{message}".encode()).hexdigest()
+
+
+def write_pending_notifications_to_outbox():
+	"""before_commit callback: persists the queued notifications inside the committing transaction."""
+	pending = getattr(frappe.local, "ferum_pending_notifications", None)
+	frappe.local.ferum_pending_notifications = None
+	settings = get_settings()
+	if not pending or not settings.enable_telegram_notifications:
+		return
+
+	run_digest = getattr(frappe.local, "ferum_notification_digest", None)
+	messages, digested = [], []
+	for message in pending:
+		if _is_digestable(message["event_type"], settings) and (
+			run_digest is not None or settings.enable_notification_digest
+		):
+			digested.append(message)
+		else:
+			messages.append(message)
+
+	if run_digest is not None:
+		for message in digested:
+			run_digest.setdefault(message["chat_id"], []).append(message["text"])
+	elif digested:
+		frappe.db.after_commit.add(lambda: _buffer_digest_messages(digested))
+
+	if messages:
+		_insert_outbox_rows(messages)
+		frappe.db.after_commit.add(enqueue_outbox_drain)
+
+
+def enqueue_outbox_drain():
+	frappe.enqueue(
+		"ferum_custom.notifications.drain_notification_outbox",
+		queue="short",
+		job_id=OUTBOX_DRAIN_JOB_ID,
+		deduplicate=True,
+	)
+
+
+def drain_notification_outbox():
+	"""Background job: delivers pending outbox entries in bulk.
+
+	Each batch is claimed with SKIP LOCKED and marked Queued in a short transaction of its own, so
+	concurrent drainers never pick the same rows and no lock is held while messages are sent (or
+	retries wait). The outcome is recorded once sending is done. Rows whose outcome never arrives,
+	because the drain died or the async worker did not acknowledge them (see
+	`acknowledge_worker_deliveries`), are claimed again once their lease expires and redelivered
+	with their original idempotency keys, which the backend deduplicates.
+	"""
+	totals = {"sent": 0, "failed": 0, "retried": 0}
+	settings = get_settings()
+	if not settings.enable_telegram_notifications:
+		return totals
+
+	while True:
+		rows = frappe.db.sql(
+			"""
+			select name, chat_id, message, idempotency_key, attempts
+			from `tabNotificationOutbox`
+			where status = 'Pending' or (status = 'Queued' and modified < %(lease)s)
+			order by creation
+			limit %(limit)s
+			for update skip locked
+			""",
+			{
+				"lease": add_to_date(now_datetime(), minutes=-OUTBOX_QUEUED_LEASE_MINUTES),
+				"limit": OUTBOX_BATCH_SIZE,
+			},
+			as_dict=True,
+		)
+		if not rows:
+			break
+		_mark_outbox_rows(rows, [True] * len(rows), "Queued")
+		frappe.db.commit()
+
+		messages = [
+			{"chat_id": row.chat_id, "text": row.message, "idempotency_key": row.idempotency_key}
+			for row in rows
+		]
+		if settings.notification_delivery_mode == "Async Worker":
+			for row, message in zip(rows, messages, strict=True):
+				message["outbox"] = row.name
+			push_to_worker_queue(messages)
+			delivered = [True] * len(rows)
+			totals["sent"] += len(rows)
+		else:
+			stats, delivered = deliver_telegram_messages(messages)
+			for key in totals:
+				totals[key] += stats[key]
+			_mark_outbox_rows(rows, delivered, "Sent")
+			frappe.db.commit()
+
+		if not all(delivered):
+			# Backend trouble: leave the rest for the next scheduled drain
+			break
+
+	return totals
+
+
+def clear_old_outbox_entries():
+	"""Scheduler job: removes delivered outbox entries past the retention period."""
+	frappe.db.delete(
+		"NotificationOutbox",
+		{
+			"status": "Sent",
+			"modified": ["<", add_days(now_datetime(), -OUTBOX_RETENTION_DAYS)],
+		},
+	)
+
+
+def acknowledge_worker_deliveries(outcomes):
+	"""Called by the async worker with `(outbox name, delivered)` pairs once it is done with them.
+
+	Delivered rows become Sent; rows the worker gave up on go back to Pending (or Failed after
+	MAX_OUTBOX_ATTEMPTS) and are redelivered by the next drain.
+	"""
+	if outcomes:
+		_mark_outbox_rows(
+			[frappe._dict(name=name) for name, _delivered in outcomes],
+			[delivered for _name, delivered in outcomes],
+			"Sent",
+		)
+		frappe.db.commit()
+
+
+def push_to_worker_queue(messages):
+	"""Appends messages to the site's notification queue in one round trip."""
+	cache = frappe.cache()
+	key = cache.make_key(NOTIFICATION_QUEUE_KEY)
+	pipeline = cache.pipeline()
+	for message in messages:
+		pipeline.rpush(key, json.dumps(message))
+	pipeline.execute()
+
+
+def _insert_outbox_rows(messages):
+	now = now_datetime()
+	user = frappe.session.user
+	values = [
+		(
+			frappe.generate_hash(length=16),
+			now,
+			now,
+			user,
+			user,
+			message["chat_id"],
+			message["text"],
+			message["event_type"],
+			message["idempotency_key"],
+			"Pending",
+			0,
+		)
+		for message in messages
+	]
+	frappe.db.bulk_insert(
+		"NotificationOutbox",
+		[
+			"name",
+			"creation",
+			"modified",
+			"owner",
+			"modified_by",
+			"chat_id",
+			"message",
+			"event_type",
+			"idempotency_key",
+			"status",
+			"attempts",
+		],
+		values,
+		ignore_duplicates=True,
+	)
+
+
+def _mark_outbox_rows(rows, delivered, status):
+	now = now_datetime()
+	sent = [row.name for row, ok in zip(rows, delivered, strict=True) if ok]
+	failed = [row.name for row, ok in zip(rows, delivered, strict=True) if not ok]
+	if sent:
+		frappe.db.sql(
+			"""update `tabNotificationOutbox`
+			set status = %(status)s, modified = %(now)s, sent_on = if(%(status)s = 'Sent', %(now)s, null)
+			where name in %(names)s""",
+			{"status": status, "now": now, "names": sent},
+		)
+	if failed:
+		# MariaDB applies SET assignments left to right, so the status check sees the new attempt count
+		frappe.db.sql(
+			"""update `tabNotificationOutbox`
+			set attempts = attempts + 1, modified = %(now)s,
+				status = if(attempts >= %(max_attempts)s, 'Failed', 'Pending')
+			where name in %(names)s""",
+			{"now": now, "names": failed, "max_attempts": MAX_OUTBOX_ATTEMPTS},
+		)
+
+
+def _discard_pending_notifications():
+	frappe.local.ferum_pending_notifications = None
+
+
+def _get_pending_notifications():
+	pending = getattr(frappe.local, "ferum_pending_notifications", None)
+	if pending is None:
+		pending = frappe.local.ferum_pending_notifications = []
+		frappe.db.before_commit.add(write_pending_notifications_to_outbox)
+		frappe.db.after_rollback.add(_discard_pending_notifications)
+	return pending
+
+
+@contextmanager
+def notification_digest():
+	"""Folds digestable notifications committed inside the block into one summary per chat.
+
+	Meant for bursty jobs such as the maintenance scheduler; the summaries are queued like any other
+	notification and go out with the next commit.
+	"""
+	frappe.local.ferum_notification_digest = {}
+	try:
+		yield
+	finally:
+		buffered = frappe.local.ferum_notification_digest
+		frappe.local.ferum_notification_digest = None
+
+		# Events of the block that are not committed yet still belong to this digest
+		pending = getattr(frappe.local, "ferum_pending_notifications", None)
+		if pending:
+			settings = get_settings()
+			for message in pending:
+				if _is_digestable(message["event_type"], settings):
+					buffered.setdefault(message["chat_id"], []).append(message["text"])
+			pending[:] = [m for m in pending if not _is_digestable(m["event_type"], settings)]
+
+		for chat_id, lines in buffered.items():
+			enqueue_notification([chat_id], format_digest(lines), event_type="digest")
+
+
+def send_notification_digests():
+	"""Scheduler job: sends the summary of every chat whose digest window has elapsed."""
+	settings = get_settings()
+	cache = frappe.cache()
+	chats_key = cache.make_key(DIGEST_CHATS_KEY)
+	cutoff = time.time() - settings.notification_digest_window * 60
+
+	for chat_id in cache.zrangebyscore(chats_key, "-inf", cutoff):
+		chat_id = frappe.safe_decode(chat_id)
+		pipeline = cache.pipeline()
+		buffer_key = cache.make_key(f"{DIGEST_BUFFER_KEY}:{chat_id}")
+		pipeline.lrange(buffer_key, 0, -1)
+		pipeline.delete(buffer_key)
+		pipeline.zrem(chats_key, chat_id)
+		lines = pipeline.execute()[0]
+		if lines:
+			enqueue_notification([chat_id], format_digest([frappe.safe_decode(l) for l in lines]), "digest")
+
+
+def format_digest(lines):
+	"""Builds one compact message out of buffered notification lines."""
+	text = f"{len(lines)} notifications:\n" + "\n".join(f"• {line}" for line in lines[:DIGEST_MAX_LINES])
+	if len(lines) > DIGEST_MAX_LINES:
+		text += f"\n… and {len(lines) - DIGEST_MAX_LINES} more"
+	return text[:TELEGRAM_MAX_MESSAGE_LENGTH]
+
+
+def _is_digestable(event_type, settings):
+	return (
+		event_type is not None
+		and event_type not in IMMEDIATE_EVENT_TYPES
+		and event_type not in settings.digest_exempt_event_types
+	)
+
+
+def _buffer_digest_messages(messages):
+	cache = frappe.cache()
+	chats_key = cache.make_key(DIGEST_CHATS_KEY)
+	now = time.time()
+	pipeline = cache.pipeline()
+	for message in messages:
+		pipeline.rpush(cache.make_key(f"{DIGEST_BUFFER_KEY}:{message['chat_id']}"), message["text"])
+		pipeline.zadd(chats_key, {message["chat_id"]: now}, nx=True)
+	pipeline.execute()
+
+
 # --- DocType Notification Hooks ---
 
 
+def _status_changed(doc):
+	"""True only for a genuine status transition of an existing document (inserts have their own hooks)."""
+	before = doc.get_doc_before_save()
+	return before is not None and before.status != doc.status
+
+
 def notify_new_service_request(doc, method):
+	if doc.flags.skip_notifications:
+		# Bulk paths announce their documents with one aggregated message
+		return
 	message = f"New Service Request created: {doc.name} - {doc.title}. Status: {doc.status}. Priority: {doc.priority}."
 	chat_ids = get_chat_ids_for_roles(["Project Manager", "Office Manager"])
-	enqueue_notification(chat_ids, message)
+	event_type = "emergency_service_request" if doc.type == "Emergency" else "new_service_request"
+	enqueue_notification(chat_ids, message, event_type, reference=doc)
+
+
+def notify_new_service_requests_bulk(docs):
+	"""One message for many new ServiceRequests; emergencies are listed first and sent immediately."""
+	emergencies = [doc for doc in docs if doc.type == "Emergency"]
+	others = [doc for doc in docs if doc.type != "Emergency"]
+	lines = [f"{doc.name} - {doc.title} ({doc.priority or 'No priority'})" for doc in emergencies + others]
+	message = f"{len(docs)} new Service Requests created"
+	if emergencies:
+		message += f", {len(emergencies)} of them emergencies"
+	message += ":\n" + "\n".join(lines[:DIGEST_MAX_LINES])
+	if len(lines) > DIGEST_MAX_LINES:
+		message += f"\n… and {len(lines) - DIGEST_MAX_LINES} more"
+
+	event_type = "emergency_service_request" if emergencies else "new_service_request"
+	chat_ids = get_chat_ids_for_roles(["Project Manager", "Office Manager"])
+	enqueue_notification(chat_ids, message[:TELEGRAM_MAX_MESSAGE_LENGTH], event_type)
 
 
 def notify_service_request_status_change(doc, method):
+	if not _status_changed(doc):
+		return
 	message = f"Service Request {doc.name} status changed to {doc.status}. Title: {doc.title}."
-	chat_ids = set()
-	if doc.assigned_to:
-		chat_ids.add(get_chat_id_for_user(doc.assigned_to))
-	if doc.customer:
-		chat_ids.add(get_chat_id_for_customer(doc.customer))
-	enqueue_notification(list(chat_ids), message)
+	chat_ids = get_recipient_chat_ids(
+		users=[doc.assigned_to] if doc.assigned_to else None,
+		customers=[doc.customer] if doc.customer else None,
+	)
+	enqueue_notification(chat_ids, message, "service_request_status_change", reference=doc)
+
+
+def get_sla_breach_message(request):
+	return f"SLA for Service Request {request.name} has been breached! Title: {request.title}. Priority: {request.priority}. Due: {request.sla_deadline}"
+
+
+def notify_sla_breaches(requests):
+	"""Alerts managers and the assigned engineers about many breached ServiceRequests at once."""
+	manager_chat_ids = get_chat_ids_for_roles(["Project Manager", "Office Manager"])
+	for request in requests:
+		chat_ids = list(manager_chat_ids)
+		if request.assigned_to:
+			chat_ids.extend(c for c in resolve_chat_ids(users=[request.assigned_to]) if c not in chat_ids)
+		enqueue_notification(chat_ids, get_sla_breach_message(request), "sla_breach")
 
 
 def notify_new_service_report(doc, method):
 	message = f"New Service Report created: {doc.name} for Service Request {doc.service_request}. Status: {doc.status}."
 	chat_ids = get_chat_ids_for_roles(["Project Manager", "System Manager"])
-	enqueue_notification(chat_ids, message)
+	enqueue_notification(chat_ids, message, "new_service_report", reference=doc)
 
 
 def notify_service_report_status_change(doc, method):
 	message = f"Service Report {doc.name} status changed to {doc.status}. For Service Request {doc.service_request}."
 	chat_ids = get_chat_ids_for_roles(["Project Manager", "System Manager"])
-	enqueue_notification(chat_ids, message)
+	enqueue_notification(chat_ids, message, "service_report_status_change", reference=doc)
 
 
 def notify_new_invoice(doc, method):
 	message = f"New Invoice created: {doc.name} for {doc.counterparty_name}. Amount: {doc.amount}. Status: {doc.status}."
 	chat_ids = get_chat_ids_for_roles(["Accountant", "System Manager"])
-	enqueue_notification(chat_ids, message)
+	enqueue_notification(chat_ids, message, "new_invoice", reference=doc)
 
 
 def notify_invoice_status_change(doc, method):
+	if not _status_changed(doc):
+		return
 	message = f"Invoice {doc.name} status changed to {doc.status}. For {doc.counterparty_name}. Amount: {doc.amount}."
 	chat_ids = get_chat_ids_for_roles(["Accountant", "System Manager"])
-	enqueue_notification(chat_ids, message)
+	enqueue_notification(chat_ids, message, "invoice_status_change", reference=doc)
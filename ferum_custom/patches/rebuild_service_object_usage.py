@@ -0,0 +1,6 @@
+from ferum_custom.doctype.ServiceObject.service_object import rebuild_service_object_usage
+
+
+def execute():
+	# Backfills the ServiceObject usage counters, which are maintained incrementally from here on
+	rebuild_service_object_usage()
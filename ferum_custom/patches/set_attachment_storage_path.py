@@ -0,0 +1,10 @@
+import frappe
+
+
+def execute():
+	# Existing attachments with a site file keep it in the local tier; Drive-only ones have no stored file
+	frappe.db.sql(
+		"""update `tabCustomAttachment`
+		set storage_path = file_url, storage_tier = 'Local'
+		where ifnull(storage_path, '') = '' and file_url like '%%/files/%%' and file_url not like 'http%%'"""
+	)
@@ -0,0 +1,79 @@
+"""Read-only, cached view of the Ferum Settings singleton for hot code paths."""
+
+import time
+from dataclasses import dataclass, fields
+
+import frappe
+from frappe.utils import cint
+from frappe.utils.password import get_decrypted_password
+
+SETTINGS_DOCTYPE = "Ferum Settings"
+SETTINGS_CACHE_KEY = "ferum_settings_snapshot"
+
+# Saving Ferum Settings clears the site cache and this process' memo once the save commits;
+# other worker processes pick the change up once their memo expires.
+PROCESS_MEMO_TTL = 60
+
+_snapshots = {}  # site -> (expires_at, FerumSettingsSnapshot)
+_tokens = {}  # site -> decrypted FastAPI token
+
+
+@dataclass(frozen=True)
+class FerumSettingsSnapshot:
+	enable_telegram_notifications: bool = False
+	fastapi_url: str | None = None
+	fallback_telegram_chat_id: str | None = None
+	notification_delivery_mode: str = "Background Job"
+	enable_notification_digest: bool = False
+	notification_digest_window: int = 15
+	digest_exempt_event_types: tuple[str, ...] = ()
+
+	@property
+	def fastapi_jwt_token(self):
+		"""The decrypted FastAPI token, read on first use and memoised for the life of the snapshot."""
+		site = frappe.local.site
+		if site not in _tokens:
+			_tokens[site] = get_decrypted_password(
+				SETTINGS_DOCTYPE, SETTINGS_DOCTYPE, "fastapi_jwt_token", raise_exception=False
+			)
+		return _tokens[site]
+
+
+def get_settings():
+	"""Returns the current FerumSettingsSnapshot without touching the database in steady state."""
+	site = frappe.local.site
+	memo = _snapshots.get(site)
+	if memo and memo[0] > time.monotonic():
+		return memo[1]
+
+	values = frappe.cache().get_value(SETTINGS_CACHE_KEY)
+	if values is None:
+		values = _load_settings_values()
+		frappe.cache().set_value(SETTINGS_CACHE_KEY, values)
+
+	snapshot = FerumSettingsSnapshot(**values)
+	_snapshots[site] = (time.monotonic() + PROCESS_MEMO_TTL, snapshot)
+	_tokens.pop(site, None)
+	return snapshot
+
+
+def clear_settings_cache(doc=None, method=None):
+	frappe.cache().delete_value(SETTINGS_CACHE_KEY)
+	_snapshots.pop(frappe.local.site, None)
+	_tokens.pop(frappe.local.site, None)
+
+
+def _load_settings_values():
+	fieldnames = [f.name for f in fields(FerumSettingsSnapshot)]
+	row = frappe.db.get_value(SETTINGS_DOCTYPE, None, fieldnames, as_dict=True) or {}
+	return {
+		"enable_telegram_notifications": bool(cint(row.get("enable_telegram_notifications"))),
+		"fastapi_url": row.get("fastapi_url") or None,
+		"fallback_telegram_chat_id": row.get("fallback_telegram_chat_id") or None,
+		"notification_delivery_mode": row.get("notification_delivery_mode") or "Background Job",
+		"enable_notification_digest": bool(cint(row.get("enable_notification_digest"))),
+		"notification_digest_window": cint(row.get("notification_digest_window")) or 15,
+		"digest_exempt_event_types": tuple(
+			line.strip() for line in (row.get("digest_exempt_event_types") or "").splitlines() if line.strip()
+		),
+	}
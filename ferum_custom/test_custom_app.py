@@ -115,46 +115,256 @@ class TestMaintenanceSchedule(unittest.TestCase):
 		if not frappe.db.exists("DocType", "ServiceObject"):
 			frappe.get_doc({"doctype": "DocType", "name": "ServiceObject", "module": "Ferum Custom"}).insert()
 
-	@patch("frappe.utils.nowdate", return_value="2025-08-12")
-	@patch("frappe.new_doc")
-	@patch("frappe.get_list")
+	@patch("frappe.enqueue")
+	@patch("frappe.get_all", return_value=["MSCH-0001", "MSCH-0002", "MSCH-0003"])
+	@patch("ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule.GENERATION_SHARD_SIZE", 2)
+	@patch(
+		"ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule.nowdate",
+		return_value="2025-08-12",
+	)
+	def test_due_schedules_are_sharded_into_range_jobs(self, mock_nowdate, mock_get_all, mock_enqueue):
+		from ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule import (
+			generate_service_requests_from_schedule,
+		)
+
+		generate_service_requests_from_schedule()
+
+		ranges = [(c.kwargs["first"], c.kwargs["last"]) for c in mock_enqueue.call_args_list]
+		self.assertEqual(ranges, [("MSCH-0001", "MSCH-0002"), ("MSCH-0003", "MSCH-0003")])
+		self.assertTrue(all(c.kwargs["deduplicate"] for c in mock_enqueue.call_args_list))
+
+	@patch("frappe.db.set_global")
+	@patch("frappe.db.get_global", return_value=None)
 	@patch("frappe.db.commit")
-	def test_generate_service_requests_from_schedule(
-		self, mock_commit, mock_get_list, mock_new_doc, mock_nowdate
+	@patch("frappe.db.sql")
+	@patch("frappe.db.savepoint")
+	@patch("frappe.get_doc")
+	@patch("frappe.get_all")
+	@patch("frappe.cache")
+	def test_generate_for_schedule_range(
+		self,
+		mock_cache,
+		mock_get_all,
+		mock_get_doc,
+		mock_savepoint,
+		mock_sql,
+		mock_commit,
+		mock_get_global,
+		mock_set_global,
 	):
 		from ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule import (
-			generate_service_requests_from_schedule,
+			GENERATION_CHECKPOINT_KEY,
+			generate_for_schedule_range,
 		)
 
-		# Mock a schedule that is due today
-		mock_schedule = MagicMock()
-		mock_schedule.name = "MSCH-0001"
-		mock_schedule.customer = "Test Customer"
-		mock_schedule.service_project = "Test Project"
-		mock_schedule.next_due_date = "2025-08-12"
-		mock_schedule.end_date = None
-		mock_schedule.get.return_value = [
-			{"service_object": "SO-001", "description": "Item 1"},
-			{"service_object": "SO-002", "description": "Item 2"},
+		mock_cache.return_value.lock.return_value.acquire.return_value = True
+		schedules = [
+			frappe._dict(
+				name=f"MSCH-000{i}",
+				schedule_name=f"Schedule {i}",
+				customer="Test Customer",
+				service_project="Test Project",
+				frequency="Monthly",
+				end_date=None,
+				next_due_date="2025-08-12",
+			)
+			for i in (1, 2, 3)
+		]
+		items = [
+			frappe._dict(name=f"{schedule.name}-{n}", parent=schedule.name, service_object=f"SO-00{n}")
+			for schedule in schedules
+			for n in (1, 2)
+		]
+		# The first request already exists, e.g. from an earlier partial run
+		mock_get_all.side_effect = [
+			schedules,
+			items,
+			["maintenance:MSCH-0001:MSCH-0001-1:2025-08-12"],
+			[],
 		]
-		mock_get_list.return_value = [mock_schedule]
+		built = []
+		mock_get_doc.side_effect = lambda values: built.append(MagicMock(**values)) or built[-1]
 
-		# Mock new_doc to return a mock ServiceRequest
-		mock_sr = MagicMock()
-		mock_new_doc.return_value = mock_sr
+		generate_for_schedule_range("MSCH-0001", "MSCH-0003", today="2025-08-12", chunk_size=4)
 
-		generate_service_requests_from_schedule()
+		# Two queries prefetch everything, plus one idempotency-key lookup per chunk
+		self.assertEqual(mock_get_all.call_count, 4)
+		self.assertEqual([sr.insert.call_count for sr in built], [0, 1, 1, 1, 1, 1])
+		# Schedules 1-2 fill the first chunk, schedule 3 the second; one commit each plus the final one
+		self.assertEqual(mock_sql.call_count, 2)
+		self.assertEqual(mock_commit.call_count, 3)
+		checkpoint_key = f"{GENERATION_CHECKPOINT_KEY}:MSCH-0001"
+		checkpoints = [c.args for c in mock_set_global.call_args_list]
+		self.assertEqual(
+			checkpoints[0], (checkpoint_key, '{"run_date": "2025-08-12", "schedule": "MSCH-0002"}')
+		)
+		self.assertEqual(checkpoints[-1], (checkpoint_key, None))
+		mock_cache.return_value.lock.return_value.release.assert_called_once()
 
-		# Assertions
-		mock_get_list.assert_called_once_with(
-			"MaintenanceSchedule",
-			filters={"next_due_date": ["<=", "2025-08-12"], "docstatus": 0},
-			fields=["*"],
+	@patch("frappe.get_all")
+	@patch("frappe.cache")
+	def test_range_locked_by_another_worker_is_skipped(self, mock_cache, mock_get_all):
+		from ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule import generate_for_schedule_range
+
+		mock_cache.return_value.lock.return_value.acquire.return_value = False
+
+		generate_for_schedule_range("MSCH-0001", "MSCH-0003", today="2025-08-12")
+
+		mock_get_all.assert_not_called()
+
+	@patch("frappe.get_all", return_value=[])
+	@patch("frappe.db.get_global", return_value='{"run_date": "2025-08-12", "schedule": "MSCH-0002"}')
+	def test_interrupted_run_resumes_after_checkpoint(self, mock_get_global, mock_get_all):
+		from ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule import get_due_schedules
+
+		get_due_schedules("2025-08-12", "MSCH-0001", "MSCH-0009")
+
+		self.assertIn(["name", ">", "MSCH-0002"], mock_get_all.call_args.kwargs["filters"])
+
+	@patch("frappe.db.rollback")
+	@patch("ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule.remove_from_sla_timer_after_commit")
+	def test_rolled_back_schedule_drops_its_notifications_and_sla_timers(self, mock_remove, mock_rollback):
+		from ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule import _rollback_schedule
+
+		frappe.local.ferum_pending_notifications = [{"text": "earlier"}, {"text": "SR-1"}, {"text": "SR-2"}]
+		try:
+			inserted = [MagicMock(name="SR-1"), MagicMock(name="SR-2"), MagicMock(name="SR-3")]
+			inserted[0].name, inserted[1].name, inserted[2].name = "SR-1", "SR-2", None
+
+			_rollback_schedule("maintenance_msch_0001", 1, inserted)
+
+			mock_rollback.assert_called_once_with(save_point="maintenance_msch_0001")
+			self.assertEqual(frappe.local.ferum_pending_notifications, [{"text": "earlier"}])
+			mock_remove.assert_called_once_with(["SR-1", "SR-2"])
+		finally:
+			frappe.local.ferum_pending_notifications = None
+
+
+@skip_frappe
+class TestMaintenanceOccurrenceExpansion(unittest.TestCase):
+	def _schedule(self, frequency, next_due_date, catch_up_policy="Backfill", end_date=None):
+		return frappe._dict(
+			name="MSCH-0001",
+			frequency=frequency,
+			next_due_date=next_due_date,
+			catch_up_policy=catch_up_policy,
+			end_date=end_date,
 		)
-		self.assertEqual(mock_new_doc.call_count, 2)  # Two service requests should be created
-		self.assertEqual(mock_sr.save.call_count, 2)
-		self.assertEqual(mock_commit.call_count, 2)
-		mock_schedule.save.assert_called_once()  # Schedule should be updated
+
+	def test_backfill_returns_every_missed_occurrence(self):
+		from datetime import date
+
+		from ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule import expand_occurrences
+
+		occurrences = expand_occurrences([self._schedule("Weekly", "2025-07-22")], "2025-08-12")
+
+		self.assertEqual(
+			occurrences["MSCH-0001"],
+			([date(2025, 7, 22), date(2025, 7, 29), date(2025, 8, 5), date(2025, 8, 12)], date(2025, 8, 19)),
+		)
+
+	def test_collapse_returns_only_the_latest_occurrence(self):
+		from datetime import date
+
+		from ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule import expand_occurrences
+
+		occurrences = expand_occurrences([self._schedule("Daily", "2025-06-01", "Collapse")], "2025-08-12")
+
+		self.assertEqual(occurrences["MSCH-0001"], ([date(2025, 8, 12)], date(2025, 8, 13)))
+
+	def test_monthly_occurrences_keep_the_anchor_day_and_stop_at_end_date(self):
+		from datetime import date
+
+		from ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule import expand_occurrences
+
+		schedule = self._schedule("Monthly", "2025-01-31", end_date="2025-04-15")
+		occurrences = expand_occurrences([schedule], "2025-08-12")
+
+		self.assertEqual(
+			occurrences["MSCH-0001"],
+			([date(2025, 1, 31), date(2025, 2, 28), date(2025, 3, 31)], date(2025, 4, 30)),
+		)
+
+	def test_monthly_occurrences_return_to_the_start_day_after_a_clamped_due_date(self):
+		from datetime import date
+
+		from ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule import expand_occurrences
+
+		# An earlier run advanced the schedule started on the 31st to the clamped 28 February
+		schedule = self._schedule("Monthly", "2025-02-28")
+		schedule.start_date = "2025-01-31"
+		occurrences = expand_occurrences([schedule], "2025-04-15")
+
+		self.assertEqual(
+			occurrences["MSCH-0001"], ([date(2025, 2, 28), date(2025, 3, 31)], date(2025, 4, 30))
+		)
+
+
+@skip_frappe
+class TestMaintenanceForecast(unittest.TestCase):
+	@patch("frappe.get_all")
+	def test_visits_are_counted_per_week_and_group(self, mock_get_all):
+		from datetime import date
+
+		from ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule import build_maintenance_forecast
+
+		mock_get_all.side_effect = [
+			[
+				frappe._dict(
+					name="MSCH-0001",
+					customer="ACME",
+					service_project=None,
+					frequency="Weekly",
+					end_date=None,
+					next_due_date="2025-08-06",
+				),
+				frappe._dict(
+					name="MSCH-0002",
+					customer="Globex",
+					service_project=None,
+					frequency="Daily",
+					end_date="2025-08-20",
+					next_due_date="2025-08-13",
+				),
+			],
+			[
+				frappe._dict(parent="MSCH-0001", service_object="SO-001"),
+				frappe._dict(parent="MSCH-0001", service_object="SO-002"),
+				frappe._dict(parent="MSCH-0002", service_object="SO-003"),
+			],
+		]
+
+		# Weeks starting 2025-08-11, 08-18 and 08-25
+		forecast = build_maintenance_forecast(date(2025, 8, 11), 3, "customer")
+
+		self.assertEqual(forecast["weeks"], ["2025-08-11", "2025-08-18", "2025-08-25"])
+		self.assertEqual(
+			forecast["rows"],
+			[
+				{"customer": "Globex", "visits": [5, 3, 0], "total": 8},
+				{"customer": "ACME", "visits": [2, 2, 2], "total": 6},
+			],
+		)
+		self.assertEqual(forecast["totals"], [7, 5, 2])
+
+	@patch("ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule.build_maintenance_forecast")
+	@patch("frappe.has_permission", return_value=True)
+	def test_forecast_is_cached_until_a_schedule_changes(self, mock_has_permission, mock_build):
+		from ferum_custom.doctype.MaintenanceSchedule.maintenance_schedule import (
+			clear_forecast_cache,
+			get_maintenance_forecast,
+		)
+
+		clear_forecast_cache()
+		mock_build.return_value = {"weeks": [], "rows": [], "totals": []}
+
+		get_maintenance_forecast(weeks=4)
+		get_maintenance_forecast(weeks=4)
+		self.assertEqual(mock_build.call_count, 1)
+
+		clear_forecast_cache(frappe._dict(doctype="MaintenanceSchedule"), "on_update")
+		get_maintenance_forecast(weeks=4)
+		self.assertEqual(mock_build.call_count, 2)
 
 
 @skip_frappe
@@ -248,65 +458,720 @@ class TestCustomAttachment(unittest.TestCase):
 				}
 			).insert()
 
-	@patch("frappe.get_site_path", side_effect=lambda *args: os.path.join("mock_site_path", *args))
-	@patch("os.path.exists", return_value=True)
-	@patch("builtins.open", new_callable=unittest.mock.mock_open)
-	@patch("frappe.conf", new_callable=MagicMock)
-	@patch("google.oauth2.service_account.Credentials.from_service_account_file", new_callable=MagicMock)
-	@patch("googleapiclient.discovery.build", new_callable=MagicMock)
-	@patch("frappe.msgprint")
+	def _start_fake_drive(self, received=b""):
+		import json
+		import threading
+		from http.server import BaseHTTPRequestHandler, HTTPServer
+
+		self.drive = {"data": bytearray(received), "puts": []}
+		drive = self.drive
+
+		class FakeDrive(BaseHTTPRequestHandler):
+			def do_POST(self):
+				self.rfile.read(int(self.headers["Content-Length"]))
+				self.send_response(200)
+				self.send_header("Location", f"http://127.0.0.1:{self.server.server_port}/upload/session/1")
+				self.send_header("Content-Length", "0")
+				self.end_headers()
+
+			def do_PUT(self):
+				body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+				content_range = self.headers["Content-Range"].split(" ")[1]
+				span, total = content_range.split("/")
+				drive["puts"].append(content_range)
+				if span != "*" and int(span.split("-")[0]) == len(drive["data"]):
+					drive["data"].extend(body)
+				if len(drive["data"]) == int(total):
+					payload = json.dumps({"id": "drive-1", "webViewLink": "https://drive/drive-1"}).encode()
+					self.send_response(200)
+					self.send_header("Content-Length", str(len(payload)))
+					self.end_headers()
+					self.wfile.write(payload)
+					return
+				self.send_response(308)
+				if drive["data"]:
+					self.send_header("Range", f"bytes=0-{len(drive['data']) - 1}")
+				self.send_header("Content-Length", "0")
+				self.end_headers()
+
+			def log_message(self, *args):
+				pass
+
+		server = HTTPServer(("127.0.0.1", 0), FakeDrive)
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+		self.addCleanup(server.server_close)
+		self.addCleanup(server.shutdown)
+		return f"http://127.0.0.1:{server.server_port}"
+
+	def _make_file(self, size):
+		import tempfile
+
+		with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as f:
+			f.write(os.urandom(size))
+		self.addCleanup(os.remove, f.name)
+		return f.name
+
+	def test_upload_is_streamed_in_chunks(self):
+		import requests
+
+		from ferum_custom.doctype.CustomAttachment.custom_attachment import open_upload_session, upload_chunks
+
+		base_url = self._start_fake_drive()
+		path = self._make_file(600 * 1024)
+		session = requests.Session()
+		doc = frappe._dict(file_name="visit.mp4", google_drive_upload_session=None)
+
+		with patch.dict(frappe.conf, {"google_drive_api_base_url": base_url}):
+			session_url, offset, file = open_upload_session(session, doc, path)
+		file = upload_chunks(session, session_url, path, offset, chunk_size=256 * 1024)
+
+		self.assertEqual((session_url, offset), (f"{base_url}/upload/session/1", 0))
+		self.assertEqual(file["id"], "drive-1")
+		with open(path, "rb") as f:
+			self.assertEqual(bytes(self.drive["data"]), f.read())
+		self.assertEqual(len(self.drive["puts"]), 3)
+
+	def test_interrupted_upload_resumes_from_received_bytes(self):
+		import requests
+
+		from ferum_custom.doctype.CustomAttachment.custom_attachment import open_upload_session, upload_chunks
+
+		path = self._make_file(600 * 1024)
+		with open(path, "rb") as f:
+			already_received = f.read(256 * 1024)
+		base_url = self._start_fake_drive(received=already_received)
+		session = requests.Session()
+		doc = frappe._dict(file_name="visit.mp4", google_drive_upload_session=f"{base_url}/upload/session/1")
+
+		progress = []
+		session_url, offset, _file = open_upload_session(session, doc, path)
+		upload_chunks(session, session_url, path, offset, chunk_size=256 * 1024, on_progress=progress.append)
+
+		with open(path, "rb") as f:
+			self.assertEqual(bytes(self.drive["data"]), f.read())
+		# One status query, then only the two missing chunks
+		self.assertEqual(self.drive["puts"], ["*/614400", "262144-524287/614400", "524288-614399/614400"])
+		self.assertEqual(progress, [524288])
+
+	@patch("frappe.db.commit")
+	@patch("frappe.db.sql")
+	def test_claims_are_renewed_only_for_uploads_making_progress(self, mock_sql, mock_commit):
+		from ferum_custom.doctype.CustomAttachment.custom_attachment import _renew_upload_claims
+
+		progress = {"CA-0001": 1024, "CA-0002": 512}
+		renewed = _renew_upload_claims(["CA-0001", "CA-0002"], progress, {"CA-0001": 0, "CA-0002": 512})
+
+		self.assertEqual(mock_sql.call_args.args[1]["names"], ("CA-0001",))
+		self.assertEqual(renewed, {"CA-0001": 1024, "CA-0002": 512})
+		mock_commit.assert_called_once()
+
 	@patch("frappe.log_error")
-	def test_upload_to_google_drive(
+	@patch("frappe.db.commit")
+	@patch("frappe.db.bulk_update", create=True)
+	@patch("frappe.db.sql")
+	@patch("ferum_custom.doctype.CustomAttachment.custom_attachment.get_local_file_path")
+	@patch("ferum_custom.doctype.CustomAttachment.custom_attachment.get_drive_session")
+	def test_attachments_are_uploaded_by_a_pool_and_written_back_in_bulk(
 		self,
+		mock_get_drive_session,
+		mock_get_local_file_path,
+		mock_sql,
+		mock_bulk_update,
+		mock_commit,
 		mock_log_error,
-		mock_msgprint,
-		mock_build,
-		mock_credentials,
-		mock_open,
-		mock_exists,
-		mock_get_site_path,
 	):
+		from ferum_custom.doctype.CustomAttachment.custom_attachment import upload_attachments
+
+		session = mock_get_drive_session.return_value
+		session.post.return_value = MagicMock(status_code=200, headers={"Location": "https://drive/session"})
+		session.put.return_value = MagicMock(status_code=200)
+		session.put.return_value.json.return_value = {"id": "drive-1", "webViewLink": "https://drive/drive-1"}
+		path = self._make_file(1024)
+		mock_get_local_file_path.side_effect = lambda url: (
+			path if url != "/files/missing.jpg" else "/nonexistent"
+		)
+		mock_sql.return_value = [
+			frappe._dict(
+				name=f"CA-000{i}",
+				file_name=f"{i}.jpg",
+				file_url=f"/files/{i}.jpg",
+				google_drive_upload_session=None,
+			)
+			for i in range(1, 5)
+		] + [
+			frappe._dict(
+				name="CA-0005",
+				file_name="missing.jpg",
+				file_url="/files/missing.jpg",
+				google_drive_upload_session=None,
+			)
+		]
+
+		upload_attachments([f"CA-000{i}" for i in range(1, 6)])
+
+		claim, sessions, results = (c.args[1] for c in mock_bulk_update.call_args_list)
+		self.assertEqual(len(claim), 5)
+		self.assertEqual(len(sessions), 4)
+		self.assertEqual(
+			{name: values["google_drive_status"] for name, values in results.items()},
+			{
+				"CA-0001": "Uploaded",
+				"CA-0002": "Uploaded",
+				"CA-0003": "Uploaded",
+				"CA-0004": "Uploaded",
+				"CA-0005": "Failed",
+			},
+		)
+		self.assertEqual(session.put.call_count, 4)
+
+	def test_deletes_and_updates_are_sent_as_batch_requests(self):
+		from ferum_custom.doctype.CustomAttachment.custom_attachment import execute_drive_batch
+
+		service = MagicMock()
+		batches = []
+
+		def new_batch(callback):
+			batch = MagicMock()
+			batch.execute.side_effect = lambda: [
+				callback(
+					c.kwargs["request_id"],
+					None,
+					RuntimeError("boom") if c.kwargs["request_id"] == "3" else None,
+				)
+				for c in batch.add.call_args_list
+			]
+			batches.append(batch)
+			return batch
+
+		service.new_batch_http_request.side_effect = new_batch
+		calls = [("delete", f"file-{i}") for i in range(150)] + [("update", ("file-x", {"name": "x.jpg"}))]
+
+		errors = execute_drive_batch(service, calls)
+
+		self.assertEqual([b.add.call_count for b in batches], [100, 51])
+		self.assertEqual([i for i, e in enumerate(errors) if e], [3])
+		service.files.return_value.update.assert_called_once_with(
+			fileId="file-x", body={"name": "x.jpg"}, supportsAllDrives=True
+		)
+
+	@patch("frappe.db.exists", return_value=False)
+	@patch("ferum_custom.doctype.CustomAttachment.custom_attachment.queue_drive_operation")
+	@patch("ferum_custom.doctype.CustomAttachment.custom_attachment.GOOGLE_DRIVE_INTEGRATION_ENABLED", True)
+	def test_renamed_attachment_renames_its_drive_file(self, mock_queue_drive_operation, mock_exists):
 		from ferum_custom.doctype.CustomAttachment.custom_attachment import CustomAttachment
 
-		mock_build.return_value.files.return_value.create.return_value.execute.return_value = {
-			"id": "mock_drive_id",
-			"webViewLink": "mock_webview_link",
-		}
-		mock_credentials.from_service_account_file.return_value = MagicMock()
-		mock_open.return_value = MagicMock()
+		attachment = MagicMock(file_name="act-signed.pdf", google_drive_file_id="drive-a")
+		attachment.name = "CA-0001"
+		attachment.get_doc_before_save.return_value = frappe._dict(file_name="act.pdf")
+
+		CustomAttachment.rename_drive_file(attachment)
+		mock_queue_drive_operation.assert_called_once_with("update", ("drive-a", {"name": "act-signed.pdf"}))
+
+		# A Drive copy shared through deduplication keeps its name
+		mock_queue_drive_operation.reset_mock()
 		mock_exists.return_value = True
-		mock_get_site_path.return_value = "mock_file_path"
-		mock_msgprint.return_value = None
-		mock_log_error.return_value = None
-		frappe.conf.google_drive_folder_id = "mock_folder_id"
+		CustomAttachment.rename_drive_file(attachment)
+		mock_queue_drive_operation.assert_not_called()
 
-		attachment = CustomAttachment({"file_url": "/files/test.pdf", "file_name": "test.pdf"})
-		attachment.upload_to_google_drive()
+	@patch("frappe.enqueue")
+	def test_operations_of_one_transaction_run_in_one_job(self, mock_enqueue):
+		from ferum_custom.doctype.CustomAttachment import custom_attachment
 
-		self.assertEqual(attachment.google_drive_file_id, "mock_drive_id")
-		self.assertEqual(attachment.file_url, "mock_webview_link")
-		mock_msgprint.assert_called_once()
+		frappe.local.ferum_drive_operations = None
+		with (
+			patch.object(frappe.db, "after_commit", MagicMock()),
+			patch.object(frappe.db, "after_rollback", MagicMock()),
+		):
+			for i in range(50):
+				custom_attachment.queue_drive_operation("delete", f"file-{i}")
+			custom_attachment.queue_drive_operation("upload", "CA-0001")
+			custom_attachment.queue_drive_operation("update", ("file-x", {"name": "x.jpg"}))
+			custom_attachment._enqueue_pending_drive_operations()
+
+		mock_enqueue.assert_called_once()
+		self.assertEqual(len(mock_enqueue.call_args.kwargs["deletes"]), 50)
+		self.assertEqual(mock_enqueue.call_args.kwargs["uploads"], ["CA-0001"])
+		self.assertEqual(mock_enqueue.call_args.kwargs["updates"], [("file-x", {"name": "x.jpg"})])
+
+	@patch("ferum_custom.doctype.CustomAttachment.custom_attachment.build", create=True)
+	@patch("ferum_custom.doctype.CustomAttachment.custom_attachment.service_account", create=True)
+	@patch("ferum_custom.doctype.CustomAttachment.custom_attachment.GOOGLE_DRIVE_INTEGRATION_ENABLED", True)
+	def test_drive_client_is_cached_per_worker(self, mock_service_account, mock_build):
+		from ferum_custom.doctype.CustomAttachment import custom_attachment
+
+		key_path = self._make_file(10)
+		custom_attachment._drive_clients.clear()
+		with patch.dict(frappe.conf, {"google_drive_service_account_key_path": key_path}):
+			first = custom_attachment.get_drive_service()
+			second = custom_attachment.get_drive_service()
+
+		self.assertIs(first, second)
+		mock_service_account.Credentials.from_service_account_file.assert_called_once()
+		mock_build.assert_called_once()
 
-	@patch("frappe.conf", new_callable=MagicMock)
-	@patch("google.oauth2.service_account.Credentials.from_service_account_file", new_callable=MagicMock)
-	@patch("googleapiclient.discovery.build", new_callable=MagicMock)
-	@patch("frappe.msgprint")
 	@patch("frappe.log_error")
-	def test_delete_from_google_drive(
-		self, mock_log_error, mock_msgprint, mock_build, mock_credentials, mock_conf
+	@patch("frappe.db.commit")
+	@patch("frappe.db.bulk_update", create=True)
+	@patch("frappe.get_all")
+	@patch("frappe.db.sql")
+	@patch("ferum_custom.doctype.CustomAttachment.custom_attachment.get_local_file_path")
+	@patch("ferum_custom.doctype.CustomAttachment.custom_attachment.get_drive_session")
+	def test_duplicate_content_is_uploaded_once(
+		self,
+		mock_get_drive_session,
+		mock_get_local_file_path,
+		mock_sql,
+		mock_get_all,
+		mock_bulk_update,
+		mock_commit,
+		mock_log_error,
+	):
+		from ferum_custom.doctype.CustomAttachment.custom_attachment import upload_attachments
+
+		session = mock_get_drive_session.return_value
+		session.post.return_value = MagicMock(status_code=200, headers={"Location": "https://drive/session"})
+		session.put.return_value = MagicMock(status_code=200)
+		session.put.return_value.json.return_value = {"id": "drive-new", "webViewLink": "https://drive/new"}
+		mock_get_local_file_path.return_value = self._make_file(1024)
+		mock_get_all.return_value = [
+			frappe._dict(
+				name="hash-b", google_drive_file_id="drive-b", google_drive_web_link="https://drive/b"
+			)
+		]
+		mock_sql.return_value = [
+			frappe._dict(
+				name=name,
+				file_name=f"{name}.jpg",
+				file_url=f"/files/{name}.jpg",
+				content_hash=content_hash,
+				google_drive_upload_session=None,
+			)
+			for name, content_hash in (("CA-0001", "hash-a"), ("CA-0002", "hash-a"), ("CA-0003", "hash-b"))
+		]
+
+		upload_attachments(["CA-0001", "CA-0002", "CA-0003"])
+
+		_claim, _sessions, blobs, results = (c.args[1] for c in mock_bulk_update.call_args_list)
+		self.assertEqual(session.put.call_count, 1)
+		self.assertEqual(
+			blobs,
+			{"hash-a": {"google_drive_file_id": "drive-new", "google_drive_web_link": "https://drive/new"}},
+		)
+		self.assertEqual(
+			{name: values["google_drive_file_id"] for name, values in results.items()},
+			{"CA-0001": "drive-new", "CA-0002": "drive-new", "CA-0003": "drive-b"},
+		)
+
+	def test_content_hash_is_streamed(self):
+		import hashlib
+
+		from ferum_custom.doctype.AttachmentBlob import attachment_blob
+
+		path = self._make_file(3 * 1024 + 5)
+		with open(path, "rb") as f:
+			expected = hashlib.sha256(f.read()).hexdigest()
+
+		with patch.object(attachment_blob, "HASH_CHUNK_SIZE", 1024):
+			self.assertEqual(attachment_blob.get_content_hash(path), expected)
+
+	@patch("frappe.db.set_value")
+	@patch("frappe.db.rollback")
+	@patch("frappe.db.savepoint")
+	@patch("frappe.db.sql")
+	@patch("frappe.get_doc")
+	@patch("frappe.db.get_value")
+	def test_blob_created_concurrently_is_referenced(
+		self, mock_get_value, mock_get_doc, mock_sql, mock_savepoint, mock_rollback, mock_set_value
+	):
+		from ferum_custom.doctype.AttachmentBlob.attachment_blob import acquire_blob
+
+		blob = frappe._dict(file_url="/files/a.jpg", google_drive_file_id=None, google_drive_web_link=None)
+		mock_get_value.side_effect = [None, blob]
+		mock_get_doc.return_value.insert.side_effect = frappe.DuplicateEntryError
+
+		self.assertEqual(acquire_blob("hash-a", "/files/a-1.jpg", 10), blob)
+		mock_rollback.assert_called_once_with(save_point="acquire_blob")
+		self.assertIn("reference_count + 1", mock_sql.call_args.args[0])
+		mock_set_value.assert_not_called()
+
+	@patch("frappe.db.set_value")
+	@patch("frappe.db.savepoint")
+	@patch("frappe.get_doc")
+	@patch("frappe.db.get_value", return_value=None)
+	def test_new_blob_owns_the_file_record(
+		self, mock_get_value, mock_get_doc, mock_savepoint, mock_set_value
+	):
+		from ferum_custom.doctype.AttachmentBlob.attachment_blob import acquire_blob
+
+		self.assertEqual(acquire_blob("hash-a", "/files/a.jpg", 10).file_url, "/files/a.jpg")
+		mock_set_value.assert_called_once_with(
+			"File",
+			{"file_url": "/files/a.jpg"},
+			{
+				"attached_to_doctype": "AttachmentBlob",
+				"attached_to_name": "hash-a",
+				"attached_to_field": None,
+			},
+			update_modified=False,
+		)
+
+	@patch("frappe.db.delete")
+	@patch("ferum_custom.doctype.CustomAttachment.custom_attachment.get_local_file_path")
+	@patch("ferum_custom.doctype.CustomAttachment.custom_attachment.acquire_blob")
+	def test_duplicate_upload_is_discarded_for_the_stored_copy(
+		self, mock_acquire_blob, mock_get_local_file_path, mock_delete
 	):
 		from ferum_custom.doctype.CustomAttachment.custom_attachment import CustomAttachment
 
-		mock_build.return_value.files.return_value.delete.return_value.execute.return_value = None
-		mock_credentials.from_service_account_file.return_value = MagicMock()
-		mock_msgprint.return_value = None
-		mock_log_error.return_value = None
-		mock_conf.google_drive_folder_id = "mock_folder_id"
+		stored, duplicate = self._make_file(10), self._make_file(10)
+		mock_get_local_file_path.side_effect = lambda url: stored if url == "/files/a.jpg" else duplicate
+		mock_acquire_blob.return_value = frappe._dict(
+			file_url="/files/a.jpg", google_drive_file_id=None, google_drive_web_link=None
+		)
+		attachment = frappe._dict(file_url="/files/a-1.jpg")
 
-		attachment = CustomAttachment({"google_drive_file_id": "mock_drive_id", "file_name": "test.pdf"})
-		attachment.delete_from_google_drive()
+		with patch.object(frappe.db, "after_commit") as after_commit:
+			CustomAttachment.reference_content_blob(attachment)
 
-		mock_msgprint.assert_called_once()
+		self.assertEqual((attachment.file_url, attachment.storage_path), ("/files/a.jpg", "/files/a.jpg"))
+		mock_delete.assert_called_once_with("File", {"file_url": "/files/a-1.jpg"})
+		after_commit.add.assert_called_once()
+
+	@patch("frappe.delete_doc")
+	@patch("frappe.db.set_value")
+	@patch("frappe.db.get_value")
+	def test_blob_is_deleted_with_its_last_reference(self, mock_get_value, mock_set_value, mock_delete_doc):
+		from ferum_custom.doctype.AttachmentBlob.attachment_blob import release_blob
+
+		mock_get_value.return_value = frappe._dict(reference_count=2, google_drive_file_id="drive-a")
+		self.assertIsNone(release_blob("hash-a"))
+		mock_set_value.assert_called_once_with(
+			"AttachmentBlob", "hash-a", "reference_count", 1, update_modified=False
+		)
+		mock_delete_doc.assert_not_called()
+
+		mock_get_value.return_value = frappe._dict(reference_count=1, google_drive_file_id="drive-a")
+		self.assertEqual(release_blob("hash-a"), "drive-a")
+		mock_delete_doc.assert_called_once_with(
+			"AttachmentBlob", "hash-a", ignore_permissions=True, force=True
+		)
+
+	@patch("ferum_custom.doctype.CustomAttachment.custom_attachment.run_drive_operations")
+	@patch("frappe.db.get_value", return_value="mock_drive_id")
+	def test_delete_from_google_drive(self, mock_get_value, mock_run_drive_operations):
+		from ferum_custom.doctype.CustomAttachment.custom_attachment import delete_from_google_drive
+
+		delete_from_google_drive("CA-0001")
+
+		mock_run_drive_operations.assert_called_once_with(deletes=["mock_drive_id"])
+
+
+@skip_frappe
+class TestAttachmentStorage(unittest.TestCase):
+	def setUp(self):
+		import shutil
+		import tempfile
+
+		self.site = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.site)
+		patcher = patch("frappe.get_site_path", lambda *path: os.path.join(self.site, *path))
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def _write(self, path, content):
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "wb") as f:
+			f.write(content)
+		return path
+
+	def test_cache_evicts_least_recently_used_files(self):
+		from ferum_custom.doctype.CustomAttachment.attachment_storage import RemoteFileCache
+
+		cache = RemoteFileCache(os.path.join(self.site, "cache"), max_size=10)
+		fetches = []
+
+		def fetch(content, path):
+			fetches.append(content)
+			self._write(path, content)
+
+		first = cache.get("a", lambda path: fetch(b"aaaa", path))
+		second = cache.get("b", lambda path: fetch(b"bbbb", path))
+		os.utime(first, (1, 1))
+		os.utime(second, (2, 2))
+		self.assertEqual(cache.get("a", lambda path: fetch(b"aaaa", path)), first)
+		cache.get("c", lambda path: fetch(b"cccc", path))
+
+		self.assertEqual(fetches, [b"aaaa", b"bbbb", b"cccc"])
+		self.assertTrue(os.path.exists(first))
+		self.assertFalse(os.path.exists(second))
+
+	@patch("frappe.db.commit")
+	@patch("frappe.db.sql")
+	def test_expired_files_move_to_the_remote_tier(self, mock_sql, mock_commit):
+		from ferum_custom.doctype.CustomAttachment import attachment_storage
+
+		local_path = self._write(os.path.join(self.site, "private", "files", "act.pdf"), b"%PDF")
+		remote_root = os.path.join(self.site, "remote")
+		mock_sql.side_effect = [
+			[
+				("/private/files/act.pdf", "https://drive/act"),
+				("/private/files/gone.pdf", "https://drive/gone"),
+			],
+			None,
+			None,
+			None,
+		]
+		config = {
+			"attachment_remote_storage": {"backend": "directory", "root": remote_root},
+			"attachment_tiering_rules": [{"after_days": 30}],
+		}
+
+		with patch.dict(frappe.conf, config):
+			attachment_storage.apply_storage_tiering()
+
+		with open(os.path.join(remote_root, "private", "files", "act.pdf"), "rb") as f:
+			self.assertEqual(f.read(), b"%PDF")
+		self.assertFalse(os.path.exists(local_path))
+		select, remote_tier, missing_tier, files = mock_sql.call_args_list
+		# Only files whose attachments all link to Drive are picked
+		self.assertIn("like 'http%%'", select.args[0])
+		self.assertEqual((remote_tier.args[1]["tier"], missing_tier.args[1]["tier"]), ("Remote", "Missing"))
+		self.assertEqual(remote_tier.args[1]["paths"], ("/private/files/act.pdf",))
+		self.assertEqual(
+			files.args[1],
+			("/private/files/act.pdf", "https://drive/act", ("/private/files/act.pdf",)),
+		)
+
+	@patch("ferum_custom.doctype.CustomAttachment.attachment_storage.nowdate", return_value="2025-08-12")
+	def test_rules_are_evaluated_per_linked_doctype_of_each_reference(self, mock_nowdate):
+		from ferum_custom.doctype.CustomAttachment.attachment_storage import _get_tiering_cutoff
+
+		cutoff, values = _get_tiering_cutoff(
+			[{"after_days": 30, "linked_doctype": "ServiceReport"}, {"after_days": 90}]
+		)
+
+		self.assertEqual(
+			cutoff,
+			"(case ifnull(linked_doctype, '') when %(doctype_0)s then %(cutoff_0)s "
+			"else %(default_cutoff)s end)",
+		)
+		self.assertEqual(
+			(values["doctype_0"], str(values["cutoff_0"]), str(values["default_cutoff"])),
+			("ServiceReport", "2025-07-13", "2025-05-14"),
+		)
+
+	@patch("frappe.db.get_value")
+	def test_remote_files_are_served_from_the_cache(self, mock_get_value):
+		from ferum_custom.doctype.CustomAttachment import attachment_storage
+
+		self._write(os.path.join(self.site, "remote", "private", "files", "act.pdf"), b"%PDF")
+		mock_get_value.return_value = frappe._dict(
+			storage_path="/private/files/act.pdf", storage_tier="Remote", google_drive_file_id="drive-1"
+		)
+		remote = attachment_storage.FileSystemStorage(os.path.join(self.site, "remote"))
+
+		with (
+			patch.object(attachment_storage, "get_remote_storage", return_value=remote),
+			patch.object(remote, "download", wraps=remote.download) as mock_download,
+		):
+			first = attachment_storage.get_attachment_file_path("CA-0001")
+			second = attachment_storage.get_attachment_file_path("CA-0001")
+
+		self.assertEqual(first, second)
+		self.assertTrue(first.startswith(os.path.join(self.site, "attachment_cache")))
+		mock_download.assert_called_once()
+
+
+@skip_frappe
+class TestRequestPhotoVariants(unittest.TestCase):
+	def _make_photo(self, directory, name, size=(800, 400), orientation=None):
+		from PIL import Image
+
+		path = os.path.join(directory, name)
+		exif = Image.Exif()
+		if orientation:
+			exif[0x0112] = orientation
+		Image.new("RGB", size, "red").save(path, format="JPEG", exif=exif)
+		return path
+
+	def test_variants_are_resized_and_upright(self):
+		import tempfile
+
+		from PIL import Image
+
+		from ferum_custom.doctype.RequestPhotoAttachmentItem.request_photo_attachment_item import (
+			render_photo_variants,
+		)
+
+		with tempfile.TemporaryDirectory() as directory:
+			# Orientation 6: the camera was turned, so the stored landscape pixels display as portrait
+			source = self._make_photo(directory, "photo.jpg", size=(4000, 2000), orientation=6)
+			render_photo_variants(source, os.path.join(directory, "variants"), "abc")
+
+			with Image.open(os.path.join(directory, "variants", "abc-thumbnail.webp")) as thumbnail:
+				self.assertEqual((thumbnail.format, thumbnail.size), ("WEBP", (160, 320)))
+			with Image.open(os.path.join(directory, "variants", "abc-print.jpg")) as print_image:
+				self.assertEqual((print_image.format, print_image.size), ("JPEG", (800, 1600)))
+
+	def test_rows_with_new_photos_are_queued(self):
+		from ferum_custom.doctype.RequestPhotoAttachmentItem.request_photo_attachment_item import (
+			queue_photo_variants,
+		)
+
+		doc = MagicMock()
+		table_field = frappe._dict(fieldname="photos", options="RequestPhotoAttachmentItem")
+		doc.meta.get_table_fields.return_value = [table_field]
+		doc.get.return_value = [
+			frappe._dict(name="row-1", photo="/files/a.jpg", variant_source=None),
+			frappe._dict(name="row-2", photo="/files/b.jpg", variant_source="/files/b.jpg"),
+			frappe._dict(name="row-3", photo="/files/c.jpg", variant_source="/files/old.jpg"),
+		]
+
+		with patch("frappe.enqueue") as mock_enqueue:
+			queue_photo_variants(doc)
+
+		self.assertEqual(mock_enqueue.call_args.kwargs["names"], ["row-1", "row-3"])
+
+	def _photo_doc(self, *rows):
+		doc = MagicMock(doctype="ServiceRequest")
+		doc.name = "SR-1"
+		doc.meta.get_table_fields.return_value = [
+			frappe._dict(fieldname="photos", options="RequestPhotoAttachmentItem")
+		]
+		doc.get.return_value = [
+			frappe._dict(
+				photo=photo,
+				variant_source=source,
+				photo_thumbnail=f"/files/photo-variants/{content}-thumbnail.webp",
+				photo_preview=f"/files/photo-variants/{content}-preview.webp",
+				photo_print=f"/files/photo-variants/{content}-print.jpg",
+			)
+			for photo, source, content in rows
+		]
+		return doc
+
+	@patch("frappe.db.delete")
+	@patch("frappe.db.sql_list", create=True)
+	def test_variants_of_replaced_photos_are_released_once_unused(self, mock_sql_list, mock_delete):
+		from ferum_custom.doctype.RequestPhotoAttachmentItem.request_photo_attachment_item import (
+			release_photo_variants,
+		)
+
+		before = self._photo_doc(
+			("/files/a.jpg", "/files/a.jpg", "aaa"),
+			("/files/b.jpg", "/files/b.jpg", "bbb"),
+			("/files/c.jpg", "/files/c.jpg", "ccc"),
+		)
+		# b.jpg was replaced and waits for its new variants; c.jpg was removed
+		doc = self._photo_doc(
+			("/files/a.jpg", "/files/a.jpg", "aaa"), ("/files/new.jpg", "/files/b.jpg", "bbb")
+		)
+		doc.get_doc_before_save.return_value = before
+		# Another request still shows a photo with the content of c.jpg
+		mock_sql_list.return_value = ["/files/photo-variants/ccc-thumbnail.webp"]
+
+		with patch.object(frappe.db, "after_commit") as after_commit:
+			release_photo_variants(doc, "on_update")
+
+		self.assertEqual(
+			sorted(mock_sql_list.call_args.args[1]["urls"]),
+			["/files/photo-variants/bbb-thumbnail.webp", "/files/photo-variants/ccc-thumbnail.webp"],
+		)
+		self.assertEqual(
+			sorted(mock_delete.call_args.args[1]["file_url"][1]),
+			[
+				"/files/photo-variants/bbb-preview.webp",
+				"/files/photo-variants/bbb-print.jpg",
+				"/files/photo-variants/bbb-thumbnail.webp",
+			],
+		)
+		self.assertEqual(after_commit.add.call_count, 3)
+
+	@patch("frappe.db.commit")
+	@patch("frappe.db.bulk_update", create=True)
+	@patch("frappe.get_doc")
+	@patch("frappe.db.exists", return_value=False)
+	@patch("frappe.get_all")
+	def test_public_and_private_copies_get_their_own_variants(
+		self, mock_get_all, mock_exists, mock_get_doc, mock_bulk_update, mock_commit
+	):
+		import shutil
+		import tempfile
+		from concurrent.futures import ThreadPoolExecutor
+
+		from ferum_custom.doctype.RequestPhotoAttachmentItem import request_photo_attachment_item
+
+		directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, directory)
+		os.makedirs(os.path.join(directory, "files"))
+		os.makedirs(os.path.join(directory, "private", "files"))
+		source = self._make_photo(os.path.join(directory, "files"), "a.jpg")
+		shutil.copy(source, os.path.join(directory, "private", "files", "a.jpg"))
+		mock_get_all.return_value = [
+			frappe._dict(name="row-0", photo="/files/a.jpg"),
+			frappe._dict(name="row-1", photo="/private/files/a.jpg"),
+		]
+
+		with (
+			patch.object(
+				request_photo_attachment_item,
+				"get_local_file_path",
+				lambda url: os.path.join(directory, url.lstrip("/")),
+			),
+			patch.object(request_photo_attachment_item, "ProcessPoolExecutor", ThreadPoolExecutor),
+		):
+			request_photo_attachment_item.generate_photo_variants(["row-0", "row-1"])
+
+		updates = mock_bulk_update.call_args.args[1]
+		for name in ("row-0", "row-1"):
+			thumbnail = updates[name]["photo_thumbnail"]
+			self.assertTrue(os.path.exists(os.path.join(directory, thumbnail.lstrip("/"))), thumbnail)
+		self.assertTrue(updates["row-1"]["photo_thumbnail"].startswith("/private/files/"))
+		registered = [c.args[0] for c in mock_get_doc.call_args_list]
+		self.assertEqual(sorted(f["is_private"] for f in registered), [False] * 3 + [True] * 3)
+
+	@patch("frappe.db.commit")
+	@patch("frappe.db.bulk_update", create=True)
+	@patch("frappe.db.exists", return_value=True)
+	@patch("frappe.get_all")
+	def test_each_content_is_rendered_once(self, mock_get_all, mock_exists, mock_bulk_update, mock_commit):
+		import shutil
+		import tempfile
+		from concurrent.futures import ThreadPoolExecutor
+
+		from ferum_custom.doctype.RequestPhotoAttachmentItem import request_photo_attachment_item
+
+		directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, directory)
+		source = self._make_photo(directory, "a.jpg")
+		shutil.copy(source, os.path.join(directory, "copy-of-a.jpg"))
+		mock_get_all.return_value = [
+			frappe._dict(name=f"row-{i}", parent="SR-1", parenttype="ServiceRequest", photo=url)
+			for i, url in enumerate(("/files/a.jpg", "/files/copy-of-a.jpg", "/files/a.jpg"))
+		]
+
+		with (
+			patch.object(
+				request_photo_attachment_item,
+				"get_local_file_path",
+				lambda url: os.path.join(directory, url.replace("/files/", "")),
+			),
+			patch.object(request_photo_attachment_item, "ProcessPoolExecutor", ThreadPoolExecutor),
+			patch.object(
+				request_photo_attachment_item,
+				"render_photo_variants",
+				wraps=request_photo_attachment_item.render_photo_variants,
+			) as mock_render,
+		):
+			request_photo_attachment_item.generate_photo_variants(["row-0", "row-1", "row-2"])
+			# Already rendered content is served from the variant files
+			request_photo_attachment_item.generate_photo_variants(["row-0"])
+
+		mock_render.assert_called_once()
+		updates = mock_bulk_update.call_args_list[0].args[1]
+		self.assertEqual(len({values["photo_thumbnail"] for values in updates.values()}), 1)
+		self.assertEqual(updates["row-1"]["variant_source"], "/files/copy-of-a.jpg")
+		self.assertEqual(len(mock_bulk_update.call_args_list), 2)
 
 
 @skip_frappe
@@ -337,46 +1202,41 @@ class TestInvoiceStatusTransitions(unittest.TestCase):
 		from ferum_custom.doctype.Invoice.invoice import Invoice
 
 		# Test Draft -> Sent (with due_date)
-		mock_get_value.return_value = "Draft"
 		invoice = Invoice({"name": "INV-001", "status": "Sent", "due_date": "2025-08-15"})
-		invoice.is_new = MagicMock(return_value=False)
+		invoice._doc_before_save = Invoice({"name": "INV-001", "status": "Draft"})
 		invoice.validate_status_transitions()
 		mock_frappe_throw.assert_not_called()
 
 		# Test Sent -> Paid
-		mock_get_value.return_value = "Sent"
 		invoice = Invoice({"name": "INV-001", "status": "Paid", "amount": 100})
-		invoice.is_new = MagicMock(return_value=False)
+		invoice._doc_before_save = Invoice({"name": "INV-001", "status": "Sent"})
 		invoice.validate_status_transitions()
 		mock_frappe_throw.assert_not_called()
 
 		# Test Sent -> Overdue
-		mock_get_value.return_value = "Sent"
 		invoice = Invoice({"name": "INV-001", "status": "Overdue"})
-		invoice.is_new = MagicMock(return_value=False)
+		invoice._doc_before_save = Invoice({"name": "INV-001", "status": "Sent"})
 		invoice.validate_status_transitions()
 		mock_frappe_throw.assert_not_called()
 
 		# Test Overdue -> Paid
-		mock_get_value.return_value = "Overdue"
 		invoice = Invoice({"name": "INV-001", "status": "Paid", "amount": 100})
-		invoice.is_new = MagicMock(return_value=False)
+		invoice._doc_before_save = Invoice({"name": "INV-001", "status": "Overdue"})
 		invoice.validate_status_transitions()
 		mock_frappe_throw.assert_not_called()
 
 		# Test Draft -> Cancelled
-		mock_get_value.return_value = "Draft"
 		invoice = Invoice({"name": "INV-001", "status": "Cancelled"})
-		invoice.is_new = MagicMock(return_value=False)
+		invoice._doc_before_save = Invoice({"name": "INV-001", "status": "Draft"})
 		invoice.validate_status_transitions()
 		mock_frappe_throw.assert_not_called()
 
 		# Test Sent -> Cancelled
-		mock_get_value.return_value = "Sent"
 		invoice = Invoice({"name": "INV-001", "status": "Cancelled"})
-		invoice.is_new = MagicMock(return_value=False)
+		invoice._doc_before_save = Invoice({"name": "INV-001", "status": "Sent"})
 		invoice.validate_status_transitions()
 		mock_frappe_throw.assert_not_called()
+		mock_get_value.assert_not_called()  # old status comes from doc_before_save
 
 	@patch("frappe.db.get_value")
 	@patch("frappe.throw")
@@ -384,28 +1244,26 @@ class TestInvoiceStatusTransitions(unittest.TestCase):
 		from ferum_custom.doctype.Invoice.invoice import Invoice
 
 		# Test Draft -> Sent (without due_date)
-		mock_get_value.return_value = "Draft"
 		invoice = Invoice({"name": "INV-001", "status": "Sent", "due_date": None})
-		invoice.is_new = MagicMock(return_value=False)
+		invoice._doc_before_save = Invoice({"name": "INV-001", "status": "Draft"})
 		invoice.validate_status_transitions()
 		mock_frappe_throw.assert_called_with(unittest.mock.ANY)  # Should throw error
 		mock_frappe_throw.reset_mock()
 
 		# Test Sent -> Paid (zero amount)
-		mock_get_value.return_value = "Sent"
 		invoice = Invoice({"name": "INV-001", "status": "Paid", "amount": 0})
-		invoice.is_new = MagicMock(return_value=False)
+		invoice._doc_before_save = Invoice({"name": "INV-001", "status": "Sent"})
 		invoice.validate_status_transitions()
 		mock_frappe_throw.assert_called_with(unittest.mock.ANY)  # Should throw error
 		mock_frappe_throw.reset_mock()
 
 		# Test invalid arbitrary transition (e.g., Paid -> Sent)
-		mock_get_value.return_value = "Paid"
 		invoice = Invoice({"name": "INV-001", "status": "Sent"})
-		invoice.is_new = MagicMock(return_value=False)
+		invoice._doc_before_save = Invoice({"name": "INV-001", "status": "Paid"})
 		invoice.validate_status_transitions()
 		mock_frappe_throw.assert_called_with(unittest.mock.ANY)  # Should throw error
 		mock_frappe_throw.reset_mock()
+		mock_get_value.assert_not_called()
 
 
 @skip_frappe
@@ -621,5 +1479,908 @@ class TestInvoiceGoogleSheets(unittest.TestCase):
 		mock_frappe_throw.assert_called_once()
 
 
+@skip_frappe
+class TestNotificationBatching(unittest.TestCase):
+	def tearDown(self):
+		frappe.local.ferum_pending_notifications = None
+
+	@patch("frappe.enqueue")
+	@patch("frappe.db.bulk_insert")
+	@patch("ferum_custom.notifications.get_settings")
+	def test_transaction_writes_outbox_once_and_drains_after_commit(
+		self, mock_get_settings, mock_bulk_insert, mock_enqueue
+	):
+		from ferum_custom.notifications import (
+			enqueue_notification,
+			enqueue_outbox_drain,
+			write_pending_notifications_to_outbox,
+		)
+
+		mock_get_settings.return_value = MagicMock(
+			enable_telegram_notifications=True, enable_notification_digest=False, digest_exempt_event_types=()
+		)
+		invoice = MagicMock(doctype="Invoice", modified="2025-08-12 10:00:00")
+		invoice.name = "INV-001"
+		frappe.local.ferum_pending_notifications = None
+		with (
+			patch.object(frappe.db, "before_commit"),
+			patch.object(frappe.db, "after_rollback"),
+			patch.object(frappe.db, "after_commit") as mock_after_commit,
+		):
+			enqueue_notification(["100", "200"], "Invoice INV-001 created", "new_invoice", reference=invoice)
+			enqueue_notification(["100", None], "Invoice INV-001 created", "new_invoice", reference=invoice)
+			write_pending_notifications_to_outbox()
+
+		mock_bulk_insert.assert_called_once()
+		rows = mock_bulk_insert.call_args.args[2]
+		self.assertEqual(len(rows), 3)
+		# Same document version, chat and text -> same idempotency key, so the duplicate is ignored
+		self.assertEqual(rows[0][8], rows[2][8])
+		self.assertNotEqual(rows[0][8], rows[1][8])
+		self.assertTrue(mock_bulk_insert.call_args.kwargs["ignore_duplicates"])
+		mock_after_commit.add.assert_called_once_with(enqueue_outbox_drain)
+		mock_enqueue.assert_not_called()
+
+	@patch("ferum_custom.notifications.deliver_telegram_messages")
+	@patch("frappe.db.commit")
+	@patch("frappe.db.sql")
+	@patch("ferum_custom.notifications.get_settings")
+	def test_outbox_rows_are_claimed_and_committed_before_sending(
+		self, mock_get_settings, mock_sql, mock_commit, mock_deliver
+	):
+		from ferum_custom.notifications import drain_notification_outbox
+
+		mock_get_settings.return_value = MagicMock(
+			enable_telegram_notifications=True, notification_delivery_mode="Direct"
+		)
+		rows = [frappe._dict(name="NO-1", chat_id="1", message="hi", idempotency_key="k1", attempts=0)]
+		mock_sql.side_effect = [rows, None, None, []]
+		events = []
+		mock_commit.side_effect = lambda: events.append("commit")
+
+		def deliver(messages):
+			events.append("send")
+			return {"sent": 1, "failed": 0, "retried": 0}, [True]
+
+		mock_deliver.side_effect = deliver
+
+		self.assertEqual(drain_notification_outbox()["sent"], 1)
+
+		_select, claim, mark, _empty = mock_sql.call_args_list
+		self.assertEqual((claim.args[1]["status"], mark.args[1]["status"]), ("Queued", "Sent"))
+		# No row lock is held while the messages are sent
+		self.assertEqual(events, ["commit", "send", "commit"])
+
+	@patch("time.sleep")
+	def test_retry_after_is_capped(self, mock_sleep):
+		from ferum_custom.notifications import MAX_RETRY_DELAY_SECONDS, _post_with_retry
+
+		session = MagicMock()
+		session.post.side_effect = [
+			MagicMock(status_code=429, headers={"Retry-After": "86400"}),
+			MagicMock(status_code=200, headers={}),
+		]
+		stats = {"sent": 0, "failed": 0, "retried": 0}
+
+		self.assertEqual(_post_with_retry(session, "http://backend", {}, stats, 1).status_code, 200)
+		mock_sleep.assert_called_once_with(MAX_RETRY_DELAY_SECONDS)
+
+	@patch("ferum_custom.notifications.get_settings")
+	def test_digest_folds_bursty_events_but_not_emergencies(self, mock_get_settings):
+		from ferum_custom.notifications import enqueue_notification, notification_digest
+
+		mock_get_settings.return_value = MagicMock(digest_exempt_event_types=())
+		frappe.local.ferum_pending_notifications = None
+		with patch.object(frappe.db, "before_commit"), patch.object(frappe.db, "after_rollback"):
+			with notification_digest():
+				enqueue_notification(["100"], "SR-1 created", "new_service_request")
+				enqueue_notification(["100"], "SR-2 created", "new_service_request")
+				enqueue_notification(["100"], "SR-3 is an emergency", "emergency_service_request")
+
+		pending = frappe.local.ferum_pending_notifications
+		self.assertEqual([m["event_type"] for m in pending], ["emergency_service_request", "digest"])
+		self.assertEqual(pending[1]["text"], "2 notifications:\n• SR-1 created\n• SR-2 created")
+
+	@patch("time.sleep")
+	@patch("ferum_custom.notifications.get_settings")
+	def test_batch_is_sent_as_one_bulk_call_with_retry(self, mock_get_settings, mock_sleep):
+		from ferum_custom import notifications
+
+		mock_get_settings.return_value = MagicMock(
+			enable_telegram_notifications=True, fastapi_url="http://fastapi.local", fastapi_jwt_token="token"
+		)
+		session = MagicMock()
+		session.headers = {}
+		session.post.side_effect = [MagicMock(status_code=503, headers={}), MagicMock(status_code=200)]
+
+		with patch.object(notifications, "get_http_session", return_value=session):
+			stats = notifications.send_telegram_notifications(
+				[{"chat_id": "100", "text": "a"}, {"chat_id": "200", "text": "b"}]
+			)
+
+		self.assertEqual(stats, {"sent": 2, "failed": 0, "retried": 2})
+		self.assertEqual(session.post.call_count, 2)
+		self.assertEqual(
+			session.post.call_args.args[0], "http://fastapi.local/api/v1/send_telegram_notifications"
+		)
+		self.assertEqual(session.post.call_args.kwargs["timeout"], notifications.FASTAPI_TIMEOUT)
+
+
+@skip_frappe
+class TestFerumSettingsSnapshot(unittest.TestCase):
+	def tearDown(self):
+		from ferum_custom.settings import clear_settings_cache
+
+		clear_settings_cache()
+
+	def test_snapshot_is_memoised_until_settings_are_saved(self):
+		from ferum_custom import settings
+
+		settings.clear_settings_cache()
+		row = {"enable_telegram_notifications": 1, "fastapi_url": "http://fastapi.local"}
+		with patch("frappe.db.get_value", return_value=row) as mock_get_value:
+			first = settings.get_settings()
+			second = settings.get_settings()
+			settings.clear_settings_cache()
+			settings.get_settings()
+
+		self.assertIs(first, second)
+		self.assertTrue(first.enable_telegram_notifications)
+		self.assertIsNone(first.fallback_telegram_chat_id)
+		self.assertEqual(mock_get_value.call_count, 2)
+
+	def test_saving_settings_clears_the_cache_after_commit(self):
+		from ferum_custom.doctype.FerumSettings.ferum_settings import FerumSettings
+		from ferum_custom.settings import clear_settings_cache
+
+		with (
+			patch.object(frappe.db, "after_commit", MagicMock()) as mock_after_commit,
+			patch("frappe.cache") as mock_cache,
+		):
+			FerumSettings.on_update(MagicMock())
+
+		mock_after_commit.add.assert_called_once_with(clear_settings_cache)
+		mock_cache.return_value.delete_value.assert_not_called()
+
+
+@skip_frappe
+class TestTelegramChatIndex(unittest.TestCase):
+	def setUp(self):
+		self.index = {
+			"User": {"engineer@example.com": ["111"], "pm@example.com": ["222"]},
+			"Customer": {"ACME": ["333"]},
+			"Role": {"Accountant": ["444"]},
+			"role_members": {"Project Manager": ["pm@example.com"]},
+		}
+
+	def test_resolves_roles_users_and_customers_from_cache(self):
+		from ferum_custom.doctype.TelegramChatMapping.telegram_chat_mapping import resolve_chat_ids
+
+		with (
+			patch("frappe.cache") as mock_cache,
+			patch("frappe.get_all") as mock_get_all,
+		):
+			mock_cache.return_value.get_value.return_value = self.index
+			chat_ids = resolve_chat_ids(
+				users=["engineer@example.com"], customers=["ACME"], roles=["Project Manager", "Accountant"]
+			)
+
+		self.assertEqual(chat_ids, ["111", "333", "444", "222"])
+		mock_get_all.assert_not_called()
+
+	def test_user_role_change_updates_index_incrementally(self):
+		from ferum_custom.doctype.TelegramChatMapping.telegram_chat_mapping import on_user_update
+
+		user = MagicMock(enabled=1)
+		user.name = "pm@example.com"
+		user.get.return_value = [MagicMock(role="Accountant")]
+		after_commit = []
+		with (
+			patch("frappe.cache") as mock_cache,
+			patch.object(frappe.db, "after_commit", MagicMock()) as mock_after_commit,
+		):
+			mock_after_commit.add.side_effect = after_commit.append
+			mock_cache.return_value.get_value.return_value = self.index
+			on_user_update(user, "on_update")
+			# Nothing reaches the cache before the change commits
+			mock_cache.return_value.set_value.assert_not_called()
+			for callback in after_commit:
+				callback()
+
+		self.assertEqual(self.index["role_members"], {"Accountant": ["pm@example.com"]})
+		mock_cache.return_value.set_value.assert_called_once()
+		mock_cache.return_value.lock.assert_called_once()
+
+	def test_index_leaves_disabled_users_out_of_role_members(self):
+		from ferum_custom.doctype.TelegramChatMapping.telegram_chat_mapping import build_chat_index
+
+		def get_all(doctype, filters=None, **kwargs):
+			if doctype == "TelegramChatMapping":
+				return [
+					frappe._dict(reference_doctype="User", reference_name=user, chat_id=chat_id)
+					for user, chat_id in (("pm@example.com", "222"), ("left@example.com", "555"))
+				]
+			if doctype == "User":
+				return ["pm@example.com"]
+			self.assertEqual(filters["parent"], ["in", ["pm@example.com"]])
+			return [frappe._dict(parent="pm@example.com", role="Project Manager")]
+
+		with patch("frappe.cache"), patch("frappe.get_all", side_effect=get_all):
+			index = build_chat_index()
+
+		self.assertEqual(index["role_members"], {"Project Manager": ["pm@example.com"]})
+		self.assertEqual(index["User"]["left@example.com"], ["555"])
+
+	@patch("frappe.db.get_value", return_value=1)
+	@patch("frappe.get_roles", return_value=["Accountant", "All", "Guest"])
+	def test_new_user_mapping_takes_roles_like_a_rebuild(self, mock_get_roles, mock_get_value):
+		from ferum_custom.doctype.TelegramChatMapping.telegram_chat_mapping import _apply_chat_index_update
+
+		def get_all(doctype, filters=None, **kwargs):
+			if doctype == "TelegramChatMapping":
+				return ["666"]
+			return [frappe._dict(parent="new@example.com", role="Accountant")]
+
+		with patch("frappe.cache") as mock_cache, patch("frappe.get_all", side_effect=get_all):
+			mock_cache.return_value.get_value.return_value = self.index
+			_apply_chat_index_update("User", "new@example.com")
+
+		# The automatic roles "All" and "Guest" never enter the index
+		self.assertEqual(
+			self.index["role_members"],
+			{"Project Manager": ["pm@example.com"], "Accountant": ["new@example.com"]},
+		)
+		mock_get_roles.assert_not_called()
+
+
+@skip_frappe
+class TestNotificationWorker(unittest.TestCase):
+	def setUp(self):
+		import json
+		import threading
+		from http.server import BaseHTTPRequestHandler, HTTPServer
+
+		self.received = []
+		received = self.received
+
+		class FakeFastAPI(BaseHTTPRequestHandler):
+			def do_POST(self):
+				body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+				received.append(body)
+				if len(received) == 1:
+					# Rate limit the very first call
+					self.send_response(429)
+					self.send_header("Retry-After", "1")
+				else:
+					self.send_response(200)
+				self.send_header("Content-Length", "0")
+				self.end_headers()
+
+			def log_message(self, *args):
+				pass
+
+		self.server = HTTPServer(("127.0.0.1", 0), FakeFastAPI)
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def test_worker_drains_queue_and_honours_retry_after(self):
+		import asyncio
+		import time
+
+		from ferum_custom.notification_worker import NotificationWorker
+
+		worker = NotificationWorker(f"http://127.0.0.1:{self.server.server_port}", "token", concurrency=4)
+		messages = [{"chat_id": str(chat), "text": "hello", "outbox": f"NO-{chat}"} for chat in range(5)]
+		acknowledged = []
+
+		async def main():
+			stop_event = asyncio.Event()
+
+			async def fetch():
+				if messages:
+					batch = messages[:]
+					messages.clear()
+					return batch
+				stop_event.set()
+				return []
+
+			await worker.run(fetch, stop_event, acknowledged.extend)
+
+		started_at = time.monotonic()
+		asyncio.run(main())
+
+		stats = worker.stats.as_dict()
+		self.assertEqual(stats["sent"], 5)
+		self.assertEqual(stats["rate_limited"], 1)
+		self.assertEqual(len(self.received), 6)
+		self.assertGreaterEqual(time.monotonic() - started_at, 1)
+		self.assertIsNotNone(stats["latency_p95"])
+		# Every message is acknowledged once it is done
+		self.assertEqual(
+			sorted((message["outbox"], ok) for message, ok in acknowledged),
+			[(f"NO-{chat}", True) for chat in range(5)],
+		)
+
+	@patch("frappe.db.commit")
+	@patch("frappe.db.sql")
+	def test_outbox_rows_stay_open_until_the_worker_acknowledges_them(self, mock_sql, mock_commit):
+		from ferum_custom.notification_worker import acknowledge_outbox_messages
+
+		acknowledge_outbox_messages(
+			[({"outbox": "NO-1"}, True), ({"outbox": "NO-2"}, False), ({"chat_id": "1"}, True)]
+		)
+
+		sent, failed = mock_sql.call_args_list
+		self.assertEqual((sent.args[1]["status"], sent.args[1]["names"]), ("Sent", ["NO-1"]))
+		# Messages the worker gave up on go back to the outbox for redelivery
+		self.assertIn("'Pending'", failed.args[0])
+		self.assertEqual(failed.args[1]["names"], ["NO-2"])
+		mock_commit.assert_called_once()
+
+
+@skip_frappe
+class TestStatusChangeNotifications(unittest.TestCase):
+	@patch("ferum_custom.notifications.enqueue_notification")
+	@patch("ferum_custom.notifications.get_recipient_chat_ids", return_value=["100"])
+	def test_only_real_transitions_notify(self, mock_get_chat_ids, mock_enqueue_notification):
+		from ferum_custom.notifications import notify_service_request_status_change
+
+		doc = MagicMock(status="In Progress", assigned_to="engineer@example.com", customer=None)
+		doc.get_doc_before_save.return_value = MagicMock(status="In Progress")
+		notify_service_request_status_change(doc, "on_update")
+		mock_enqueue_notification.assert_not_called()
+
+		doc.get_doc_before_save.return_value = None  # insert
+		notify_service_request_status_change(doc, "on_update")
+		mock_enqueue_notification.assert_not_called()
+
+		doc.get_doc_before_save.return_value = MagicMock(status="Open")
+		notify_service_request_status_change(doc, "on_update")
+		mock_enqueue_notification.assert_called_once()
+
+	def test_timestamps_are_stamped_without_extra_save(self):
+		from ferum_custom.doctype.ServiceRequest.service_request import ServiceRequest
+
+		sr = ServiceRequest(
+			{"doctype": "ServiceRequest", "status": "In Progress", "actual_start_datetime": None}
+		)
+		sr.save = MagicMock()
+		sr.update_timestamps()
+
+		self.assertIsNotNone(sr.actual_start_datetime)
+		sr.save.assert_not_called()
+
+
+@skip_frappe
+class TestWorkflowEngine(unittest.TestCase):
+	def test_transition_table_lookup(self):
+		from ferum_custom.workflow import get_transition_error
+
+		doc = frappe._dict(assigned_to=None)
+		self.assertIsNotNone(get_transition_error("ServiceRequest", "Open", "In Progress", doc, []))
+		doc.assigned_to = "engineer@example.com"
+		self.assertIsNone(get_transition_error("ServiceRequest", "Open", "In Progress", doc, []))
+		self.assertIsNotNone(get_transition_error("ServiceRequest", "Completed", "Closed", doc, ["Guest"]))
+		self.assertIsNone(
+			get_transition_error("ServiceRequest", "Completed", "Closed", doc, ["System Manager"])
+		)
+		self.assertIsNotNone(get_transition_error("ServiceReport", "Approved", "Draft", doc, []))
+
+	@patch("frappe.get_doc")
+	@patch("frappe.get_roles", return_value=["System Manager"])
+	@patch("frappe.get_all")
+	def test_bulk_transition_validates_all_before_saving(self, mock_get_all, mock_get_roles, mock_get_doc):
+		from ferum_custom.workflow import bulk_transition
+
+		mock_get_all.return_value = [
+			frappe._dict(name="INV-001", status="Sent", amount=100),
+			frappe._dict(name="INV-002", status="Draft", amount=50),
+		]
+		with self.assertRaises(frappe.ValidationError):
+			bulk_transition("Invoice", ["INV-001", "INV-002"], "Paid")
+
+		mock_get_all.assert_called_once_with(
+			"Invoice", filters={"name": ["in", ["INV-001", "INV-002"]]}, fields=["name", "status", "amount"]
+		)
+		mock_get_doc.assert_not_called()
+
+
+@skip_frappe
+class TestSLASweep(unittest.TestCase):
+	@patch("ferum_custom.doctype.ServiceRequest.service_request.notify_sla_breaches")
+	@patch("frappe.log_error")
+	@patch("frappe.db.sql")
+	def test_sweep_marks_and_alerts_new_breaches_in_bulk(
+		self, mock_sql, mock_log_error, mock_notify_sla_breaches
+	):
+		from ferum_custom.doctype.ServiceRequest.service_request import check_all_slas
+
+		breached = [
+			frappe._dict(
+				name="SR-001",
+				title="Leak",
+				priority="High",
+				sla_deadline="2025-08-12 10:00:00",
+				is_breached=1,
+			),
+			frappe._dict(
+				name="SR-002",
+				title="Noise",
+				priority="Low",
+				sla_deadline="2025-08-11 10:00:00",
+				is_breached=1,
+			),
+		]
+		mock_sql.side_effect = [breached, None]
+
+		self.assertEqual(check_all_slas(), 2)
+
+		claim, mark = mock_sql.call_args_list
+		# Rows held by an overlapping sweep are skipped rather than alerted twice
+		self.assertIn("sla_breached_at is null", claim.args[0])
+		self.assertIn("for update skip locked", claim.args[0])
+		self.assertEqual(mark.args[1]["names"], ["SR-001", "SR-002"])
+		mock_notify_sla_breaches.assert_called_once_with(breached)
+		mock_log_error.assert_called_once()
+
+	@patch("ferum_custom.doctype.ServiceRequest.service_request.remove_from_sla_timer_after_commit")
+	@patch("frappe.get_all", return_value=["SR-003"])
+	@patch("ferum_custom.doctype.ServiceRequest.service_request._sweep_sla_breaches")
+	@patch("frappe.cache")
+	def test_timer_tick_only_sweeps_due_requests(self, mock_cache, mock_sweep, mock_get_all, mock_remove):
+		from ferum_custom.doctype.ServiceRequest.service_request import check_due_sla_deadlines
+
+		cache = mock_cache.return_value
+		cache.zrangebyscore.return_value = []
+		self.assertEqual(check_due_sla_deadlines(), 0)
+		mock_sweep.assert_not_called()
+
+		cache.zrangebyscore.return_value = [b"SR-001", b"SR-002", b"SR-003", b"SR-004"]
+		mock_sweep.return_value = [
+			frappe._dict(name="SR-001", is_breached=1),
+			frappe._dict(name="SR-002", is_breached=0),
+		]
+		self.assertEqual(check_due_sla_deadlines(), 1)
+		mock_sweep.assert_called_once_with(["SR-001", "SR-002", "SR-003", "SR-004"])
+		# SR-003 is held by another transaction and stays due; SR-004 was deleted
+		mock_remove.assert_called_once_with(["SR-001", "SR-002", "SR-004"])
+
+	@patch("frappe.cache")
+	def test_timer_changes_wait_for_the_commit(self, mock_cache):
+		from ferum_custom.doctype.ServiceRequest.service_request import update_sla_timer
+
+		doc = frappe._dict(
+			name="SR-001", status="Open", sla_deadline="2025-08-12 10:00:00", sla_breached_at=None
+		)
+		with patch.object(frappe.db, "after_commit") as after_commit:
+			update_sla_timer(doc)
+			mock_cache.return_value.zadd.assert_not_called()
+			after_commit.add.call_args.args[0]()
+
+		mock_cache.return_value.zadd.assert_called_once()
+
+	@patch("frappe.db.sql", return_value=[])
+	@patch("frappe.get_doc")
+	def test_sweep_without_breaches_loads_no_documents(self, mock_get_doc, mock_sql):
+		from ferum_custom.doctype.ServiceRequest.service_request import check_all_slas
+
+		self.assertEqual(check_all_slas(), 0)
+		mock_get_doc.assert_not_called()
+
+
+@skip_frappe
+class TestSLACalendar(unittest.TestCase):
+	def compile(self, holidays=()):
+		from ferum_custom.doctype.SLACalendar.sla_calendar import compile_calendar
+
+		working_hours = [
+			frappe._dict(weekday=day, start_time="09:00:00", end_time="18:00:00")
+			for day in ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday")
+		]
+		with patch("frappe.get_all", side_effect=[working_hours, list(holidays)]):
+			return compile_calendar("Office Hours", anchor="2025-08-15")
+
+	def test_business_hours_skip_nights_weekends_and_holidays(self):
+		import datetime
+
+		calendar = self.compile(holidays=["2025-08-18"])
+
+		# Friday 16:00 + 4h -> 2h on Friday, Monday is a holiday, 2h on Tuesday
+		self.assertEqual(
+			calendar.add_working_seconds("2025-08-15 16:00:00", 4 * 3600),
+			datetime.datetime(2025, 8, 19, 11, 0),
+		)
+		# Saturday night counts from Monday's opening
+		self.assertEqual(
+			calendar.add_working_seconds("2025-08-16 23:00:00", 3600), datetime.datetime(2025, 8, 19, 10, 0)
+		)
+		# Landing exactly on closing time stays on that day
+		self.assertEqual(
+			calendar.add_working_seconds("2025-08-14 09:00:00", 9 * 3600),
+			datetime.datetime(2025, 8, 14, 18, 0),
+		)
+
+	@patch("ferum_custom.doctype.SLACalendar.sla_calendar.compile_calendar")
+	@patch("frappe.cache")
+	def test_compiled_calendars_are_cached_per_window(self, mock_cache, mock_compile_calendar):
+		from ferum_custom.doctype.SLACalendar.sla_calendar import CALENDAR_CACHE_TTL, get_compiled_calendar
+
+		cached = {}
+		cache = mock_cache.return_value
+		cache.get_value.side_effect = cached.get
+		cache.set_value.side_effect = lambda key, value, expires_in_sec=None: cached.__setitem__(key, value)
+		mock_compile_calendar.return_value.as_dict.return_value = {"starts": [], "ends": []}
+
+		get_compiled_calendar("Office Hours", "2025-08-15")
+		get_compiled_calendar("Office Hours", "2025-08-20")
+		get_compiled_calendar("Office Hours", "2027-01-10")
+
+		# Same window is compiled once; a later window gets its own entry instead of recompiling per call
+		self.assertEqual(mock_compile_calendar.call_count, 2)
+		self.assertEqual(len(cached), 2)
+		self.assertEqual(cache.set_value.call_args.kwargs["expires_in_sec"], CALENDAR_CACHE_TTL)
+
+	@patch("frappe.db.commit")
+	@patch("frappe.db.sql")
+	@patch("frappe.get_all")
+	def test_recomputed_deadlines_reset_breaches_moved_into_the_future(
+		self, mock_get_all, mock_sql, mock_commit
+	):
+		from ferum_custom.doctype.ServiceRequest.service_request import recompute_sla_deadlines
+
+		mock_get_all.side_effect = [
+			[frappe._dict(name="SR-001", creation="2025-08-15 09:00:00", type="Routine", priority="Low")],
+			[],
+		]
+		with patch(
+			"ferum_custom.doctype.ServiceRequest.service_request.get_calendar_for_request", return_value=None
+		):
+			recompute_sla_deadlines(customers=["ACME"])
+
+		self.assertIn("sla_breached_at = if(sla_deadline >", mock_sql.call_args.args[0])
+
+
+@skip_frappe
+class TestServiceObjectAttributeCache(unittest.TestCase):
+	@patch("frappe.get_all")
+	@patch("frappe.cache")
+	def test_cache_misses_are_loaded_in_one_query(self, mock_cache, mock_get_all):
+		import json
+
+		from ferum_custom.doctype.ServiceObject.service_object import get_service_object_attributes
+
+		cache = mock_cache.return_value
+		cache.hmget.return_value = [json.dumps({"customer": "ACME", "project": "PRJ-1"}), None, None]
+		mock_get_all.return_value = [frappe._dict(name="SO-002", customer="Globex", project=None)]
+
+		attributes = get_service_object_attributes(["SO-001", "SO-002", "SO-003", "SO-001", None])
+
+		self.assertEqual(
+			attributes,
+			{
+				"SO-001": {"customer": "ACME", "project": "PRJ-1"},
+				"SO-002": {"customer": "Globex", "project": None},
+			},
+		)
+		mock_get_all.assert_called_once_with(
+			"ServiceObject",
+			filters={"name": ["in", ["SO-002", "SO-003"]]},
+			fields=["name", "customer", "project"],
+		)
+		cache.hset.assert_called_once()
+
+
+@skip_frappe
+class TestServiceObjectUsageIndex(unittest.TestCase):
+	@patch("frappe.db.sql")
+	def test_usage_moves_with_one_update_per_delta(self, mock_sql):
+		from ferum_custom.doctype.ServiceObject.service_object import update_service_object_usage
+
+		update_service_object_usage(
+			"active_project_count", {"SO-001", "SO-002"}, {"SO-002", "SO-003", "SO-004"}
+		)
+
+		calls = {c.args[1][0]: sorted(c.args[1][1]) for c in mock_sql.call_args_list}
+		self.assertEqual(calls, {-1: ["SO-001"], 1: ["SO-003", "SO-004"]})
+
+	@patch("ferum_custom.doctype.ServiceRequest.service_request.update_service_object_usage")
+	def test_closing_a_request_releases_its_object(self, mock_update_usage):
+		from ferum_custom.doctype.ServiceRequest.service_request import ServiceRequest
+
+		request = MagicMock(service_object="SO-001", status="Completed")
+		request.get_doc_before_save.return_value = frappe._dict(service_object="SO-001", status="In Progress")
+
+		ServiceRequest.update_service_object_usage(request)
+
+		mock_update_usage.assert_called_once_with("open_request_count", ["SO-001"], [])
+
+	@patch("frappe.get_all")
+	@patch("frappe.db.get_value")
+	def test_unused_object_is_deleted_after_one_lookup(self, mock_get_value, mock_get_all):
+		from ferum_custom.doctype.ServiceObject.service_object import ServiceObject
+
+		mock_get_value.return_value = frappe._dict(active_project_count=0, open_request_count=0)
+		service_object = MagicMock()
+		service_object.name = "SO-001"
+
+		ServiceObject.on_trash(service_object)
+
+		mock_get_value.assert_called_once()
+		mock_get_all.assert_not_called()
+
+	@patch("frappe.get_all", return_value=["PRJ-0001"])
+	@patch("frappe.db.get_value")
+	def test_object_in_active_project_cannot_be_deleted(self, mock_get_value, mock_get_all):
+		from ferum_custom.doctype.ServiceObject.service_object import ServiceObject
+
+		mock_get_value.return_value = frappe._dict(active_project_count=1, open_request_count=0)
+		service_object = MagicMock()
+		service_object.name = "SO-001"
+
+		with self.assertRaises(frappe.ValidationError):
+			ServiceObject.on_trash(service_object)
+
+	@patch("frappe.db.get_value")
+	def test_saving_the_form_keeps_the_counters_from_the_database(self, mock_get_value):
+		from ferum_custom.doctype.ServiceObject.service_object import ServiceObject
+
+		mock_get_value.return_value = frappe._dict(active_project_count=2, open_request_count=5)
+		service_object = frappe._dict(name="SO-001", active_project_count=1, open_request_count=0)
+		service_object.is_new = lambda: False
+
+		ServiceObject.before_save(service_object)
+
+		self.assertEqual((service_object.active_project_count, service_object.open_request_count), (2, 5))
+		self.assertTrue(mock_get_value.call_args.kwargs["for_update"])
+
+	@patch("frappe.log_error")
+	@patch("ferum_custom.doctype.ServiceObject.service_object.rebuild_service_object_usage")
+	@patch("frappe.get_all")
+	@patch("frappe.db.sql")
+	def test_drift_check_recounts_only_objects_that_differ(
+		self, mock_sql, mock_get_all, mock_rebuild, mock_log_error
+	):
+		from ferum_custom.doctype.ServiceObject.service_object import check_service_object_usage
+
+		mock_sql.side_effect = [[("SO-001", 1), ("SO-002", 1)], [("SO-001", 2), ("SO-003", 1)]]
+		mock_get_all.return_value = [
+			frappe._dict(name="SO-001", active_project_count=1, open_request_count=2),
+			frappe._dict(name="SO-002", active_project_count=1, open_request_count=1),
+		]
+
+		drifted = check_service_object_usage()
+
+		# SO-002 counts a request that is no longer open; SO-003 misses one
+		self.assertEqual(sorted(drifted), ["SO-002", "SO-003"])
+		self.assertEqual(sorted(mock_rebuild.call_args.args[0]), ["SO-002", "SO-003"])
+		mock_log_error.assert_called_once()
+
+
+@skip_frappe
+class TestServiceObjectImport(unittest.TestCase):
+	def test_rows_are_streamed_from_csv_with_normalised_headers(self):
+		import tempfile
+
+		from ferum_custom.doctype.ServiceObject.service_object_import import iter_import_rows
+
+		with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False, encoding="utf-8") as f:
+			f.write("Object Name,Customer,Address\nBoiler 1, ACME ,Main St\n,,\nBoiler 2,ACME,\n")
+		self.addCleanup(os.remove, f.name)
+
+		rows = list(iter_import_rows(f.name))
+
+		self.assertEqual([number for number, _ in rows], [2, 4])
+		self.assertEqual(
+			rows[0][1],
+			{"object_name": "Boiler 1", "address": "Main St", "customer": "ACME", "type": "", "project": ""},
+		)
+
+	@patch("ferum_custom.doctype.ServiceObject.service_object_import.update_service_object_usage")
+	@patch("frappe.db.commit")
+	@patch("frappe.db.bulk_insert")
+	@patch("frappe.get_all")
+	def test_rows_are_deduplicated_and_inserted_in_batches(
+		self, mock_get_all, mock_bulk_insert, mock_commit, mock_update_usage
+	):
+		from ferum_custom.doctype.ServiceObject.service_object_import import ServiceObjectImporter
+
+		mock_get_all.side_effect = [
+			["Boiler 1"],
+			["ACME"],
+			[frappe._dict(name="PRJ-0001", status="Active")],
+			[frappe._dict(parent="PRJ-0001", idx=3)],
+		]
+		importer = ServiceObjectImporter(project="PRJ-0001", batch_size=2)
+		importer.error_writer = MagicMock()
+		row = {"address": "", "customer": "ACME", "type": "", "project": ""}
+
+		for number, name in enumerate(["Boiler 1", "Boiler 2", "Boiler 3", "Boiler 2", "Boiler 4"], start=2):
+			importer.add(number, {**row, "object_name": name})
+		importer.flush()
+
+		self.assertEqual((importer.imported, importer.failed), (3, 2))
+		self.assertEqual(mock_get_all.call_count, 4)
+		objects = [c for c in mock_bulk_insert.call_args_list if c.args[0] == "ServiceObject"]
+		links = [c for c in mock_bulk_insert.call_args_list if c.args[0] == "ProjectObjectItem"]
+		self.assertEqual([len(c.args[2]) for c in objects], [2, 1])
+		self.assertEqual([link[4] for c in links for link in c.args[2]], [4, 5, 6])
+		self.assertEqual(mock_commit.call_count, 2)
+
+	@patch("ferum_custom.doctype.ServiceObject.service_object_import.update_service_object_usage")
+	@patch("frappe.db.commit")
+	@patch("frappe.db.rollback")
+	@patch("frappe.db.savepoint")
+	@patch("frappe.db.bulk_insert")
+	@patch("frappe.get_all")
+	def test_batch_rejected_by_the_database_is_retried_row_by_row(
+		self, mock_get_all, mock_bulk_insert, mock_savepoint, mock_rollback, mock_commit, mock_update_usage
+	):
+		from ferum_custom.doctype.ServiceObject.service_object_import import ServiceObjectImporter
+
+		mock_get_all.side_effect = [[], ["ACME"], [frappe._dict(name="PRJ-0001", status="Active")], []]
+
+		def bulk_insert(doctype, fields, values):
+			if doctype == "ServiceObject" and any(value[0] == "Boiler 2" for value in values):
+				raise frappe.DuplicateEntryError("Duplicate entry 'Boiler 2'")
+
+		mock_bulk_insert.side_effect = bulk_insert
+		importer = ServiceObjectImporter(project="PRJ-0001", batch_size=3)
+		importer.error_writer = MagicMock()
+		row = {"address": "", "customer": "ACME", "type": "", "project": ""}
+
+		for number, name in enumerate(["Boiler 1", "Boiler 2", "Boiler 3"], start=2):
+			importer.add(number, {**row, "object_name": name})
+		importer.flush()
+
+		self.assertEqual((importer.imported, importer.failed), (2, 1))
+		self.assertEqual(importer.error_writer.writerow.call_args.args[0]["row"], 3)
+		mock_rollback.assert_any_call(save_point="service_object_import_row")
+		links = [c for c in mock_bulk_insert.call_args_list if c.args[0] == "ProjectObjectItem"]
+		# The rejected row's link index is handed to the next row
+		self.assertEqual([link[4] for c in links for link in c.args[2]], [1, 2])
+		self.assertNotIn("Boiler 2", importer.object_names)
+
+	@patch("frappe.enqueue")
+	@patch("frappe.db.get_value", return_value="FILE-0001")
+	@patch("frappe.has_permission")
+	def test_import_requires_read_access_to_the_file(self, mock_has_permission, mock_get_value, mock_enqueue):
+		from ferum_custom.doctype.ServiceObject.service_object_import import import_service_objects
+
+		mock_has_permission.side_effect = lambda doctype, ptype, doc=None, throw=False: (
+			doctype != "File" or frappe.throw("Not permitted", frappe.PermissionError)
+		)
+
+		with self.assertRaises(frappe.PermissionError):
+			import_service_objects("/private/files/objects.csv")
+
+		mock_has_permission.assert_called_with("File", "read", "FILE-0001", throw=True)
+		mock_enqueue.assert_not_called()
+
+
+@skip_frappe
+class TestServiceProjectUniqueObjects(unittest.TestCase):
+	def _project(self, *service_objects, status="Active"):
+		project = MagicMock(
+			status=status, objects=[frappe._dict(service_object=so) for so in service_objects]
+		)
+		project.name = "PRJ-0001"
+		return project
+
+	@patch("frappe.get_all")
+	def test_all_conflicts_are_reported_from_one_query(self, mock_get_all):
+		from ferum_custom.doctype.ServiceProject.service_project import ServiceProject
+
+		mock_get_all.return_value = [
+			frappe._dict(name="PRJ-0002", service_object="SO-002"),
+			frappe._dict(name="PRJ-0003", service_object="SO-003"),
+		]
+		project = self._project(*[f"SO-{n:03d}" for n in range(1, 2001)], "SO-001")
+
+		with self.assertRaises(Exception) as error:
+			ServiceProject.validate_unique_objects(project)
+
+		mock_get_all.assert_called_once()
+		self.assertEqual(mock_get_all.call_args.kwargs["filters"]["status"], ["in", ("Planned", "Active")])
+		message = str(error.exception)
+		self.assertIn("SO-001 is duplicated", message)
+		self.assertIn("SO-002 is already linked to active project PRJ-0002", message)
+		self.assertIn("SO-003 is already linked to active project PRJ-0003", message)
+
+	@patch("frappe.get_all")
+	def test_closed_project_skips_the_cross_project_check(self, mock_get_all):
+		from ferum_custom.doctype.ServiceProject.service_project import ServiceProject
+
+		ServiceProject.validate_unique_objects(self._project("SO-001", status="Completed"))
+
+		mock_get_all.assert_not_called()
+
+
+@skip_frappe
+class TestBulkServiceRequestIngestion(unittest.TestCase):
+	@patch("ferum_custom.doctype.ServiceRequest.service_request.notify_new_service_requests_bulk")
+	@patch("frappe.db.commit")
+	@patch("frappe.db.savepoint")
+	@patch("frappe.has_permission", return_value=True)
+	@patch("frappe.get_doc")
+	@patch("ferum_custom.doctype.ServiceRequest.service_request.get_service_object_attributes")
+	def test_rows_are_validated_set_wise_and_inserted_in_chunks(
+		self,
+		mock_get_attributes,
+		mock_get_doc,
+		mock_has_permission,
+		mock_savepoint,
+		mock_commit,
+		mock_notify_bulk,
+	):
+		from ferum_custom.doctype.ServiceRequest.service_request import bulk_create_service_requests
+
+		mock_get_attributes.return_value = {"SO-001": {"customer": "ACME", "project": None}}
+		docs = [MagicMock(), MagicMock(), MagicMock()]
+		for number, doc in enumerate(docs, 1):
+			doc.name = f"SR-{number:03d}"
+		mock_get_doc.side_effect = docs
+
+		results = bulk_create_service_requests(
+			[
+				{"title": "Leak", "service_object": "SO-001"},
+				{"title": "Unknown object", "service_object": "SO-404"},
+				{"title": "Noise", "service_object": "SO-001"},
+				{"service_object": "SO-001"},
+				{"title": "Smoke", "service_object": "SO-001", "type": "Emergency"},
+			],
+			chunk_size=2,
+		)
+
+		self.assertEqual(
+			[r["status"] for r in results], ["Created", "Failed", "Created", "Failed", "Created"]
+		)
+		self.assertEqual(results[4]["name"], "SR-003")
+		mock_get_attributes.assert_called_once()
+		self.assertEqual(mock_commit.call_count, 2)
+		self.assertEqual(mock_notify_bulk.call_count, 2)
+		self.assertTrue(all(doc.flags.skip_notifications for doc in docs))
+
+	@patch("ferum_custom.doctype.ServiceRequest.service_request.notify_new_service_requests_bulk")
+	@patch("frappe.db.commit")
+	@patch("frappe.db.savepoint")
+	@patch("frappe.has_permission", return_value=True)
+	@patch("frappe.get_doc")
+	@patch("ferum_custom.doctype.ServiceRequest.service_request.get_service_object_attributes")
+	def test_rows_only_set_whitelisted_fields(
+		self,
+		mock_get_attributes,
+		mock_get_doc,
+		mock_has_permission,
+		mock_savepoint,
+		mock_commit,
+		mock_notify_bulk,
+	):
+		from ferum_custom.doctype.ServiceRequest.service_request import bulk_create_service_requests
+
+		mock_get_attributes.return_value = {}
+		results = bulk_create_service_requests(
+			[
+				"not an object",
+				{
+					"title": "Leak",
+					"priority": "High",
+					"name": "SR-HIJACK",
+					"creation": "2020-01-01 00:00:00",
+					"sla_breached_at": "2020-01-02 00:00:00",
+					"assigned_to": "someone@example.com",
+				},
+			]
+		)
+
+		self.assertEqual(results[0], {"row": 0, "status": "Failed", "error": "Row must be an object."})
+		self.assertEqual(
+			mock_get_doc.call_args.args[0],
+			{"doctype": "ServiceRequest", "status": "Open", "title": "Leak", "priority": "High"},
+		)
+
+
 if __name__ == "__main__":
 	unittest.main()
@@ -0,0 +1,182 @@
+"""Declarative status workflows for ServiceRequest, ServiceReport and Invoice.
+
+Each doctype lists its allowed transitions once; the tables are compiled at import time into a
+`(from_status, to_status) -> Transition` dict, so validating a save is a single lookup. The old
+status comes from `doc_before_save`, which Frappe has already loaded, never from a query.
+"""
+
+from dataclasses import dataclass
+
+import frappe
+from frappe import _
+
+
+@dataclass(frozen=True)
+class Transition:
+	from_status: str
+	to_status: str
+	# The user needs at least one of these roles (empty: anyone)
+	roles: tuple[str, ...] = ()
+	# These fields must be set (a zero amount counts as unset)
+	required_fields: tuple[str, ...] = ()
+	message: str | None = None
+
+
+@dataclass(frozen=True)
+class Workflow:
+	initial_statuses: tuple[str, ...]
+	transitions: tuple[Transition, ...]
+
+
+WORKFLOWS = {
+	# [*] --> Open --> In Progress --> Completed --> Closed, with cancellation and rework
+	"ServiceRequest": Workflow(
+		initial_statuses=("Open",),
+		transitions=(
+			Transition(
+				"Open",
+				"In Progress",
+				required_fields=("assigned_to",),
+				message="Cannot set status to 'In Progress' without assigning an engineer.",
+			),
+			Transition("Open", "Cancelled"),
+			Transition(
+				"In Progress",
+				"Completed",
+				required_fields=("linked_report",),
+				message="Cannot set status to 'Completed' without linking a Service Report.",
+			),
+			Transition("In Progress", "Open"),
+			Transition("In Progress", "Cancelled"),
+			Transition("Completed", "In Progress"),
+			Transition(
+				"Completed",
+				"Closed",
+				roles=("System Manager",),
+				message="Only a Manager can close a Service Request.",
+			),
+		),
+	),
+	"ServiceReport": Workflow(
+		initial_statuses=("Draft", "Submitted"),
+		transitions=(
+			Transition("Draft", "Submitted"),
+			Transition("Submitted", "Approved"),
+			Transition("Approved", "Archived"),
+			Transition("Submitted", "Draft"),
+			Transition("Draft", "Cancelled"),
+			Transition("Submitted", "Cancelled"),
+		),
+	),
+	"Invoice": Workflow(
+		initial_statuses=("Draft", "Sent"),
+		transitions=(
+			Transition(
+				"Draft",
+				"Sent",
+				required_fields=("due_date",),
+				message="Set a Due Date before sending the Invoice.",
+			),
+			Transition(
+				"Sent", "Paid", required_fields=("amount",), message="A paid Invoice needs an amount."
+			),
+			Transition("Sent", "Overdue"),
+			Transition(
+				"Overdue", "Paid", required_fields=("amount",), message="A paid Invoice needs an amount."
+			),
+			Transition("Draft", "Cancelled"),
+			Transition("Sent", "Cancelled"),
+			Transition("Overdue", "Cancelled"),
+		),
+	),
+}
+
+_compiled = {
+	doctype: {(t.from_status, t.to_status): t for t in workflow.transitions}
+	for doctype, workflow in WORKFLOWS.items()
+}
+
+
+def get_transition_error(doctype, old_status, new_status, doc, roles):
+	"""Returns why `doc` may not move from `old_status` to `new_status`, or None if it may."""
+	if old_status == new_status:
+		return None
+
+	if old_status is None:
+		if new_status in WORKFLOWS[doctype].initial_statuses:
+			return None
+		return _("A new document cannot start in status {0}.").format(new_status)
+
+	transition = _compiled[doctype].get((old_status, new_status))
+	if not transition:
+		return _("Invalid status transition from {0} to {1}.").format(old_status, new_status)
+
+	if transition.roles and not set(transition.roles).intersection(roles):
+		return _(transition.message or "You are not permitted to move this document to {0}.").format(
+			new_status
+		)
+
+	for fieldname in transition.required_fields:
+		if not doc.get(fieldname):
+			return _(transition.message or "{0} is required for status {1}.").format(
+				frappe.unscrub(fieldname), new_status
+			)
+
+	return None
+
+
+def validate_status_transition(doc, doctype=None):
+	"""Throws if the status change of `doc` in the current save is not allowed."""
+	if doc.flags.status_transition_validated:
+		return
+	before = doc.get_doc_before_save()
+	old_status = before.status if before else None
+	error = get_transition_error(doctype or doc.doctype, old_status, doc.status, doc, frappe.get_roles())
+	if error:
+		frappe.throw(error)
+
+
+@frappe.whitelist()
+def bulk_transition(doctype, names, status):
+	"""Moves many documents to `status`.
+
+	All documents are checked in one pass against one query, and nothing is saved unless every
+	transition is valid. Each document is then saved normally so its hooks still run.
+	"""
+	names = frappe.parse_json(names) if isinstance(names, str) else names
+	if doctype not in WORKFLOWS:
+		frappe.throw(_("No status workflow is defined for {0}.").format(doctype))
+
+	required_fields = {
+		fieldname
+		for transition in WORKFLOWS[doctype].transitions
+		if transition.to_status == status
+		for fieldname in transition.required_fields
+	}
+	rows = frappe.get_all(
+		doctype,
+		filters={"name": ["in", names]},
+		fields=["name", "status", *sorted(required_fields)],
+	)
+	missing = set(names) - {row.name for row in rows}
+	if missing:
+		frappe.throw(_("{0} not found: {1}").format(doctype, ", ".join(sorted(missing))))
+
+	roles = frappe.get_roles()
+	errors = []
+	for row in rows:
+		error = get_transition_error(doctype, row.status, status, row, roles)
+		if error:
+			errors.append(f"{row.name}: {error}")
+	if errors:
+		frappe.throw("<br>".join(errors), title=_("Invalid status transitions"))
+
+	for row in rows:
+		if row.status == status:
+			continue
+		doc = frappe.get_doc(doctype, row.name)
+		doc.status = status
+		doc.flags.status_transition_validated = True
+		doc.save()
+
+	return len(rows)